@@ -0,0 +1,196 @@
+"""
+Benchmarks of the point process generators, the gridding functions and
+estimators, reduced sweeps through every run_simulation_* function, and the
+trial-by-trial loop of a sweep against its batch_size blocks.
+
+Usage:
+    python benchmarks/run_benchmarks.py --save          # record the baseline
+    python benchmarks/run_benchmarks.py                 # compare with the baseline
+    python benchmarks/run_benchmarks.py -k aggregation_2d --threshold 1.5
+
+The comparison exits with status 1 when a benchmark is slower than its
+baseline time by more than the threshold factor. Timings depend on the
+machine, so the baseline should be recorded on the machine it is compared on.
+"""
+import argparse
+from functools import partial
+import json
+import os
+import sys
+import timeit
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import numpy as np
+from src import aggregation_1d, aggregation_2d, aggregation_nd, point_processes_1d, point_processes_2d, simulation1d, simulation2d
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+# Grid widths of the gridding and estimator benchmarks. The 2D histograms stop
+# at 1e-3 (9 million cells on [-1, 2]^2), the grid-free estimators go down to 1e-4.
+GRID_WIDTHS_1D = [1e-1, 1e-2, 1e-3, 1e-4]
+GRID_WIDTHS_2D = [1e-1, 1e-2, 1e-3]
+GRID_WIDTHS_GRID_FREE_2D = [1e-1, 1e-2, 1e-3, 1e-4]
+
+def get_benchmarks():
+    """
+    Dict of benchmark name to a function of no arguments to time.
+    """
+    benchmarks = {}
+
+    # Point process generators across rates and grid resolutions
+    for rate in [100, 1000, 10000]:
+        benchmarks[f'point_processes_1d.poisson[rate={rate}]'] = partial(point_processes_1d.get_poisson_process_samples, rate, -1, 2)
+        benchmarks[f'point_processes_1d.neyman_scott[lambda_c={rate // 20}]'] = partial(point_processes_1d.get_neyman_scott_process, 20, rate // 20, 0.01, -1, 2)
+        benchmarks[f'point_processes_2d.poisson[rate={rate}]'] = partial(point_processes_2d.get_poisson_process_samples_2d, rate, -1, 2, -1, 2)
+        benchmarks[f'point_processes_2d.neyman_scott[lambda_c={rate // 20}]'] = partial(point_processes_2d.get_neyman_scott_process_2d, 20, rate // 20, 0.01, -1, 2, -1, 2)
+    for dx in [1e-2, 1e-3, 1e-4]:
+        benchmarks[f'point_processes_1d.lgcp[dx={dx}]'] = partial(point_processes_1d.get_log_gaussian_cox_process, dx, 4, 0.5, 0.1, -1, 2)
+        benchmarks[f'point_processes_1d.lgcp_direct_sampling[dx={dx}]'] = partial(point_processes_1d.get_log_gaussian_cox_process_direct_sampling, dx, 4, 0.5, 0.1, -1, 2)
+    for grid_size in [50, 200, 800]:
+        benchmarks[f'point_processes_2d.lgcp[grid_size={grid_size}]'] = partial(point_processes_2d.get_lgcp_2d, 1000, -1, 2, -1, 2, grid_size)
+
+    # Gridding functions and estimators across grid widths
+    np.random.seed(0)
+    data = np.random.uniform(-1, 2, 3000)
+    data_2d = np.random.uniform(-1, 2, (3000, 2))
+    polygon = (0.2, 0.7)
+    angles = np.linspace(0, 2 * np.pi, 64, endpoint=False)
+    vertices = np.column_stack((0.45 + 0.25 * np.cos(angles), 0.45 + 0.25 * np.sin(angles)))
+    for grid_width in GRID_WIDTHS_1D:
+        count, edges = aggregation_1d.create_gridded_data(data, grid_width, -1, 2)
+        benchmarks[f'aggregation_1d.create_gridded_data[dg={grid_width}]'] = partial(aggregation_1d.create_gridded_data, data, grid_width, -1, 2)
+        benchmarks[f'aggregation_1d.create_gridded_data_random_origin[dg={grid_width}]'] = partial(aggregation_1d.create_gridded_data_random_origin, data, grid_width, -1, 2, 0.5)
+        benchmarks[f'aggregation_1d.centroid_allocation_estimate[dg={grid_width}]'] = partial(aggregation_1d.centroid_allocation_estimate, count, edges, *polygon)
+        benchmarks[f'aggregation_1d.proportional_allocation_estimate[dg={grid_width}]'] = partial(aggregation_1d.proportional_allocation_estimate, count, edges, *polygon)
+        benchmarks[f'aggregation_1d.grid_free_estimates[dg={grid_width}]'] = partial(aggregation_1d.grid_free_estimates, data, edges, *polygon)
+    for grid_width in GRID_WIDTHS_2D:
+        count, edges_x, edges_y = aggregation_2d.create_gridded_data_2d(data_2d, grid_width, (-1, 2), (-1, 2))
+        benchmarks[f'aggregation_2d.create_gridded_data_2d[dg={grid_width}]'] = partial(aggregation_2d.create_gridded_data_2d, data_2d, grid_width, (-1, 2), (-1, 2), 0.5)
+        benchmarks[f'aggregation_2d.centroid_allocation_estimate_2d[dg={grid_width}]'] = partial(aggregation_2d.centroid_allocation_estimate_2d, count, edges_x, edges_y, polygon, polygon)
+        benchmarks[f'aggregation_2d.proportional_allocation_estimate_2d[dg={grid_width}]'] = partial(aggregation_2d.proportional_allocation_estimate_2d, count, edges_x, edges_y, polygon, polygon)
+        benchmarks[f'aggregation_2d.proportional_allocation_estimate_polygon_2d[dg={grid_width}]'] = partial(aggregation_2d.proportional_allocation_estimate_polygon_2d, count, edges_x, edges_y, vertices)
+    # Histograms against numpy, whose pairs show the gain of the arithmetic
+    # binning on fine grids and that coarse grids are left to numpy
+    for grid_width in GRID_WIDTHS_1D:
+        edges = aggregation_1d.create_random_origin_bins(grid_width, -1, 2, 0.5)
+        benchmarks[f'aggregation_1d.histogram[dg={grid_width}]'] = partial(aggregation_1d.histogram, data, edges)
+        benchmarks[f'numpy.histogram[dg={grid_width}]'] = partial(np.histogram, data, edges)
+    for grid_width in GRID_WIDTHS_2D:
+        edges = aggregation_2d.create_random_origin_bins_2d(-1, 2, grid_width, 0.5)
+        benchmarks[f'aggregation_2d.histogram_2d[dg={grid_width}]'] = partial(aggregation_2d.histogram_2d, data_2d[:, 0], data_2d[:, 1], edges, edges)
+        benchmarks[f'numpy.histogram2d[dg={grid_width}]'] = partial(np.histogram2d, data_2d[:, 0], data_2d[:, 1], [edges, edges])
+    for grid_width in GRID_WIDTHS_GRID_FREE_2D:
+        edges = aggregation_2d.create_random_origin_bins_2d(-1, 2, grid_width)
+        benchmarks[f'aggregation_2d.grid_free_estimates_2d[dg={grid_width}]'] = partial(aggregation_2d.grid_free_estimates_2d, data_2d, edges, edges, polygon, polygon)
+
+    # Space-time grid of 100 x 100 cells and 365 days
+    space_time_edges = [np.linspace(-1, 2, 101), np.linspace(-1, 2, 101), np.arange(366)]
+    space_time_count = np.random.poisson(1, (100, 100, 365))
+    space_time_polygon = [polygon, polygon, (10.5, 300.5)]
+    benchmarks['aggregation_nd.centroid_allocation_estimate_nd[space_time]'] = partial(aggregation_nd.centroid_allocation_estimate_nd, space_time_count, space_time_edges, space_time_polygon)
+    benchmarks['aggregation_nd.proportional_allocation_estimate_nd[space_time]'] = partial(aggregation_nd.proportional_allocation_estimate_nd, space_time_count, space_time_edges, space_time_polygon)
+
+    # Full sweeps at reduced sizes
+    dg = [0.001, 0.01, 0.1]
+    dp = [0.5, 0.5, 0.5]
+    for run_simulation in [
+        simulation1d.run_simulation_fixed_edge,
+        simulation1d.run_simulation_random_polygon_placement,
+        simulation1d.run_simulation_random_polygon_placement_and_grid_origin,
+    ]:
+        benchmarks[f'simulation1d.{run_simulation.__name__}'] = partial(
+            run_simulation, 1000, -1, 2, 20, dg, dp, point_processes_1d.get_poisson_process_samples, seed=0)
+    for run_simulation in [
+        simulation2d.run_simulation_fixed_edge_2d,
+        simulation2d.run_simulation_random_polygon_placement_2d,
+        simulation2d.run_simulation_random_polygon_placement_and_grid_origin_2d,
+    ]:
+        benchmarks[f'simulation2d.{run_simulation.__name__}'] = partial(
+            run_simulation, 1000, (-1, 2), (-1, 2), 5, [0.01, 0.1], [0.5, 0.5], point_processes_2d.poisson_process_2d, seed=0)
+
+    # Trial-by-trial loop against batches of trials, on the random grid origin scenario
+    for batch_size in [None, 500]:
+        name = 'loop' if batch_size is None else f'batch_size={batch_size}'
+        benchmarks[f'batch.simulation1d[{name}]'] = partial(
+            simulation1d.run_simulation_random_polygon_placement_and_grid_origin, 100, -3, 4, 500, dg, dp,
+            point_processes_1d.get_poisson_process_samples, batch_size=batch_size, seed=0)
+        benchmarks[f'batch.simulation2d[{name}]'] = partial(
+            simulation2d.run_simulation_random_polygon_placement_and_grid_origin_2d, 20, (-3, 4), (-3, 4), 200,
+            [0.01, 0.1], [1, 1], point_processes_2d.poisson_process_2d, batch_size=batch_size, seed=0)
+    return benchmarks
+
+def time_benchmark(function, repeat=3):
+    """
+    Best time per call, in seconds, over repeat runs of at least 0.2 s each.
+    """
+    np.random.seed(0)
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+def run_benchmarks(pattern=None, repeat=3, verbose=True):
+    """
+    Time every benchmark whose name contains pattern.
+
+    Returns:
+    - Dict of benchmark name to seconds per call
+    """
+    results = {}
+    for name, function in get_benchmarks().items():
+        if pattern is not None and pattern not in name:
+            continue
+        results[name] = time_benchmark(function, repeat)
+        if verbose:
+            print(f'{name}: {results[name] * 1e3:.3f} ms', flush=True)
+    return results
+
+def compare(results, baseline, threshold):
+    """
+    Benchmarks slower than their baseline time by more than the threshold factor.
+
+    Returns:
+    - List of (name, baseline seconds, current seconds, slowdown)
+    """
+    regressions = []
+    for name, seconds in results.items():
+        if name in baseline and seconds > threshold * baseline[name]:
+            regressions.append((name, baseline[name], seconds, seconds / baseline[name]))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='JSON file of baseline timings')
+    parser.add_argument('--save', action='store_true', help='record the timings as the new baseline')
+    parser.add_argument('--threshold', type=float, default=1.5, help='slowdown factor that counts as a regression')
+    parser.add_argument('-k', dest='pattern', help='only run the benchmarks whose name contains this')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timing runs per benchmark')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.pattern, args.repeat)
+    if args.save:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as file:
+                baseline = json.load(file)
+        baseline.update(results)
+        with open(args.baseline, 'w') as file:
+            json.dump(baseline, file, indent=2, sort_keys=True)
+        print(f'Saved {len(results)} timings to {args.baseline}')
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f'No baseline at {args.baseline}, run with --save first')
+        return 1
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    regressions = compare(results, baseline, args.threshold)
+    for name, before, after, slowdown in regressions:
+        print(f'REGRESSION {name}: {before * 1e3:.3f} ms -> {after * 1e3:.3f} ms ({slowdown:.2f}x)')
+    missing = sorted(set(results) - set(baseline))
+    if missing:
+        print(f'{len(missing)} benchmarks have no baseline: {", ".join(missing)}')
+    print(f'{len(regressions)} of {len(results)} benchmarks slower than {args.threshold}x their baseline')
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,8 @@
 # Create Sample Data
 import numpy as np
+from src.aggregation_nd import count_cells, get_compact_count_dtype
+# The bin index functions live in binning, which aggregation_nd uses as well
+from src.binning import get_arithmetic_bin_index, get_bin_index, is_regular_edges
 
 # Create gridded data using histogram
 # def create_gridded_data(data, grid_size, start=0, end=1):
@@ -10,9 +13,9 @@ import numpy as np
 #     hist, bin_edges = np.histogram(data, bins=bins)
 #     return hist, bin_edges
 
-def create_gridded_data(data, grid_size, start=0, end=1):
+def create_bins(grid_size, start=0, end=1):
     """
-    Create gridded data using histogram.
+    Create the bin edges used by create_gridded_data.
     """
     if start < 0:
         neg_bins = np.arange(start, 0, grid_size)
@@ -22,21 +25,68 @@ def create_gridded_data(data, grid_size, start=0, end=1):
         bins = np.array([start, end])  # Create a single bin from start to end
     else:
         bins = np.arange(start, end+grid_size, grid_size)  # Create bins from 0 to 1 with specified grid size
-    hist, bin_edges = np.histogram(data, bins=bins)
-    return hist, bin_edges
+    return bins
 
-def create_gridded_data_random_origin(data, grid_size, start=0, end=1, range_of_variation=0):
+def create_random_origin_bins(grid_size, start=0, end=1, range_of_variation=0):
     """
-    Create gridded data using histogram.
+    Create bin edges with a random origin.
     """
     origin = np.random.uniform(0, range_of_variation)
     
     neg_bins = np.arange(start, origin, grid_size)
     pos_bins = np.arange(origin, end+grid_size, grid_size)  # Create bins from 0 to end
-    bins = np.concatenate((neg_bins, pos_bins))  # Combine negative and positive bins
-    hist, bin_edges = np.histogram(data, bins=bins)
+    return np.concatenate((neg_bins, pos_bins))  # Combine negative and positive bins
+
+# Beyond this many points np.histogram, which sorts the data in blocks before
+# locating the edges, is faster than the arithmetic binning of histogram
+ARITHMETIC_HISTOGRAM_MAX_POINTS = 8192
+# Below this many bins np.histogram is faster than the arithmetic binning of
+# histogram (see the histogram benchmarks of benchmarks/run_benchmarks.py)
+ARITHMETIC_HISTOGRAM_MIN_BINS = 2048
+
+def create_gridded_data(data, grid_size, start=0, end=1, compact=False):
+    """
+    Create gridded data using histogram.
+    """
+    bins = create_bins(grid_size, start, end)
+    hist, bin_edges = histogram(data, bins, compact)
     return hist, bin_edges
 
+def create_gridded_data_random_origin(data, grid_size, start=0, end=1, range_of_variation=0, compact=False):
+    """
+    Create gridded data using histogram.
+    """
+    bins = create_random_origin_bins(grid_size, start, end, range_of_variation)
+    hist, bin_edges = histogram(data, bins, compact)
+    return hist, bin_edges
+
+def histogram(data, edges, compact=False):
+    """
+    Same as np.histogram(data, bins=edges), including the last bin being closed.
+
+    np.histogram locates every edge among the points, which takes longer the
+    more bins there are. For at least ARITHMETIC_HISTOGRAM_MIN_BINS bins and at
+    most ARITHMETIC_HISTOGRAM_MAX_POINTS points, the bin of each point is
+    instead computed arithmetically by get_arithmetic_bin_index and counted
+    with np.bincount. Other inputs, and edges that are not regular enough for
+    the arithmetic bins to be exact, fall back to np.histogram.
+
+    With compact the counts have the smallest integer type that can hold them
+    (see aggregation_nd.count_cells), which the estimators accept like any other.
+    """
+    edges = np.asarray(edges)
+    data = np.asarray(data)
+    index = None
+    if data.ndim == 1 and len(edges) > ARITHMETIC_HISTOGRAM_MIN_BINS and len(data) <= ARITHMETIC_HISTOGRAM_MAX_POINTS:
+        index = get_arithmetic_bin_index(data, edges)
+    if index is None:
+        hist, edges = np.histogram(data, bins=edges)
+        if compact:
+            hist = hist.astype(get_compact_count_dtype(hist.max(initial=0)))
+        return hist, edges
+    hist = count_cells(index[index >= 0], len(edges) - 1, compact)
+    return hist, edges
+
 # Create the actual value that falls within the range
 def get_actual_value(data, start, end):
     """
@@ -48,45 +98,460 @@ def get_actual_value(data, start, end):
 def centroid_allocation_estimate(count, edges, polygon_start, polygon_end):
     """
     Estimate the value using centroid allocation.
+
+    The centers of the cells increase, so the cells with their center in the
+    polygon form a run, found from the cells holding the polygon bounds.
+    Only the counts of the run are read.
     """
-    centers = (edges[:-1] + edges[1:]) / 2
-    return np.sum(count[(centers >= polygon_start) & (centers <= polygon_end)])
+    edges = np.asarray(edges, dtype=float)
+    first = _get_cell(edges, polygon_start)
+    if (edges[first] + edges[first + 1]) / 2 < polygon_start:
+        first += 1
+    last = _get_cell(edges, polygon_end)
+    if (edges[last] + edges[last + 1]) / 2 <= polygon_end:
+        last += 1
+    return float(np.sum(count[first:last], dtype=float)) if last > first else 0.0
 
 # Estimate the value using proportional allocation
 def proportional_allocation_estimate(count, edges, polygon_start, polygon_end):
     """
     Estimate the value using proportional allocation.
+
+    Each cell contributes its count times the fraction of its width that lies
+    within the polygon, using the actual width of every cell. Only the cells
+    holding the polygon bounds can be partly within it, so the cells in between
+    are summed and the fraction is computed for those two cells alone.
     """
-    grid_width = edges[1] - edges[0]
-    begin_edges = edges[:-1]
-    end_edges = edges[1:]
-    
-    polygon_begins_before_first_edge = polygon_start <= begin_edges
-    polygon_ends_after_last_edge = polygon_end >= end_edges
+    edges = np.asarray(edges, dtype=float)
+    first = _get_cell(edges, polygon_start)
+    last = _get_cell(edges, polygon_end)
+    if last < first:
+        return 0.0
+    estimate = float(np.sum(count[first + 1:last], dtype=float))
+    for cell in range(first, last + 1, max(last - first, 1)):
+        width = edges[cell + 1] - edges[cell]
+        # Cells without width hold no count
+        if width > 0:
+            overlap = min(edges[cell + 1], polygon_end) - max(edges[cell], polygon_start)
+            estimate += max(overlap, 0) / width * count[cell]
+    return estimate
 
-    grid_cell_contains_polygon_start = (begin_edges < polygon_start) & (end_edges > polygon_start)
-    grid_cell_contains_polygon_end = (begin_edges < polygon_end) & (end_edges > polygon_end)
+def _get_cell(edges, x):
+    """
+    Index of the cell holding x, clipped to the cells of the grid.
+    """
+    return min(max(int(np.searchsorted(edges, x, side='right')) - 1, 0), len(edges) - 2)
+
+# Estimate both values directly from the points, without the histogram
+def grid_free_estimates(data, edges, polygon_start, polygon_end):
+    """
+    Calculate the actual value and the centroid and proportional allocation
+    estimates directly from the points, without creating the histogram.
 
-    # Determine the grid cells that lie fully within the polygon
-    fully_within = (polygon_begins_before_first_edge) & (polygon_ends_after_last_edge)
+    Gives the same values as create_gridded_data followed by the estimators
+    with the same edges: a point counts towards the centroid estimate if the
+    center of its cell lies within the polygon, and adds the fraction of its
+    cell within the polygon to the proportional estimate. Only the points
+    within a cell width of the polygon are binned.
 
-    # and the grid cells that are partially within the polygon
-    partially_within = (grid_cell_contains_polygon_start | grid_cell_contains_polygon_end) & ~fully_within
+    Returns:
+    - Tuple (actual_value, estimate_centroid, estimate_proportional)
+    """
+    data = np.asarray(data)
+    edges = np.asarray(edges, dtype=float)
+    actual_value = np.count_nonzero((data >= polygon_start) & (data <= polygon_end))
 
-    # Sum the counts of the fully within cells
-    estimate = np.sum(count[fully_within])
-    
-    # For the partially within cells, we need to calculate the fraction of the polygon that lies within the grid cell
-    edge_starts = begin_edges[partially_within]
-    edge_ends = end_edges[partially_within]
-    count_partial = count[partially_within]
-    for i,edge in enumerate(edge_starts):
-        # Calculate the fraction of the grid cell that lies within the polygon
-        if edge_starts[i] < polygon_start:
-            fraction = (edge_ends[i] - polygon_start) / grid_width
-        elif edge_ends[i] > polygon_end:
-            fraction = (polygon_end - edge_starts[i]) / grid_width
-        else:
-            fraction = 1.0
-        estimate += count_partial[i] * fraction
-    return estimate
\ No newline at end of file
+    # Points further than a cell width from the polygon add to neither estimate
+    reach = np.max(np.diff(edges))
+    near = data[(data >= polygon_start - reach) & (data <= polygon_end + reach)]
+    cell = get_bin_index(near, edges)
+    cell = cell[cell >= 0]
+    start = edges[cell]
+    end = edges[cell + 1]
+
+    centers = (start + end) / 2
+    estimate_centroid = np.count_nonzero((centers >= polygon_start) & (centers <= polygon_end))
+    overlap = np.clip(np.minimum(end, polygon_end) - np.maximum(start, polygon_start), 0, None)
+    estimate_proportional = np.sum(overlap / (end - start))
+    return actual_value, estimate_centroid, estimate_proportional
+
+class GridIndex1D:
+    """
+    Prefix-sum index of gridded data for centroid and proportional allocation.
+
+    Built once from the (count, edges) returned by create_gridded_data, it answers
+    queries for any [polygon_start, polygon_end] with two binary searches. The
+    polygon bounds can be scalars or arrays, in which case one estimate is
+    returned per interval. The edges do not need to be uniform (e.g. the odd
+    first bin of create_gridded_data_random_origin).
+    """
+    def __init__(self, count, edges):
+        self.count = np.asarray(count)
+        self.edges = np.asarray(edges, dtype=float)
+        self.centers = (self.edges[:-1] + self.edges[1:]) / 2
+        self.widths = np.diff(self.edges)
+        # Compact counts are accumulated in 64 bits
+        self.cumulative_count = np.concatenate(([0], np.cumsum(self.count, dtype=np.result_type(self.count, np.int64))))
+
+    def centroid_allocation(self, polygon_start, polygon_end):
+        """
+        Estimate the value using centroid allocation.
+        """
+        # The cells with their center in the polygon form the range [first, last)
+        first = np.searchsorted(self.centers, polygon_start, side='left')
+        last = np.searchsorted(self.centers, polygon_end, side='right')
+        estimate = np.where(last > first, self.cumulative_count[last] - self.cumulative_count[np.minimum(first, last)], 0)
+        return estimate[()]
+
+    def proportional_allocation(self, polygon_start, polygon_end):
+        """
+        Estimate the value using proportional allocation.
+        """
+        return (self.cumulative_value(polygon_end) - self.cumulative_value(polygon_start))[()]
+
+    def cumulative_value(self, x):
+        """
+        Proportionally allocated count of everything below x, i.e. the
+        cumulative count interpolated linearly within each cell.
+        """
+        x = np.clip(x, self.edges[0], self.edges[-1])
+        cell = np.clip(np.searchsorted(self.edges, x, side='right') - 1, 0, len(self.widths) - 1)
+        width = self.widths[cell]
+        fraction = np.divide(x - self.edges[cell], width, out=np.zeros(np.shape(x)), where=width > 0)
+        return self.cumulative_count[cell] + self.count[cell] * fraction
+
+class PointIndex1D:
+    """
+    Sorted points of one realization for counting the points in intervals.
+
+    Built once with a sort, it gives the same value as get_actual_value (with
+    both bounds included) with two binary searches per interval. The bounds
+    can be scalars or arrays, in which case one count is returned per interval.
+    """
+    def __init__(self, data):
+        self.points = np.sort(np.asarray(data, dtype=float).ravel())
+
+    def get_actual_value(self, start, end):
+        """
+        Number of points in [start, end].
+        """
+        first = np.searchsorted(self.points, start, side='left')
+        last = np.searchsorted(self.points, end, side='right')
+        return np.maximum(last - first, 0)[()]
+
+# Batched versions of the functions above. A batch of trials is stored as the
+# concatenated points of every trial, in the order of the trials, plus the index
+# of the trial each point belongs to, so that a whole block of trials is handled
+# with array operations.
+def stack_trials(samples):
+    """
+    Concatenate a list of per-trial point arrays.
+
+    Returns the concatenated points and the trial index of each point.
+    """
+    lengths = [len(points) for points in samples]
+    data = np.concatenate(samples) if samples else np.empty(0)
+    trial_index = np.repeat(np.arange(len(samples)), lengths)
+    return data, trial_index
+
+def pad_edges(bins):
+    """
+    Stack per-trial bin edges into a 2D array.
+
+    Trials with fewer bins are padded by repeating their last edge, which adds
+    empty zero-width cells that never receive points.
+    """
+    n_edges = max(len(edges) for edges in bins)
+    padded = np.empty((len(bins), n_edges))
+    for i, edges in enumerate(bins):
+        padded[i, :len(edges)] = edges
+        padded[i, len(edges):] = edges[-1]
+    return padded
+
+def create_random_origin_bins_batch(n_trials, grid_size, start=0, end=1, range_of_variation=0):
+    """
+    Create the bin edges of a batch of trials, each with its own random origin
+    as in create_random_origin_bins. The origins are drawn at once.
+    """
+    return RandomOriginEdges(grid_size, start, end, np.random.uniform(0, range_of_variation, n_trials))
+
+class RandomOriginEdges:
+    """
+    Bin edges of a batch of trials, with the edges of create_random_origin_bins
+    for the origin of every trial: bins of grid_size from start up to the
+    origin, the last of which ends at the origin, then bins of grid_size from
+    the origin to past end.
+
+    The edges are computed from the origins when needed rather than stored, so
+    the bin of every point is found arithmetically (see get_bin_index). They
+    are indexed like the padded edges of pad_edges, with arrays of rows and
+    edge indices, and are accepted in their place by create_gridded_data_batch
+    and the batched estimators. Up to rounding, the edges are those of
+    np.arange in create_random_origin_bins.
+    """
+    def __init__(self, grid_size, start, end, origin):
+        self.grid_size = grid_size
+        self.start = start
+        self.origin = np.asarray(origin, dtype=float)
+        # Number of edges below the origin, len(np.arange(start, origin, grid_size))
+        offset = (self.origin - start) / grid_size
+        self.n_below = np.maximum(np.ceil(offset), 0)
+        n_above = np.ceil((end + grid_size - self.origin) / grid_size)
+        self.n_bins = (self.n_below + n_above - 1).astype(np.intp)
+        self.shape = (len(self.origin), int(self.n_bins.max(initial=0)) + 1)
+        # Above the origin the bins are shifted from those counted from start
+        # by the fraction of a bin between the origin and the bin edge below it
+        self.shift = self.n_below - offset
+        self.first = np.where(self.n_below > 0, start, self.origin)
+        self.last = self.origin + (n_above - 1) * grid_size
+
+    def __getitem__(self, key):
+        rows, index = key
+        # Past the last edge of a trial, its last edge is repeated as in pad_edges
+        index = np.minimum(index, self.n_bins[rows])
+        # Position of the edges in bins from start, shifted above the origin
+        position = index - (index >= self.n_below[rows]) * self.shift[rows]
+        position *= self.grid_size
+        position += self.start
+        return position
+
+    def get_bin_index(self, data, trial_index, chunk_size=65536):
+        """
+        Find the bin of each point in the edges of its trial, following the
+        conventions of np.histogram like binning.get_bin_index. Points outside
+        of the edges of their trial get an index of -1.
+
+        The points are processed in chunks of whole trials of about chunk_size
+        points, so that the temporaries stay in cache.
+        """
+        n_trials = len(self.origin)
+        bounds = get_trial_bounds(trial_index, n_trials)
+        index = np.empty(len(data), dtype=np.intp)
+        # Bounds within which every point is inside the edges of its trial
+        inner = (self.first.max(initial=-np.inf), self.last.min(initial=np.inf))
+        step = max(1, chunk_size * n_trials // max(len(data), 1))
+        for first in range(0, n_trials, step):
+            trials = slice(first, first + step)
+            points = slice(bounds[first], bounds[min(first + step, n_trials)])
+            index[points] = self._get_bin_index_chunk(data[points], trials, np.diff(bounds[first:first + step + 1]), inner)
+        return index
+
+    def _get_bin_index_chunk(self, data, trials, sizes, inner):
+        # The values of the trials are repeated over their points, which is
+        # faster than indexing them with the trial of every point
+        position = data - self.start
+        position /= self.grid_size
+        position += (data >= np.repeat(self.origin[trials], sizes)) * np.repeat(self.shift[trials], sizes)
+        index = np.floor(position, out=position).astype(np.intp)
+        if len(data) and not (data.min() >= inner[0] and data.max() < inner[1]):
+            # The last bin of every trial includes its last edge
+            np.minimum(index, np.repeat(self.n_bins[trials], sizes) - 1, out=index)
+            index[~((data >= np.repeat(self.first[trials], sizes)) & (data <= np.repeat(self.last[trials], sizes)))] = -1
+        return index
+
+def create_gridded_data_batch(data, trial_index, n_trials, bins, compact=False, window=None):
+    """
+    Create the histograms of a batch of trials.
+
+    Parameters:
+    - data: Concatenated points of all trials
+    - trial_index: Trial each point belongs to
+    - n_trials: Number of trials in the batch
+    - bins: Bin edges shared by all trials, a list with the edges of each trial,
+      or RandomOriginEdges
+    - compact: Store the counts with the smallest integer type that can hold them
+      (see aggregation_nd.count_cells)
+    - window: Tuple (polygon_start, polygon_end) of scalars or arrays with one
+      value per trial. If given, only the cells of each trial from the one
+      holding polygon_start to the one holding polygon_end are counted, and
+      only the points within them binned (see get_window_batch). Those are all
+      the cells the batched estimators read for that polygon, so the cost no
+      longer grows with the number of cells of the grids.
+
+    Returns:
+    - Counts with shape (n_trials, n_bins) and edges with shape (n_trials, n_bins + 1),
+      the RandomOriginEdges themselves if given without window
+    """
+    edges = get_batch_edges(bins, n_trials)
+    if window is None:
+        index = get_bin_index_batch(data, trial_index, edges)
+    else:
+        first, window_edges = get_window_batch(edges, n_trials, *window)
+        # Indexing with the positions of the points is faster than with the mask
+        near = np.flatnonzero(is_in_window_batch(data, trial_index, window_edges))
+        trial_index = trial_index[near]
+        index = get_bin_index_batch(data[near], trial_index, edges) - first[trial_index]
+        edges = window_edges
+    n_bins = edges.shape[1] - 1
+    flat_index = trial_index * n_bins + index
+    if len(index) and not (0 <= index.min() and index.max() < n_bins):
+        flat_index = flat_index[(index >= 0) & (index < n_bins)]
+    count = count_cells(flat_index, n_trials * n_bins, compact).reshape(n_trials, n_bins)
+    return count, edges
+
+def get_batch_edges(bins, n_trials):
+    """
+    Edges of every trial of a batch with one row per trial, from the bins
+    accepted by create_gridded_data_batch. Shared edges are broadcast to the
+    rows and RandomOriginEdges returned as they are.
+    """
+    if isinstance(bins, RandomOriginEdges):
+        return bins
+    if isinstance(bins, np.ndarray) and bins.ndim == 1:
+        return np.broadcast_to(bins, (n_trials, len(bins)))
+    return pad_edges(bins)
+
+def get_bin_index_batch(data, trial_index, edges):
+    """
+    Find the bin of each point of a batch in the edges of its trial (see
+    get_batch_edges), -1 for the points outside of them.
+    """
+    if isinstance(edges, RandomOriginEdges):
+        return edges.get_bin_index(data, trial_index)
+    # Edges shared by all the trials are broadcast, and searched once as such
+    if edges.strides[0] == 0:
+        return get_bin_index(data, edges[0])
+    return get_bin_index(data, edges, trial_index)
+
+def get_window_batch(edges, n_trials, polygon_start, polygon_end):
+    """
+    Window of cells of every trial of a batch holding the polygon: the cells
+    from the one holding polygon_start to the one holding polygon_end, clipped
+    to the grid, which are the only cells the batched estimators read.
+
+    Returns the first cell of the window of every trial and the edges of the
+    windows with one row per trial. The windows have the width of the widest
+    one, and extend past the grid as zero-width cells like those of pad_edges.
+    """
+    polygon_start = np.broadcast_to(polygon_start, n_trials)
+    polygon_end = np.broadcast_to(polygon_end, n_trials)
+    first = get_cell_batch(edges, polygon_start)
+    last = get_cell_batch(edges, polygon_end)
+    offset = np.arange(np.max(last - first, initial=0) + 2)
+    window_edges = edges[np.arange(n_trials)[:, None], np.minimum(first[:, None] + offset, edges.shape[1] - 1)]
+    return first, window_edges
+
+def is_in_window_batch(data, trial_index, window_edges):
+    """
+    Whether each point of a batch lies within the window of cells of its
+    trial, from the edges of the windows (see get_window_batch).
+    """
+    # As in get_actual_value_batch, the bounds are repeated over the points
+    sizes = np.diff(get_trial_bounds(trial_index, len(window_edges)))
+    return (data >= np.repeat(window_edges[:, 0], sizes)) & (data <= np.repeat(window_edges[:, -1], sizes))
+
+def get_actual_value_batch(data, trial_index, n_trials, start, end):
+    """
+    Calculate the actual value within [start, end] for every trial of a batch.
+
+    start and end can be scalars or arrays with one value per trial.
+    """
+    # The points are grouped by trial, so the bounds of every trial are repeated
+    # over its points, which is faster than indexing them with trial_index
+    bounds = get_trial_bounds(trial_index, n_trials)
+    if np.ndim(start) > 0:
+        start = np.repeat(start, np.diff(bounds))
+    if np.ndim(end) > 0:
+        end = np.repeat(end, np.diff(bounds))
+    inside = (data >= start) & (data <= end)
+    return sum_by_trial(inside, bounds)
+
+def get_trial_bounds(trial_index, n_trials):
+    """
+    Position of the first point of every trial of a batch, and past the last
+    point of the last trial. The points of trial i are [bounds[i], bounds[i + 1]).
+    """
+    return np.searchsorted(trial_index, np.arange(n_trials + 1))
+
+def sum_by_trial(values, bounds):
+    """
+    Sum of the values of the points of every trial, from the bounds of the
+    trials (see get_trial_bounds), with a single np.add.reduceat. Integer and
+    boolean values are summed in 64 bits.
+    """
+    total = np.zeros(len(bounds) - 1, dtype=np.result_type(values, np.int64))
+    nonempty = np.flatnonzero(bounds[1:] > bounds[:-1])
+    if len(nonempty) > 0:
+        # Empty trials add no bound, so every sum stops at the next nonempty trial
+        total[nonempty] = np.add.reduceat(values, bounds[nonempty], dtype=total.dtype)
+    return total
+
+def centroid_allocation_estimate_batch(count, edges, polygon_start, polygon_end):
+    """
+    Estimate the value of every trial of a batch using centroid allocation.
+
+    As in centroid_allocation_estimate, the cells with their center in the
+    polygon form a run, found from the cells holding the polygon bounds, and
+    only the counts of the runs are read.
+    """
+    edges = _broadcast_edges(count, edges)
+    polygon_start = np.broadcast_to(polygon_start, len(count))
+    polygon_end = np.broadcast_to(polygon_end, len(count))
+    rows = np.arange(len(count))
+    first = get_cell_batch(edges, polygon_start)
+    first += (edges[rows, first] + edges[rows, first + 1]) / 2 < polygon_start
+    last = get_cell_batch(edges, polygon_end)
+    last += (edges[rows, last] + edges[rows, last + 1]) / 2 <= polygon_end
+    return _range_sum_batch(count, first, last)
+
+def proportional_allocation_estimate_batch(count, edges, polygon_start, polygon_end):
+    """
+    Estimate the value of every trial of a batch using proportional allocation.
+
+    Same rule as proportional_allocation_estimate: the cells strictly between
+    the cells holding the polygon bounds are summed, and the fraction within
+    the polygon is computed for those two cells alone.
+    """
+    edges = _broadcast_edges(count, edges)
+    polygon_start = np.broadcast_to(polygon_start, len(count))
+    polygon_end = np.broadcast_to(polygon_end, len(count))
+    rows = np.arange(len(count))
+    first = get_cell_batch(edges, polygon_start)
+    last = get_cell_batch(edges, polygon_end)
+    estimate = _range_sum_batch(count, first + 1, last)
+    for cell, included in [(first, last >= first), (last, last > first)]:
+        begin = edges[rows, cell]
+        end = edges[rows, cell + 1]
+        overlap = np.maximum(np.minimum(end, polygon_end) - np.maximum(begin, polygon_start), 0)
+        # Cells without width hold no count
+        estimate += np.divide(overlap, end - begin, out=np.zeros(len(rows)), where=included & (end > begin)) * count[rows, cell]
+    return estimate
+
+def _broadcast_edges(count, edges):
+    """
+    Edges of every trial of count, from shared or per-trial edges.
+    """
+    if isinstance(edges, RandomOriginEdges):
+        return edges
+    return np.broadcast_to(np.atleast_2d(edges), (count.shape[0], np.shape(edges)[-1]))
+
+def get_cell_batch(edges, x):
+    """
+    Index of the cell of each trial holding x, clipped to the cells of its
+    grid, for one row of edges per trial (shared edges broadcast to rows) or
+    RandomOriginEdges.
+    """
+    if isinstance(edges, RandomOriginEdges):
+        x = np.clip(x, edges.first, edges.last)
+    else:
+        x = np.clip(x, edges[:, 0], edges[:, -1])
+    return get_bin_index_batch(x, np.arange(len(x)), edges)
+
+def _range_sum_batch(count, first, last):
+    """
+    Sum of the cells [first, last) of each trial, with a single np.add.reduceat
+    over the flattened counts. Compact counts are accumulated in 64 bits.
+    """
+    total = np.zeros(len(count))
+    nonempty = np.flatnonzero(last > first)
+    if len(nonempty) == 0:
+        return total
+    flat = count.reshape(-1)
+    offset = nonempty * count.shape[1]
+    bounds = np.stack((offset + first[nonempty], offset + last[nonempty]), axis=1).ravel()
+    # np.add.reduceat sums up to the next bound, and up to the end after the
+    # last one, which is the only bound that can be past the end
+    if bounds[-1] == len(flat):
+        bounds = bounds[:-1]
+    total[nonempty] = np.add.reduceat(flat, bounds, dtype=np.result_type(count, np.int64))[0::2]
+    return total
@@ -1,5 +1,26 @@
 # Create Sample Data
 import numpy as np
+from src.aggregation_1d import (
+    RandomOriginEdges,
+    get_batch_edges,
+    get_bin_index_batch,
+    get_cell_batch,
+    get_trial_bounds,
+    get_window_batch,
+    is_in_window_batch,
+    sum_by_trial,
+)
+from src.binning import get_bin_index
+from src.aggregation_nd import (
+    SparseCount,
+    centroid_allocation_estimate_nd,
+    get_fraction_of_polygon_in_cell,
+    count_cells,
+    get_tiles,
+    histogram_nd,
+    is_numpy_histogram_faster,
+    proportional_allocation_estimate_nd,
+)
 
 # Create gridded data using histogram
 # def create_gridded_data(data, grid_size, start=0, end=1):
@@ -34,16 +55,49 @@ def create_random_origin_bins_2d(start, end, grid_size, range_of_variation=0):
 
     return bins
 
-def create_gridded_data_2d(data, grid_size, x_range=(0,1), y_range=(0,1), range_of_variation=0):
+def create_random_origin_bins_2d_batch(n_trials, start, end, grid_size, range_of_variation=0):
+    """
+    Create the bins of a batch of trials along one axis as
+    create_random_origin_bins_2d does, drawing the origins of all the trials
+    at once (see aggregation_1d.RandomOriginEdges).
+
+    Only the bins from a negative start depend on the origin, the others are
+    shared by all the trials.
+    """
+    if start < 0 and range_of_variation > 0:
+        return RandomOriginEdges(grid_size, start, end, np.random.uniform(0, range_of_variation, n_trials))
+    return create_random_origin_bins_2d(start, end, grid_size)
+
+def create_gridded_data_2d(data, grid_size, x_range=(0,1), y_range=(0,1), range_of_variation=0, compact=False, sparse=False):
     """
     Create gridded data using histogram.
     """
     binx = create_random_origin_bins_2d(x_range[0], x_range[1], grid_size, range_of_variation)
     biny = create_random_origin_bins_2d(y_range[0], y_range[1], grid_size, range_of_variation)
 
-    hist, xedges, yedges = np.histogram2d(data[:,0], data[:,1], bins=[binx, biny], range=[x_range, y_range])
+    hist, xedges, yedges = histogram_2d(data[:,0], data[:,1], binx, biny, compact, sparse)
     return hist, xedges, yedges
 
+def histogram_2d(x, y, edges_x, edges_y, compact=False, sparse=False):
+    """
+    Same as np.histogram2d(x, y, bins=[edges_x, edges_y]), including float counts.
+
+    The counting is done by np.histogram2d on coarse grids, on which it is
+    faster (see aggregation_nd.is_numpy_histogram_faster), and by
+    aggregation_nd.histogram_nd otherwise. With compact the counts
+    are instead integers of the smallest type that can hold them (usually 2
+    bytes per cell rather than 8, see aggregation_nd.count_cells), which the
+    estimators accept like float counts. With sparse they are an
+    aggregation_nd.SparseCount of the occupied cells, which the centroid and
+    proportional estimators evaluate in time proportional to their number.
+    """
+    if not (compact or sparse) and is_numpy_histogram_faster(len(x), [edges_x, edges_y]):
+        return np.histogram2d(x, y, bins=[edges_x, edges_y])
+    hist, (edges_x, edges_y) = histogram_nd((x, y), [edges_x, edges_y], compact, sparse)
+    if compact or sparse:
+        return hist, edges_x, edges_y
+    return hist.astype(float), edges_x, edges_y
+
 # Create the actual value that falls within the range
 def get_actual_value_2d(data, x_range, y_range):
     """
@@ -52,61 +106,535 @@ def get_actual_value_2d(data, x_range, y_range):
     return len(data[(data[:,0] >= x_range[0]) & (data[:,0] <= x_range[1]) & (data[:,1] >= y_range[0]) & (data[:,1] <= y_range[1])])
 
 # Estimate the value using centroid allocation
-def centroid_allocation_estimate_2d(count, edges_x, edges_y, polygon_x, polygon_y):
+def centroid_allocation_estimate_2d(count, edges_x, edges_y, polygon_x, polygon_y, tile_cells=None):
     """
     Estimate the value using centroid allocation.
+
+    count can be a np.memmap larger than memory: it is read in tiles of at most
+    tile_cells cells (aggregation_nd.ALLOCATION_CHUNK_CELLS by default), and
+    only the tiles of the cells within the polygon are read. It can also be a
+    SparseCount (see histogram_2d), of which only the occupied cells are read.
     """
-    centersx = (edges_x[:-1] + edges_x[1:]) / 2
-    centersy = (edges_y[:-1] + edges_y[1:]) / 2
-    
-    centersx_included = (centersx >= polygon_x[0]) & (centersx <= polygon_x[1])
-    centersy_included = (centersy >= polygon_y[0]) & (centersy <= polygon_y[1])
-    
-    return np.sum(count[np.ix_(centersx_included, centersy_included)])
+    return centroid_allocation_estimate_nd(count, [edges_x, edges_y], [polygon_x, polygon_y], tile_cells)
 
-def get_fraction_of_polygon_in_cell(width, centers, polygon):
+# Estimate the value using proportional allocation
+def proportional_allocation_estimate_2d(count, edges_x, edges_y, polygon_x, polygon_y, tile_cells=None):
     """
-    Get the fraction of the polygon that lies within the cell.
+    Estimate the value using proportional allocation.
+
+    Each cell contributes its count times the fraction of its area that lies
+    within the polygon, using the actual width and height of every cell. count
+    can be a np.memmap, read in tiles, or a SparseCount, as in
+    centroid_allocation_estimate_2d.
     """
-    start = centers - width/2
-    end = centers + width/2
+    return proportional_allocation_estimate_nd(count, [edges_x, edges_y], [polygon_x, polygon_y], tile_cells)
 
-    polygon_start = polygon[0]
-    polygon_end = polygon[1]
-    
-    fraction = np.zeros_like(centers)
+# Estimate the value using proportional allocation for any simple polygon
+def proportional_allocation_estimate_polygon_2d(count, edges_x, edges_y, vertices, tile_cells=None):
+    """
+    Estimate the value using proportional allocation for an arbitrary simple polygon.
 
-    outside_polygon = (start >= polygon_end) | (end <= polygon_start)
-    inside_polygon = (start >= polygon_start) & (end <= polygon_end)
-    partially_inside_polygon = np.logical_not(outside_polygon) & np.logical_not(inside_polygon)
+    Each cell contributes its count times the exact fraction of its area that
+    lies within the polygon. Only the cells within the bounding box of the
+    polygon are read: the cells crossed by its edges are clipped, and the
+    interior cells count as whole (see get_polygon_cell_contributions).
 
-    fraction[inside_polygon] = 1.0
-    starting_difference = end[partially_inside_polygon] - polygon_start
-    ending_difference = polygon_end - start[partially_inside_polygon]
-    valid_start = (starting_difference >= 0) & (starting_difference < width)
-    # valid_end = (ending_difference >= 0) & (ending_difference < width)
+    count can also be a SparseCount (see histogram_2d), for which the cells
+    crossed by the edges and the rest of each column are looked up among the
+    occupied cells with SparseCount.range_sum.
 
-    fraction[partially_inside_polygon] = np.where(valid_start, starting_difference / width, ending_difference / width)
+    Parameters:
+    - vertices: (m, 2) array of the polygon vertices, in either orientation. The
+      first vertex may be repeated at the end.
+    - tile_cells: Number of cells read at once, aggregation_nd.ALLOCATION_CHUNK_CELLS
+      by default, which bounds the memory when count is a np.memmap larger than memory
+    """
+    if not isinstance(count, SparseCount):
+        count = np.asarray(count)
+    vertices = np.asarray(vertices, dtype=float)
+    edges_y = np.asarray(edges_y, dtype=float)
+    polygon, cell_x, cell_y, fraction, column_start = get_polygon_cell_contributions(
+        np.asarray(edges_x, dtype=float), edges_y, [vertices])
+    if len(cell_x) == 0:
+        return 0.0
+    first_x, last_x = cell_x.min(), cell_x.max() + 1
+    first_y, last_y = cell_y.min(), cell_y.max() + 1
+    if np.max(vertices[:,1]) >= edges_y[-1]:
+        # The edges above the grid end no column, so these columns are whole up to its top
+        last_y = count.shape[1]
 
-    return fraction
+    if isinstance(count, SparseCount):
+        # The rest of a column within the box, and a single cell, are both ranges of flat indices
+        flat = cell_x * count.shape[1] + cell_y
+        last = np.where(column_start, cell_x * count.shape[1] + last_y, flat + 1)
+        return float(np.dot(fraction, count.range_sum(np.minimum(flat, last), last)))
 
-# Estimate the value using proportional allocation
-def proportional_allocation_estimate_2d(count, edges_x, edges_y, polygon_x, polygon_y):
+    # Interior cells are whole from their column_start row upwards, which is
+    # the count of the rest of the column within the bounding box, summed over
+    # the tiles of the box
+    block = count[first_x:last_x, first_y:last_y]
+    cell_x = cell_x - first_x
+    cell_y = cell_y - first_y
+    values = np.zeros(len(fraction))
+    for rows, columns in get_tiles(block.shape, tile_cells):
+        tile = np.asarray(block[rows, columns])
+        in_rows = (cell_x >= rows.start) & (cell_x < rows.stop)
+        in_tile = in_rows & (cell_y >= columns.start) & (cell_y < columns.stop)
+        # rest_of_tile[i, j] is the sum of tile[i, j:], which is the whole row of
+        # the tile for the cells below it and 0 for the cells above it
+        rest_of_tile = np.zeros((tile.shape[0], tile.shape[1] + 1), dtype=np.result_type(tile, np.int64))
+        rest_of_tile[:, :-1] = np.cumsum(tile[:, ::-1], axis=1, dtype=rest_of_tile.dtype)[:, ::-1]
+        start = column_start & in_rows
+        values[start] += rest_of_tile[cell_x[start] - rows.start, np.clip(cell_y[start] - columns.start, 0, tile.shape[1])]
+        edge = ~column_start & in_tile
+        values[edge] = tile[cell_x[edge] - rows.start, cell_y[edge] - columns.start]
+    return float(np.dot(fraction, values))
+
+# Estimate both values directly from the points, without the histogram
+def grid_free_estimates_2d(data, edges_x, edges_y, polygon_x, polygon_y):
     """
-    Estimate the value using proportional allocation.
+    Calculate the actual value and the centroid and proportional allocation
+    estimates directly from the points, without creating the 2D histogram.
+
+    Gives the same values as create_gridded_data_2d followed by the estimators
+    with the same edges, in time and memory that depend on the number of points
+    rather than the number of cells. Only the points within a cell of the
+    polygon are binned.
+
+    Returns:
+    - Tuple (actual_value, estimate_centroid, estimate_proportional)
     """
-    grid_width_x = (edges_x[1] - edges_x[0])
-    grid_width_y = (edges_y[1] - edges_y[0])
+    data = np.asarray(data)
+    edges_x = np.asarray(edges_x, dtype=float)
+    edges_y = np.asarray(edges_y, dtype=float)
+    actual_value = get_actual_value_2d(data, polygon_x, polygon_y)
 
-    centersx = (edges_x[:-1] + edges_x[1:]) / 2
-    centersy = (edges_y[:-1] + edges_y[1:]) / 2
-    
-    # Get fraction of each cell that lies within the polygon
-    fraction_x = get_fraction_of_polygon_in_cell(grid_width_x, centersx, polygon_x)
-    fraction_y = get_fraction_of_polygon_in_cell(grid_width_y, centersy, polygon_y)
+    # Points further than a cell from the polygon add to neither estimate
+    reach_x = np.max(np.diff(edges_x))
+    reach_y = np.max(np.diff(edges_y))
+    near = data[
+        (data[:,0] >= polygon_x[0] - reach_x) & (data[:,0] <= polygon_x[1] + reach_x)
+        & (data[:,1] >= polygon_y[0] - reach_y) & (data[:,1] <= polygon_y[1] + reach_y)
+    ]
+    cell_x = get_bin_index(near[:,0], edges_x)
+    cell_y = get_bin_index(near[:,1], edges_y)
+    inside = (cell_x >= 0) & (cell_y >= 0)
+    cell_x = cell_x[inside]
+    cell_y = cell_y[inside]
+
+    width_x = edges_x[cell_x + 1] - edges_x[cell_x]
+    width_y = edges_y[cell_y + 1] - edges_y[cell_y]
+    centers_x = (edges_x[cell_x] + edges_x[cell_x + 1]) / 2
+    centers_y = (edges_y[cell_y] + edges_y[cell_y + 1]) / 2
+    estimate_centroid = np.count_nonzero(
+        (centers_x >= polygon_x[0]) & (centers_x <= polygon_x[1])
+        & (centers_y >= polygon_y[0]) & (centers_y <= polygon_y[1])
+    )
+    fraction_x = get_fraction_of_polygon_in_cell(width_x, centers_x, polygon_x)
+    fraction_y = get_fraction_of_polygon_in_cell(width_y, centers_y, polygon_y)
+    estimate_proportional = np.sum(fraction_x * fraction_y)
+    return actual_value, estimate_centroid, estimate_proportional
+
+class GridIndex2D:
+    """
+    Summed-area table of gridded data for centroid and proportional allocation.
+
+    Built once from the (count, xedges, yedges) returned by create_gridded_data_2d,
+    it answers queries for any axis-aligned rectangle in constant time, whatever
+    the size of the grid. The bounds in polygon_x and polygon_y can be scalars or
+    arrays, in which case one estimate is returned per rectangle. The edges do
+    not need to be uniform. The table covers every cell, so a SparseCount is
+    converted to dense counts.
+    """
+    def __init__(self, count, edges_x, edges_y):
+        self.count = count.to_dense() if isinstance(count, SparseCount) else np.asarray(count)
+        self.edges_x = np.asarray(edges_x, dtype=float)
+        self.edges_y = np.asarray(edges_y, dtype=float)
+        self.centers_x = (self.edges_x[:-1] + self.edges_x[1:]) / 2
+        self.centers_y = (self.edges_y[:-1] + self.edges_y[1:]) / 2
+
+        # summed_area[i, j] is the sum of count[:i, :j]
+        self.summed_area = np.zeros((self.count.shape[0] + 1, self.count.shape[1] + 1), dtype=np.result_type(self.count, np.int64))
+        np.cumsum(np.cumsum(self.count, axis=0, dtype=self.summed_area.dtype), axis=1, out=self.summed_area[1:, 1:])
+
+    def rectangle_sum(self, first_x, last_x, first_y, last_y):
+        """
+        Sum of count[first_x:last_x, first_y:last_y].
+        """
+        summed_area = self.summed_area
+        return summed_area[last_x, last_y] - summed_area[first_x, last_y] - summed_area[last_x, first_y] + summed_area[first_x, first_y]
+
+    def centroid_allocation(self, polygon_x, polygon_y):
+        """
+        Estimate the value using centroid allocation.
+        """
+        # The cells with their center in the polygon form a block of the grid
+        first_x = np.searchsorted(self.centers_x, polygon_x[0], side='left')
+        last_x = np.maximum(np.searchsorted(self.centers_x, polygon_x[1], side='right'), first_x)
+        first_y = np.searchsorted(self.centers_y, polygon_y[0], side='left')
+        last_y = np.maximum(np.searchsorted(self.centers_y, polygon_y[1], side='right'), first_y)
+        return self.rectangle_sum(first_x, last_x, first_y, last_y)[()]
+
+    def proportional_allocation(self, polygon_x, polygon_y):
+        """
+        Estimate the value using proportional allocation.
+        """
+        cumulative_value = self.cumulative_value
+        estimate = (
+            cumulative_value(polygon_x[1], polygon_y[1])
+            - cumulative_value(polygon_x[0], polygon_y[1])
+            - cumulative_value(polygon_x[1], polygon_y[0])
+            + cumulative_value(polygon_x[0], polygon_y[0])
+        )
+        return estimate[()]
+
+    def proportional_allocation_polygon(self, polygons):
+        """
+        Estimate the value using proportional allocation for arbitrary simple polygons.
+
+        polygons is one (m, 2) array of vertices, or a list of them for which the
+        estimates are returned as an array. The cost of each polygon depends on
+        the number of its edges and of the cells they cross, not on its area.
+        """
+        single = isinstance(polygons, np.ndarray) and polygons.ndim == 2
+        polygon_list = [polygons] if single else list(polygons)
+        polygon, cell_x, cell_y, fraction, column_start = get_polygon_cell_contributions(self.edges_x, self.edges_y, polygon_list)
+
+        # Interior cells are whole from their column_start row to the top of the column
+        n_y = self.count.shape[1]
+        rest_of_column = self.rectangle_sum(cell_x, cell_x + 1, cell_y, n_y)
+        values = np.where(column_start, rest_of_column, self.count[cell_x, cell_y])
+        estimate = np.bincount(polygon, weights=fraction * values, minlength=len(polygon_list))
+        return estimate[0] if single else estimate
+
+    def cumulative_value(self, x, y):
+        """
+        Proportionally allocated count of everything below x and y, i.e. the
+        summed-area table interpolated bilinearly within each cell.
+        """
+        cell_x, fraction_x = _get_cell_and_fraction(self.edges_x, x)
+        cell_y, fraction_y = _get_cell_and_fraction(self.edges_y, y)
+        summed_area = self.summed_area
+        base = summed_area[cell_x, cell_y]
+        return (
+            base
+            + fraction_x * (summed_area[cell_x + 1, cell_y] - base)
+            + fraction_y * (summed_area[cell_x, cell_y + 1] - base)
+            + fraction_x * fraction_y * self.count[cell_x, cell_y]
+        )
+
+def _get_cell_and_fraction(edges, x):
+    """
+    Cell containing x (clipped to the grid) and the fraction of that cell below x.
+    """
+    x = np.clip(x, edges[0], edges[-1])
+    cell = np.clip(np.searchsorted(edges, x, side='right') - 1, 0, len(edges) - 2)
+    width = edges[cell + 1] - edges[cell]
+    fraction = np.divide(x - edges[cell], width, out=np.zeros(np.shape(x)), where=width > 0)
+    return cell, fraction
+
+def get_polygon_cell_contributions(edges_x, edges_y, polygons):
+    """
+    Exact fractions of the cells of a grid covered by simple polygons, in sparse form.
+
+    The area of a polygon within a cell [x0, x1] x [y0, y1] is the sum over the
+    polygon edges of the integral of clip(y1 - y, 0, y1 - y0) dx along the edge
+    (by Green's theorem, with the sign of the orientation of the polygon). The
+    edges are split at the grid columns. Each piece of an edge is clipped
+    against the cells of its column that its y range crosses, and covers the
+    whole of every cell above them, which is recorded once as a column start.
+    The fraction of a cell is then the sum of its clipped contributions plus
+    the column starts at or below it, so interior cells are never visited.
+    Shared by the polygon estimators and by
+    areal_reallocation.get_polygon_overlap_weights.
+
+    Returns:
+    - Arrays polygon, cell_x, cell_y, fraction and column_start. A contribution
+      with column_start set covers every cell of column cell_x from cell_y up.
+    """
+    n_x = len(edges_x) - 1
+    n_y = len(edges_y) - 1
+    vertices = [np.asarray(v, dtype=float).reshape(-1, 2) for v in polygons]
+    start = np.concatenate(vertices) if vertices else np.empty((0, 2))
+    end = np.concatenate([np.roll(v, -1, axis=0) for v in vertices]) if vertices else np.empty((0, 2))
+    polygon = np.repeat(np.arange(len(vertices)), [len(v) for v in vertices])
 
-    # Calculate the fraction of the polygon that lies within each grid cell
-    fraction = np.outer(fraction_x, fraction_y)
+    # Sign of each polygon's orientation, from the shoelace formula
+    signed_area = np.bincount(polygon, weights=start[:,0] * end[:,1] - end[:,0] * start[:,1], minlength=len(vertices))
+    orientation = np.sign(signed_area)
 
-    # Sum the counts of the fully within cells
-    return np.sum(fraction * count)
\ No newline at end of file
+    # Vertical edges and the parts of edges outside the grid columns add nothing
+    left = np.maximum(np.minimum(start[:,0], end[:,0]), edges_x[0])
+    right = np.minimum(np.maximum(start[:,0], end[:,0]), edges_x[-1])
+    keep = right > left
+    start, end, polygon, left, right = start[keep], end[keep], polygon[keep], left[keep], right[keep]
+    slope = (end[:,1] - start[:,1]) / (end[:,0] - start[:,0])
+    direction = np.sign(end[:,0] - start[:,0]) * orientation[polygon]
+
+    # Split the edges at the column boundaries
+    first_column = np.clip(np.searchsorted(edges_x, left, side='right') - 1, 0, n_x - 1)
+    last_column = np.clip(np.searchsorted(edges_x, right, side='left') - 1, 0, n_x - 1)
+    n_pieces = last_column - first_column + 1
+    edge = np.repeat(np.arange(len(left)), n_pieces)
+    column = first_column[edge] + np.arange(len(edge)) - np.repeat(np.cumsum(n_pieces) - n_pieces, n_pieces)
+    piece_start = np.maximum(left[edge], edges_x[column])
+    piece_end = np.minimum(right[edge], edges_x[column + 1])
+    keep = piece_end > piece_start
+    edge, column, piece_start, piece_end = edge[keep], column[keep], piece_start[keep], piece_end[keep]
+    y_start = start[edge, 1] + slope[edge] * (piece_start - start[edge, 0])
+    y_end = start[edge, 1] + slope[edge] * (piece_end - start[edge, 0])
+    # Signed width of the piece relative to its column
+    weight = direction[edge] * (piece_end - piece_start) / (edges_x[column + 1] - edges_x[column])
+
+    # Rows crossed by each piece, between -1 (below the grid) and n_y (above it)
+    first_row = np.searchsorted(edges_y, np.minimum(y_start, y_end), side='right') - 1
+    last_row = np.searchsorted(edges_y, np.maximum(y_start, y_end), side='right') - 1
+
+    # Cells above a piece are covered by its whole width
+    above = last_row + 1 < n_y
+    start_pieces = np.flatnonzero(above)
+
+    # Clip each piece against the cells it crosses
+    clipped_first = np.maximum(first_row, 0)
+    n_clipped = np.maximum(np.minimum(last_row, n_y - 1) - clipped_first + 1, 0)
+    piece = np.repeat(np.arange(len(edge)), n_clipped)
+    row = clipped_first[piece] + np.arange(len(piece)) - np.repeat(np.cumsum(n_clipped) - n_clipped, n_clipped)
+    cell_bottom = edges_y[row]
+    cell_top = edges_y[row + 1]
+    piece_slope = slope[edge[piece]]
+    x0 = piece_start[piece]
+    x1 = piece_end[piece]
+    y0 = y_start[piece]
+    # The integrand is linear between the points where the piece crosses the
+    # bottom and the top of the cell, so the midpoint rule is exact there
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossings = np.sort(np.clip(np.stack([
+            x0 + (cell_bottom - y0) / piece_slope,
+            x0 + (cell_top - y0) / piece_slope,
+        ]), x0, x1), axis=0)
+    crossings[:, piece_slope == 0] = x0[piece_slope == 0]
+    bounds = np.stack([x0, crossings[0], crossings[1], x1])
+    middle = (bounds[:-1] + bounds[1:]) / 2
+    height = np.clip((cell_top - (y0 + piece_slope * (middle - x0))) / (cell_top - cell_bottom), 0, 1)
+    covered = np.sum(np.diff(bounds, axis=0) * height, axis=0) / (x1 - x0)
+
+    return (
+        np.concatenate((polygon[edge[piece]], polygon[edge[start_pieces]])),
+        np.concatenate((column[piece], column[start_pieces])),
+        np.concatenate((row, last_row[start_pieces] + 1)),
+        np.concatenate((weight[piece] * covered, weight[start_pieces])),
+        np.concatenate((np.zeros(len(piece), dtype=bool), np.ones(len(start_pieces), dtype=bool))),
+    )
+
+class PointIndex2D:
+    """
+    Merge sort tree of the points of one realization for counting the points
+    in rectangles.
+
+    The points are sorted by x, and every aligned block of 1, 2, 4, ... of them
+    keeps its y coordinates sorted (as ranks among all the y coordinates). A
+    rectangle selects a range of the x-sorted points by binary search, which
+    splits into at most two blocks per level, and the points of each block
+    within the y range are counted by binary search. A query takes O(log^2 n)
+    time and the index holds n log n integers.
+
+    Gives the same value as get_actual_value_2d, with all the bounds included.
+    The bounds in x_range and y_range can be scalars or arrays, in which case
+    one count is returned per rectangle.
+    """
+    def __init__(self, data):
+        data = np.asarray(data, dtype=float).reshape(-1, 2)
+        n = len(data)
+        order = np.argsort(data[:,0], kind='stable')
+        self.x = data[order, 0]
+        y = data[order, 1]
+        y_order = np.argsort(y, kind='stable')
+        self.y = y[y_order]
+
+        # Rank of the y coordinate of each x-sorted point, padded to a power of
+        # two with the rank n, which no query counts
+        size = 1 << max(n - 1, 0).bit_length()
+        rank = np.full(size, n, dtype=np.int64)
+        rank[y_order] = np.arange(n)
+
+        # levels[l] holds block * (n + 1) + rank for the blocks of 2**l points,
+        # sorted, so that the ranks of each block are sorted and found by binary search
+        self.stride = n + 1
+        position = np.arange(size)
+        self.levels = [np.sort((position >> level) * self.stride + rank) for level in range(size.bit_length())]
+
+    def get_actual_value(self, x_range, y_range):
+        """
+        Number of points in [x_range[0], x_range[1]] x [y_range[0], y_range[1]].
+        """
+        first = np.searchsorted(self.x, x_range[0], side='left')
+        last = np.searchsorted(self.x, x_range[1], side='right')
+        low = np.searchsorted(self.y, y_range[0], side='left')
+        high = np.searchsorted(self.y, y_range[1], side='right')
+        first, last, low, high = np.broadcast_arrays(first, last, low, high)
+        high = np.maximum(high, low)
+        first = first.copy()
+        last = last.copy()
+
+        count = np.zeros(first.shape, dtype=np.int64)
+        for keys in self.levels:
+            # Blocks at the ends of the range that are not part of a larger block
+            left = (first < last) & (first % 2 == 1)
+            count += np.where(left, self._block_count(keys, first, low, high), 0)
+            first += left
+            right = (first < last) & (last % 2 == 1)
+            last -= right
+            count += np.where(right, self._block_count(keys, last, low, high), 0)
+            first >>= 1
+            last >>= 1
+        return count[()]
+
+    def _block_count(self, keys, block, low, high):
+        """
+        Number of points of the blocks with a y rank in [low, high).
+        """
+        base = block * self.stride
+        return np.searchsorted(keys, base + high, side='left') - np.searchsorted(keys, base + low, side='left')
+
+# Batched versions of the functions above. A batch of trials is stored as the
+# concatenated points of every trial plus the index of the trial each point
+# belongs to (see aggregation_1d.stack_trials).
+def create_gridded_data_2d_batch(data, trial_index, n_trials, binx, biny, compact=False, window=None):
+    """
+    Create the 2D histograms of a batch of trials.
+
+    Parameters:
+    - data: Concatenated (n, 2) points of all trials
+    - trial_index: Trial each point belongs to
+    - n_trials: Number of trials in the batch
+    - binx, biny: Bin edges shared by all trials, lists with the edges of each
+      trial, or aggregation_1d.RandomOriginEdges
+    - compact: Store the counts with the smallest integer type that can hold them
+      (see aggregation_nd.count_cells)
+    - window: Tuple (polygon_x, polygon_y) of ranges whose bounds are scalars or
+      arrays with one value per trial. If given, only the window of cells of
+      each trial holding the rectangle is counted (see
+      aggregation_1d.get_window_batch) and only the points within it binned, as
+      in aggregation_1d.create_gridded_data_batch.
+
+    Returns:
+    - Counts with shape (n_trials, n_bins_x, n_bins_y) and the x and y edges with one row per trial
+    """
+    edges_x = get_batch_edges(binx, n_trials)
+    edges_y = get_batch_edges(biny, n_trials)
+    if window is None:
+        index_x = get_bin_index_batch(data[:, 0], trial_index, edges_x)
+        index_y = get_bin_index_batch(data[:, 1], trial_index, edges_y)
+    else:
+        first_x, window_edges_x = get_window_batch(edges_x, n_trials, *window[0])
+        first_y, window_edges_y = get_window_batch(edges_y, n_trials, *window[1])
+        near = is_in_window_batch(data[:, 0], trial_index, window_edges_x) & is_in_window_batch(data[:, 1], trial_index, window_edges_y)
+        # Indexing with the positions of the points is faster than with the mask
+        near = np.flatnonzero(near)
+        data = data[near]
+        trial_index = trial_index[near]
+        index_x = get_bin_index_batch(data[:, 0], trial_index, edges_x) - first_x[trial_index]
+        index_y = get_bin_index_batch(data[:, 1], trial_index, edges_y) - first_y[trial_index]
+        edges_x = window_edges_x
+        edges_y = window_edges_y
+    n_bins_x = edges_x.shape[1] - 1
+    n_bins_y = edges_y.shape[1] - 1
+    flat_index = (trial_index * n_bins_x + index_x) * n_bins_y + index_y
+    if len(flat_index) and not (0 <= index_x.min() and index_x.max() < n_bins_x and 0 <= index_y.min() and index_y.max() < n_bins_y):
+        flat_index = flat_index[(index_x >= 0) & (index_x < n_bins_x) & (index_y >= 0) & (index_y < n_bins_y)]
+    count = count_cells(flat_index, n_trials * n_bins_x * n_bins_y, compact)
+    return count.reshape(n_trials, n_bins_x, n_bins_y), edges_x, edges_y
+
+def get_actual_value_2d_batch(data, trial_index, n_trials, x_range, y_range):
+    """
+    Calculate the actual value within the rectangle for every trial of a batch.
+
+    The bounds of x_range and y_range can be scalars or arrays with one value per trial.
+    """
+    # As in aggregation_1d.get_actual_value_batch, the bounds of every trial are
+    # repeated over its points
+    bounds = get_trial_bounds(trial_index, n_trials)
+    x_start, x_end, y_start, y_end = (
+        np.repeat(np.broadcast_to(value, (n_trials,)), np.diff(bounds))
+        for value in (*x_range, *y_range)
+    )
+    inside = (data[:,0] >= x_start) & (data[:,0] <= x_end) & (data[:,1] >= y_start) & (data[:,1] <= y_end)
+    return sum_by_trial(inside, bounds)
+
+def centroid_allocation_estimate_2d_batch(count, edges_x, edges_y, polygon_x, polygon_y):
+    """
+    Estimate the value of every trial of a batch using centroid allocation.
+
+    Only the window of cells holding the polygon in each trial is read (see
+    _get_window_weights).
+    """
+    return _estimate_window_batch(count, edges_x, edges_y, polygon_x, polygon_y, centroid=True)
+
+def proportional_allocation_estimate_2d_batch(count, edges_x, edges_y, polygon_x, polygon_y):
+    """
+    Estimate the value of every trial of a batch using proportional allocation.
+
+    Only the window of cells holding the polygon in each trial is read (see
+    _get_window_weights).
+    """
+    return _estimate_window_batch(count, edges_x, edges_y, polygon_x, polygon_y, centroid=False)
+
+def _estimate_window_batch(count, edges_x, edges_y, polygon_x, polygon_y, centroid):
+    """
+    Contract the window of cells of each trial with the weights of its rows and columns.
+    """
+    cell_x, weight_x = _get_window_weights(edges_x, polygon_x, len(count), centroid)
+    cell_y, weight_y = _get_window_weights(edges_y, polygon_y, len(count), centroid)
+    n_trials, n_bins_x, n_bins_y = count.shape
+    if n_bins_x * n_bins_y <= 4 * cell_x.shape[1] * cell_y.shape[1]:
+        # The grids are little larger than the windows, as those counted with
+        # the window of create_gridded_data_2d_batch, so the weights are spread
+        # over whole rows and columns, which is faster than gathering the windows
+        weight_x = _spread_window_weights(cell_x, weight_x, n_bins_x)
+        weight_y = _spread_window_weights(cell_y, weight_y, n_bins_y)
+        return np.einsum('ti,ti->t', np.einsum('tij,tj->ti', count, weight_y), weight_x)
+    window = count[np.arange(n_trials)[:, None, None], cell_x[:, :, None], cell_y[:, None, :]]
+    # Contract the window with both weights without building the outer product
+    return np.einsum('tij,ti,tj->t', window, weight_x, weight_y)
+
+def _spread_window_weights(cell, weight, n_bins):
+    """
+    Weights of all the n_bins cells of each trial, zero outside of its window.
+    """
+    n_trials = len(cell)
+    flat_cell = (np.arange(n_trials)[:, None] * n_bins + cell).ravel()
+    # Padded cells repeat the last cell of the grid with a zero weight, so the weights are summed
+    return np.bincount(flat_cell, weight.ravel(), minlength=n_trials * n_bins).reshape(n_trials, n_bins)
+
+def _get_window_weights(edges, polygon, n_trials, centroid):
+    """
+    Cells of each trial along one axis that can hold part of the polygon, and
+    their weights: 1 for the cells with their center in the polygon with
+    centroid, else the fraction of the cell within the polygon.
+
+    The cells of a trial form a run starting at the cell holding the start of
+    the polygon. The runs are padded to the longest one with zero weights.
+    """
+    if not isinstance(edges, RandomOriginEdges):
+        edges = np.broadcast_to(np.atleast_2d(edges), (n_trials, np.shape(edges)[-1]))
+    start = np.broadcast_to(polygon[0], n_trials)
+    end = np.broadcast_to(polygon[1], n_trials)
+    rows = np.arange(n_trials)[:, None]
+    first = get_cell_batch(edges, start)
+    last = get_cell_batch(edges, end)
+    if centroid:
+        first += (edges[rows[:, 0], first] + edges[rows[:, 0], first + 1]) / 2 < start
+        last += (edges[rows[:, 0], last] + edges[rows[:, 0], last + 1]) / 2 <= end
+    else:
+        last += 1
+    length = np.maximum(last - first, 0)
+    offset = np.arange(length.max(initial=0))
+    cell = np.minimum(first[:, None] + offset, edges.shape[1] - 2)
+    run = offset < length[:, None]
+    if centroid:
+        return cell, run.astype(float)
+    begin = edges[rows, cell]
+    finish = edges[rows, cell + 1]
+    overlap = np.maximum(np.minimum(finish, end[:, None]) - np.maximum(begin, start[:, None]), 0)
+    # Padded cells have no width and no count
+    return cell, np.divide(overlap, finish - begin, out=np.zeros(cell.shape), where=run & (finish > begin))
@@ -0,0 +1,285 @@
+import itertools
+
+import numpy as np
+from src.binning import get_arithmetic_bin_index
+
+# Default upper bound on the number of cells of the count grid read and
+# converted to float64 at once by the estimators (see get_tiles), which bounds
+# their memory on grids of any size, including np.memmap grids larger than
+# RAM. The estimates are accumulated in float64 whatever the type of the counts.
+ALLOCATION_CHUNK_CELLS = 2**20
+
+# np.histogramdd is faster than the arithmetic binning of histogram_nd on
+# coarse grids, with fewer bins than ARITHMETIC_HISTOGRAM_ND_MIN_BINS along
+# every axis, unless there are so many points that their number times the
+# number of bins reaches ARITHMETIC_HISTOGRAM_ND_MIN_SIZE (see the histogram
+# benchmarks of benchmarks/run_benchmarks.py)
+ARITHMETIC_HISTOGRAM_ND_MIN_BINS = 256
+ARITHMETIC_HISTOGRAM_ND_MIN_SIZE = 2**18
+
+# Integer types of the compact counts, from the smallest
+COMPACT_COUNT_DTYPES = (np.uint16, np.int32, np.int64)
+
+def get_compact_count_dtype(max_count):
+    """
+    Smallest of COMPACT_COUNT_DTYPES that can hold max_count.
+    """
+    for dtype in COMPACT_COUNT_DTYPES:
+        if max_count <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+def count_cells(flat_index, n_cells, compact=False):
+    """
+    Number of occurrences of each cell index in [0, n_cells), like np.bincount.
+
+    With compact the counts have the smallest integer type that holds the
+    largest of them (see get_compact_count_dtype), usually 2 bytes per cell
+    rather than 8. They are counted with np.unique and scattered into the grid,
+    so the int64 counts of the whole grid are never formed either, and the cost
+    depends on the number of points more than on the number of cells.
+    """
+    if not compact:
+        return np.bincount(flat_index, minlength=n_cells)
+    cells, cell_count = np.unique(flat_index, return_counts=True)
+    count = np.zeros(n_cells, dtype=get_compact_count_dtype(cell_count.max(initial=0)))
+    count[cells] = cell_count
+    return count
+
+class SparseCount:
+    """
+    Counts of a grid of any dimension holding only its occupied cells.
+
+    cells holds the sorted flat (C order) indices of the occupied cells and
+    count their counts, so the memory and the cost of the estimators depend on
+    the number of occupied cells rather than on the size of the grid. Produced
+    by histogram_nd with sparse (and create_gridded_data_2d), and accepted in
+    place of the dense counts by centroid_allocation_estimate_nd and
+    proportional_allocation_estimate_nd, and so by the 2D estimators, and by
+    aggregation_2d.proportional_allocation_estimate_polygon_2d (see range_sum).
+    """
+    def __init__(self, shape, cells, count):
+        self.shape = tuple(int(n) for n in shape)
+        self.cells = np.asarray(cells, dtype=np.intp)
+        self.count = np.asarray(count)
+        # Index of the occupied cells along each axis
+        self.index = np.unravel_index(self.cells, self.shape)
+
+    @classmethod
+    def from_dense(cls, count):
+        """
+        Sparse form of a dense count array.
+        """
+        count = np.asarray(count)
+        cells = np.flatnonzero(count)
+        return cls(count.shape, cells, count.ravel()[cells])
+
+    def to_dense(self):
+        """
+        Dense count array, with the type of count.
+        """
+        dense = np.zeros(int(np.prod(self.shape)), dtype=self.count.dtype)
+        dense[self.cells] = self.count
+        return dense.reshape(self.shape)
+
+    def contract(self, blocks, weights):
+        """
+        Sum of the counts of the cells within blocks weighted by the outer
+        product of the per-axis weights, see _contract.
+        """
+        weight = np.ones(len(self.cells))
+        for axis_index, block, axis_weights in zip(self.index, blocks, weights):
+            inside = (axis_index >= block.start) & (axis_index < block.stop)
+            weight[~inside] = 0
+            weight[inside] *= axis_weights[axis_index[inside] - block.start]
+        return float(np.dot(weight, self.count))
+
+    def range_sum(self, first, last):
+        """
+        Sum of the counts of the cells with flat indices in [first, last), for
+        arrays of bounds. The occupied cells are sorted, so every range is
+        found with two binary searches in their cumulative counts.
+        """
+        cumulative = np.concatenate(([0], np.cumsum(self.count, dtype=np.result_type(self.count, np.int64))))
+        return cumulative[np.searchsorted(self.cells, last)] - cumulative[np.searchsorted(self.cells, first)]
+
+def is_numpy_histogram_faster(n_points, edges):
+    """
+    Whether np.histogramdd bins n_points faster than histogram_nd on a grid
+    with the given sequence of edges, see ARITHMETIC_HISTOGRAM_ND_MIN_BINS.
+    """
+    n_bins = max(len(axis_edges) - 1 for axis_edges in edges)
+    return n_bins < ARITHMETIC_HISTOGRAM_ND_MIN_BINS and n_points * n_bins < ARITHMETIC_HISTOGRAM_ND_MIN_SIZE
+
+def histogram_nd(data, edges, compact=False, sparse=False):
+    """
+    Same as np.histogramdd(data, bins=edges), but with integer counts.
+
+    Unless np.histogramdd is faster on the grid (see is_numpy_histogram_faster),
+    the bins are computed arithmetically by binning.get_arithmetic_bin_index
+    and the cells are counted with np.bincount of their flat index. Coarse
+    grids, and edges that are not regular enough for the arithmetic bins to
+    be exact, fall back to np.histogramdd.
+
+    Parameters:
+    - data: (n, d) array of points, or a sequence of the d arrays of their coordinates
+    - edges: Sequence of the d arrays of bin edges, e.g. from create_random_origin_bins_2d
+    - compact: Store the counts with the smallest integer type that holds them (see count_cells)
+    - sparse: Return the counts as a SparseCount of the occupied cells, without
+      forming the dense grid
+
+    Returns:
+    - Counts with one axis per dimension and the list of edges
+    """
+    if isinstance(data, (list, tuple)):
+        coordinates = [np.asarray(axis_data) for axis_data in data]
+    else:
+        data = np.asarray(data)
+        if data.ndim == 1:
+            data = data[:, None]
+        coordinates = [data[:, axis] for axis in range(data.shape[1])]
+    edges = [np.asarray(axis_edges) for axis_edges in edges]
+    index = [None]
+    if not is_numpy_histogram_faster(len(coordinates[0]), edges):
+        index = [get_arithmetic_bin_index(axis_data, axis_edges) for axis_data, axis_edges in zip(coordinates, edges)]
+    if any(axis_index is None for axis_index in index):
+        count, edges = np.histogramdd(coordinates, bins=edges)
+        dtype = get_compact_count_dtype(count.max(initial=0)) if compact else np.int64
+        count = count.astype(dtype)
+        return SparseCount.from_dense(count) if sparse else count, list(edges)
+    shape = tuple(len(axis_edges) - 1 for axis_edges in edges)
+    valid = np.logical_and.reduce([axis_index >= 0 for axis_index in index])
+    flat_index = np.ravel_multi_index([axis_index[valid] for axis_index in index], shape)
+    if sparse:
+        cells, cell_count = np.unique(flat_index, return_counts=True)
+        if compact:
+            cell_count = cell_count.astype(get_compact_count_dtype(cell_count.max(initial=0)))
+        return SparseCount(shape, cells, cell_count), edges
+    return count_cells(flat_index, int(np.prod(shape)), compact).reshape(shape), edges
+
+def get_fraction_of_polygon_in_cell(width, centers, polygon):
+    """
+    Get the fraction of the polygon that lies within the cell.
+
+    width, centers and the polygon bounds are broadcast against each other, so
+    they can hold one row per trial.
+    """
+    start = centers - width/2
+    end = centers + width/2
+
+    polygon_start = polygon[0]
+    polygon_end = polygon[1]
+
+    # Length of the overlap between the cell and the polygon, relative to the cell
+    overlap = np.clip(np.minimum(end, polygon_end) - np.maximum(start, polygon_start), 0, None)
+    return overlap / width
+
+def get_tiles(shape, tile_cells=None):
+    """
+    Split an array of the given shape into tiles of at most tile_cells cells
+    (ALLOCATION_CHUNK_CELLS by default).
+
+    The tiles span whole trailing axes for as long as they fit, so that they are
+    contiguous in a C-ordered array (or np.memmap), and are yielded in order as
+    tuples of slices.
+    """
+    if tile_cells is None:
+        tile_cells = ALLOCATION_CHUNK_CELLS
+    tile_shape = []
+    remaining = max(1, tile_cells)
+    for n in reversed(shape):
+        size = max(1, min(n, remaining))
+        tile_shape.append(size)
+        remaining = remaining // n if size == n else 1
+    tile_shape.reverse()
+    starts = [range(0, n, size) for n, size in zip(shape, tile_shape)]
+    for start in itertools.product(*starts):
+        yield tuple(slice(first, first + size) for first, size in zip(start, tile_shape))
+
+def centroid_allocation_estimate_nd(count, edges, polygon, tile_cells=None):
+    """
+    Estimate the value using centroid allocation on a grid of any dimension.
+
+    A cell counts if its center lies within the bounds of the polygon along
+    every axis, so the cells form a block of the grid and only that block is read.
+
+    Parameters:
+    - count: Counts with one axis per dimension or SparseCount, e.g. from histogram_nd
+    - edges: Sequence of the bin edges along each axis
+    - polygon: Sequence of the (start, end) bounds of the hyper-rectangle along each axis
+    - tile_cells: Number of cells read at once, ALLOCATION_CHUNK_CELLS by default
+    """
+    blocks = []
+    weights = []
+    for axis_edges, (polygon_start, polygon_end) in zip(edges, polygon):
+        axis_edges = np.asarray(axis_edges, dtype=float)
+        centers = (axis_edges[:-1] + axis_edges[1:]) / 2
+        first = np.searchsorted(centers, polygon_start, side='left')
+        last = max(np.searchsorted(centers, polygon_end, side='right'), first)
+        blocks.append(slice(first, last))
+        weights.append(np.ones(last - first))
+    return _contract(count, blocks, weights, tile_cells)
+
+def proportional_allocation_estimate_nd(count, edges, polygon, tile_cells=None):
+    """
+    Estimate the value using proportional allocation on a grid of any dimension.
+
+    The fraction of a cell within a hyper-rectangle is the product of the
+    fractions of its extent within the bounds along each axis. Only the block of
+    cells overlapping the polygon is read, and it is contracted with the
+    per-axis fractions one axis at a time, so the weights of the cells are never
+    formed. The edges do not need to be uniform.
+
+    count can be a np.memmap (e.g. from np.load(path, mmap_mode='r')) of a grid
+    larger than memory, of which only the tiles of the block are read.
+
+    Parameters:
+    - count: Counts with one axis per dimension or SparseCount, e.g. from histogram_nd
+    - edges: Sequence of the bin edges along each axis
+    - polygon: Sequence of the (start, end) bounds of the hyper-rectangle along each axis
+    - tile_cells: Number of cells read at once, ALLOCATION_CHUNK_CELLS by default
+    """
+    blocks = []
+    weights = []
+    for axis_edges, (polygon_start, polygon_end) in zip(edges, polygon):
+        axis_edges = np.asarray(axis_edges, dtype=float)
+        # Cells that start before the end of the polygon and end after its start
+        first = max(np.searchsorted(axis_edges, polygon_start, side='right') - 1, 0)
+        last = max(min(np.searchsorted(axis_edges, polygon_end, side='left'), len(axis_edges) - 1), first)
+        width = np.diff(axis_edges[first:last + 1])
+        centers = (axis_edges[first:last] + axis_edges[first + 1:last + 1]) / 2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fraction = get_fraction_of_polygon_in_cell(width, centers, (polygon_start, polygon_end))
+        # Cells without width hold no count
+        blocks.append(slice(first, last))
+        weights.append(np.where(width > 0, fraction, 0))
+    return _contract(count, blocks, weights, tile_cells)
+
+def _contract(count, blocks, weights, tile_cells=None):
+    """
+    Sum of count[blocks] weighted by the outer product of the per-axis weights.
+
+    The block is read one tile at a time (see get_tiles), and each tile is
+    converted to float64 and contracted with the weights of the last axis
+    first, so the extra memory does not depend on the size of the grid and
+    only the block is read from a memory-mapped count. A block that fits in
+    one tile is contracted directly. A SparseCount is contracted over its
+    occupied cells instead.
+    """
+    if isinstance(count, SparseCount):
+        return count.contract(blocks, weights)
+    block = count[tuple(blocks)]
+    if block.size == 0:
+        return 0.0
+    if block.size <= (ALLOCATION_CHUNK_CELLS if tile_cells is None else tile_cells):
+        part = np.asarray(block, dtype=float)
+        for axis_weights in reversed(weights):
+            part = part @ axis_weights
+        return float(part)
+    estimate = 0.0
+    for tile in get_tiles(block.shape, tile_cells):
+        part = np.asarray(block[tile], dtype=float)
+        for axis_weights, axis_tile in zip(reversed(weights), reversed(tile)):
+            part = part @ axis_weights[axis_tile]
+        estimate += part
+    return float(estimate)
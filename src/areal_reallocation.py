@@ -0,0 +1,242 @@
+import hashlib
+import os
+import numpy as np
+import scipy.sparse
+from src.aggregation_2d import get_polygon_cell_contributions
+from src.caching import LRUCache, write_atomically
+
+# Number and total size of the reallocations kept in memory by the get_*_reallocation functions
+MAX_CACHED_REALLOCATIONS = 32
+MAX_CACHED_REALLOCATION_BYTES = 256 * 2**20
+
+class ArealReallocation:
+    """
+    Sparse overlap weights moving counts from a source grid onto target cells
+    with the proportional allocation rule: every target cell gets the count of
+    each source cell times the fraction of the source cell within it, as in
+    the proportional allocation estimators of aggregation_1d and aggregation_2d.
+
+    Between two rectilinear grids the weights are separable, and kept as one
+    (n_target, n_source) matrix per axis (see get_overlap_weights), which are
+    applied one axis at a time. Onto polygons (zones) they are a single
+    (n_zones, n_source_cells) matrix over the flattened source cells. Either
+    way the weights are computed once and applied to any number of layers.
+    """
+    def __init__(self, source_shape, axis_weights=None, weights=None):
+        self.source_shape = tuple(source_shape)
+        self.axis_weights = None if axis_weights is None else [scipy.sparse.csr_matrix(w) for w in axis_weights]
+        self.weights = None if weights is None else scipy.sparse.csr_matrix(weights)
+        if self.axis_weights is not None:
+            self.target_shape = tuple(w.shape[0] for w in self.axis_weights)
+        else:
+            self.target_shape = (self.weights.shape[0],)
+
+    @classmethod
+    def from_grids(cls, source_edges, target_edges):
+        """
+        Reallocation between two rectilinear grids, given by the sequences of
+        their edges along each axis.
+        """
+        axis_weights = [get_overlap_weights(source, target) for source, target in zip(source_edges, target_edges)]
+        return cls([w.shape[1] for w in axis_weights], axis_weights=axis_weights)
+
+    @classmethod
+    def from_polygons(cls, edges_x, edges_y, polygons):
+        """
+        Reallocation from a 2D grid onto simple polygons, given as (m, 2) arrays
+        of vertices. Uses the exact cell fractions of
+        aggregation_2d.proportional_allocation_estimate_polygon_2d.
+        """
+        edges_x = np.asarray(edges_x, dtype=float)
+        edges_y = np.asarray(edges_y, dtype=float)
+        source_shape = (len(edges_x) - 1, len(edges_y) - 1)
+        weights = get_polygon_overlap_weights(edges_x, edges_y, polygons)
+        return cls(source_shape, weights=weights)
+
+    @property
+    def matrix(self):
+        """
+        Weights as one sparse matrix over the flattened source and target cells.
+        """
+        if self.weights is not None:
+            return self.weights
+        matrix = scipy.sparse.csr_matrix(np.ones((1, 1)))
+        for w in self.axis_weights:
+            matrix = scipy.sparse.kron(matrix, w, format='csr')
+        return matrix
+
+    @property
+    def nbytes(self):
+        """
+        Memory taken by the sparse weights.
+        """
+        matrices = self.axis_weights if self.weights is None else [self.weights]
+        return sum(w.data.nbytes + w.indices.nbytes + w.indptr.nbytes for w in matrices)
+
+    def apply(self, count):
+        """
+        Reallocate count, of shape source_shape or (..., *source_shape) for
+        several layers, onto the target cells.
+
+        Returns:
+        - Float counts of shape target_shape, or (..., *target_shape)
+        """
+        count = np.asarray(count)
+        layers = count.shape[:count.ndim - len(self.source_shape)]
+        if count.shape[len(layers):] != self.source_shape:
+            raise ValueError(f"Expected counts of shape (..., {self.source_shape}), got {count.shape}")
+        if self.weights is not None:
+            flat = count.reshape(-1, self.weights.shape[1])
+            return (self.weights @ flat.T).T.reshape(layers + self.target_shape)
+        result = count
+        for axis, w in enumerate(self.axis_weights):
+            result = _apply_along_axis(w, result, len(layers) + axis)
+        return result
+
+    def save(self, path):
+        """
+        Save the weights in .npz format to path, read back with load. Unlike
+        np.savez, no .npz suffix is appended to path.
+        """
+        matrices = self.axis_weights if self.weights is None else [self.weights]
+        arrays = {'source_shape': np.array(self.source_shape), 'separable': np.array(self.weights is None)}
+        for i, w in enumerate(matrices):
+            arrays.update({f'data_{i}': w.data, f'indices_{i}': w.indices, f'indptr_{i}': w.indptr, f'shape_{i}': np.array(w.shape)})
+        with open(path, 'wb') as file:
+            np.savez(file, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read weights saved with save.
+        """
+        with np.load(path) as arrays:
+            matrices = []
+            while f'data_{len(matrices)}' in arrays:
+                i = len(matrices)
+                matrices.append(scipy.sparse.csr_matrix(
+                    (arrays[f'data_{i}'], arrays[f'indices_{i}'], arrays[f'indptr_{i}']), shape=tuple(arrays[f'shape_{i}'])))
+            source_shape = tuple(arrays['source_shape'])
+            if arrays['separable']:
+                return cls(source_shape, axis_weights=matrices)
+            return cls(source_shape, weights=matrices[0])
+
+def _apply_along_axis(weights, array, axis):
+    """
+    Contract one axis of array with a sparse (n_target, n_source) matrix.
+    """
+    array = np.moveaxis(array, axis, 0)
+    result = weights @ array.reshape(array.shape[0], -1)
+    return np.moveaxis(result.reshape((weights.shape[0],) + array.shape[1:]), 0, axis)
+
+def get_overlap_weights(source_edges, target_edges):
+    """
+    Sparse (n_target, n_source) matrix of the fraction of each source cell
+    within each target cell, along one axis.
+
+    The union of both sets of edges splits their common range into pieces that
+    each lie in one source cell and one target cell, so the matrix has fewer
+    nonzeros than the two grids have cells together. Neither grid needs to be
+    uniform, and cells without width get no weight.
+    """
+    source_edges = np.asarray(source_edges, dtype=float)
+    target_edges = np.asarray(target_edges, dtype=float)
+    breaks = np.union1d(source_edges, target_edges)
+    breaks = breaks[(breaks >= max(source_edges[0], target_edges[0])) & (breaks <= min(source_edges[-1], target_edges[-1]))]
+    middle = (breaks[:-1] + breaks[1:]) / 2
+    source = np.searchsorted(source_edges, middle, side='right') - 1
+    target = np.searchsorted(target_edges, middle, side='right') - 1
+    weight = np.diff(breaks) / (source_edges[source + 1] - source_edges[source])
+    return scipy.sparse.csr_matrix((weight, (target, source)), shape=(len(target_edges) - 1, len(source_edges) - 1))
+
+def get_polygon_overlap_weights(edges_x, edges_y, polygons, atol=1e-12):
+    """
+    Sparse (n_polygons, n_cells) matrix of the fraction of each cell of a 2D
+    grid within each polygon, with the cells flattened in C order.
+
+    The column starts of get_polygon_cell_contributions are expanded into the
+    runs of whole cells between consecutive starts of the same column, where
+    their running sum is the covered fraction. Fractions within atol of 0 are
+    dropped.
+    """
+    n_y = len(edges_y) - 1
+    polygon, cell_x, cell_y, fraction, column_start = get_polygon_cell_contributions(edges_x, edges_y, list(polygons))
+
+    # Sort the column starts by polygon, column and row
+    order = np.lexsort((cell_y[column_start], cell_x[column_start], polygon[column_start]))
+    start_polygon = polygon[column_start][order]
+    start_x = cell_x[column_start][order]
+    start_y = cell_y[column_start][order]
+    start_fraction = fraction[column_start][order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (start_polygon[1:] != start_polygon[:-1]) | (start_x[1:] != start_x[:-1])
+    last = np.roll(first, -1)
+    # Running sum within each column, and the row where the next start takes over
+    running = np.cumsum(start_fraction)
+    group_lengths = np.diff(np.append(np.flatnonzero(first), len(order)))
+    running -= np.repeat(running[first] - start_fraction[first], group_lengths)
+    run_end = np.where(last, n_y, np.roll(start_y, -1))
+    keep = (np.abs(running) > atol) & (run_end > start_y)
+    run_length = (run_end - start_y)[keep]
+    run = np.repeat(np.flatnonzero(keep), run_length)
+    run_y = start_y[run] + np.arange(len(run)) - np.repeat(np.cumsum(run_length) - run_length, run_length)
+
+    edge = ~column_start
+    weights = scipy.sparse.csr_matrix((
+        np.concatenate((fraction[edge], running[run])),
+        (np.concatenate((polygon[edge], start_polygon[run])),
+         np.concatenate((cell_x[edge] * n_y + cell_y[edge], start_x[run] * n_y + run_y))),
+    ), shape=(len(polygons), (len(edges_x) - 1) * n_y))
+    weights.data[np.abs(weights.data) <= atol] = 0
+    weights.eliminate_zeros()
+    return weights
+
+def make_geometry_key(kind, *arrays):
+    """
+    Hash of the kind of reallocation and of the geometry arrays defining it.
+    The shapes of the arrays are hashed with their values, so the boundaries
+    between them are unambiguous.
+    """
+    digest = hashlib.sha256(kind.encode())
+    for array in arrays:
+        array = np.ascontiguousarray(array, dtype=float)
+        digest.update(str(array.shape).encode())
+        digest.update(array.tobytes())
+    return digest.hexdigest()[:32]
+
+# Reallocations computed by the get_*_reallocation functions
+reallocation_cache = LRUCache(MAX_CACHED_REALLOCATION_BYTES, MAX_CACHED_REALLOCATIONS)
+
+def get_grid_reallocation(source_edges, target_edges, cache_dir=None):
+    """
+    ArealReallocation.from_grids, cached in memory and, if cache_dir is given,
+    on disk, keyed by the edges of both grids.
+    """
+    key = make_geometry_key(f'grids_{len(source_edges)}', *source_edges, *target_edges)
+    return _get_cached(key, lambda: ArealReallocation.from_grids(source_edges, target_edges), cache_dir)
+
+def get_polygon_reallocation(edges_x, edges_y, polygons, cache_dir=None):
+    """
+    ArealReallocation.from_polygons, cached in memory and, if cache_dir is
+    given, on disk, keyed by the edges of the grid and the polygon vertices.
+    """
+    key = make_geometry_key('polygons', edges_x, edges_y, *polygons)
+    return _get_cached(key, lambda: ArealReallocation.from_polygons(edges_x, edges_y, polygons), cache_dir)
+
+def _get_cached(key, compute, cache_dir):
+    """
+    Reallocation stored under key in reallocation_cache or in cache_dir,
+    computing and storing it on a miss.
+    """
+    if cache_dir is None:
+        return reallocation_cache.get(key, compute)
+    filename = os.path.join(cache_dir, key + '.npz')
+
+    def load_or_compute():
+        if os.path.exists(filename):
+            return ArealReallocation.load(filename)
+        reallocation = compute()
+        os.makedirs(cache_dir, exist_ok=True)
+        write_atomically(filename, reallocation.save)
+        return reallocation
+    return reallocation_cache.get(key, load_or_compute)
@@ -0,0 +1,165 @@
+import numpy as np
+
+def is_regular_edges(edges, rtol=1e-6):
+    """
+    Whether the bins all have the width of the last bin, apart from at most one
+    narrower bin (the odd bin left where the grid meets its origin).
+    """
+    edges = np.asarray(edges)
+    if edges.ndim != 1 or len(edges) < 2 or not np.issubdtype(edges.dtype, np.number):
+        return False
+    widths = np.diff(edges)
+    width = widths[-1]
+    if not width > 0:
+        return False
+    irregular = np.abs(widths - width) > rtol * width
+    return np.count_nonzero(irregular) <= 1 and bool(np.all((widths[irregular] > 0) & (widths[irregular] < width)))
+
+def get_bin_index(data, edges, trial_index=None, chunk_size=65536):
+    """
+    Find the bin of each point, following the conventions of np.histogram.
+
+    Bins are half open except the last one, which also includes the last edge.
+    Points outside of the edges get an index of -1.
+
+    edges is either a 1D array shared by all the points, or one row of padded
+    edges per trial (see aggregation_1d.pad_edges) with trial_index giving the row of each point.
+    The points are processed in chunks so that the temporaries stay in cache.
+    """
+    if np.ndim(edges) == 1 and is_regular_edges(edges):
+        return _get_regular_bin_index(data, edges, chunk_size)
+    edges = np.atleast_2d(edges)
+    if trial_index is None:
+        trial_index = np.zeros(len(data), dtype=np.intp)
+    # Positions of the first and last real bins of each row in the flat edges
+    bottom = np.arange(len(edges)) * edges.shape[1]
+    top = bottom + np.maximum(_get_n_bins(edges) - 1, 0)
+    flat_edges = edges.ravel()
+    last_width = flat_edges[top + 1] - flat_edges[top]
+    bounds = (edges[:, 0], edges[:, -1], 1 / np.where(last_width > 0, last_width, 1), bottom, top)
+
+    index = np.empty(len(data), dtype=np.intp)
+    for chunk in range(0, len(data), chunk_size):
+        points = slice(chunk, chunk + chunk_size)
+        index[points] = _get_bin_index_chunk(data[points], flat_edges, trial_index[points] if len(edges) > 1 else 0, *bounds)
+    return index
+
+def _get_n_bins(edges):
+    """
+    Number of real bins of each row of padded edges (see aggregation_1d.pad_edges).
+
+    Padding repeats the last edge, so the real bins are those before its first
+    occurrence, which is found by a binary search of all the rows at once
+    rather than by comparing every edge with it.
+    """
+    rows = np.arange(len(edges))
+    last = edges[:, -1]
+    # edges[rows, below] < last <= edges[rows, above], with below = -1 standing for -inf
+    below = np.full(len(edges), -1)
+    above = np.full(len(edges), edges.shape[1] - 1)
+    while np.any(above - below > 1):
+        # Rounding up leaves the rows already found unchanged
+        middle = (below + above + 1) // 2
+        less = edges[rows, middle] < last
+        below = np.where(less, middle, below)
+        above = np.where(less, above, middle)
+    return above
+
+def get_arithmetic_bin_index(data, edges):
+    """
+    Bin index of each point as in get_bin_index, for shared increasing edges,
+    or None if the edges are not regular enough for it to be computed
+    arithmetically.
+
+    Instead of checking the widths of all the bins (see is_regular_edges), the
+    bin of every point is checked against the edges, which costs a pass over
+    the points rather than over the edges and is cheaper for fine grids.
+    """
+    edges = np.asarray(edges)
+    if edges.ndim != 1 or len(edges) < 2 or not np.issubdtype(edges.dtype, np.number) or not edges[-1] > edges[-2]:
+        return None
+    return _get_regular_bin_index(np.asarray(data), edges, check=True)
+
+def _get_regular_bin_index(data, edges, chunk_size=65536, check=False):
+    """
+    Bin index of each point for shared regular edges, see get_bin_index.
+
+    The guess counting whole widths back from the last edge is off by at most
+    one bin, so a single round of comparisons with the edges makes it exact.
+    With check, None is returned if a point inside the edges is left outside
+    of its bin, which can only happen for irregular edges.
+    """
+    n_bins = len(edges) - 1
+    first = edges[0]
+    last = edges[-1]
+    scale = 1 / (last - edges[-2])
+    index = np.empty(len(data), dtype=np.intp)
+    for chunk in range(0, len(data), chunk_size):
+        x = data[chunk:chunk + chunk_size]
+        with np.errstate(invalid='ignore'):
+            guess = ((last - x) * scale).astype(np.intp)
+        # The ufuncs and indexing below are much cheaper to call than np.clip
+        # and np.take on the small arrays of a single trial
+        np.subtract(n_bins - 1, guess, out=guess)
+        np.maximum(guess, 0, out=guess)
+        np.minimum(guess, n_bins - 1, out=guess)
+        guess -= x < edges[guess]
+        guess += x >= edges[guess + 1]
+        np.minimum(guess, n_bins - 1, out=guess)
+        outside = (x < first) | ~(x <= last)
+        if check:
+            # The corrections can only move a guess to -1 or within the bins
+            wrong = (guess < 0) | (x < edges[guess]) | ((x >= edges[guess + 1]) & (guess < n_bins - 1))
+            if (wrong & ~outside).any():
+                return None
+        guess[outside] = -1
+        index[chunk:chunk + chunk_size] = guess
+    return index
+
+def _get_bin_index_chunk(data, flat_edges, row, first, last, scale, bottom, top):
+    """
+    Bin index of a chunk of points, see get_bin_index. The per-trial bounds are
+    indexed by row, which is 0 for shared edges.
+    """
+    last = last[row]
+    bottom = bottom[row]
+    top = top[row]
+    inside = (data >= first[row]) & (data <= last)
+
+    # Guess the bin counting whole widths back from the last edge. Our bins
+    # are regular apart from at most an odd bin at the origin, so the guess is
+    # off by at most a bin and one round of comparisons makes it exact.
+    with np.errstate(invalid='ignore'):
+        distance = ((last - data) * scale[row]).astype(np.intp)
+    position = top - distance
+    np.maximum(position, bottom, out=position)
+    np.minimum(position, top, out=position)
+    # Points inside never move below the first bin, and the last bin is closed
+    position -= data < flat_edges[position]
+    position += data >= flat_edges[position + 1]
+    np.minimum(position, top, out=position)
+
+    # Fall back to a binary search for the points of other grids that are still unresolved
+    unresolved = np.flatnonzero(inside & ((data < flat_edges[position]) | ((data >= flat_edges[position + 1]) & (position < top))))
+    if len(unresolved):
+        position[unresolved] = _search_rows(
+            flat_edges, data[unresolved], np.broadcast_to(bottom, data.shape)[unresolved], np.broadcast_to(top, data.shape)[unresolved])
+
+    position -= bottom
+    position[~inside] = -1
+    return position
+
+def _search_rows(flat_edges, data, bottom, top):
+    """
+    Position of the last of the edges bottom..top of each point that is not
+    above it, by a binary search of all the points at once.
+    """
+    # flat_edges[below] <= data < flat_edges[above], with above = top + 1 standing for +inf
+    below = bottom.copy()
+    above = top + 1
+    while np.any(above - below > 1):
+        middle = (below + above) // 2
+        lower = flat_edges[middle] <= data
+        below = np.where(lower, middle, below)
+        above = np.where(lower, above, middle)
+    return below
@@ -0,0 +1,93 @@
+from collections import OrderedDict
+import os
+
+class LRUCache:
+    """
+    Bounded least recently used cache of values computed on demand.
+
+    Values are kept until their total size (their nbytes) exceeds max_bytes or
+    their number exceeds max_entries, then the least recently used ones are
+    evicted. hits, misses and evictions count the cache activity. Cached values
+    are shared between callers; subclasses can make them read-only in _freeze.
+    """
+    def __init__(self, max_bytes, max_entries):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+        self._values = OrderedDict()
+
+    def get(self, key, compute):
+        """
+        Return the value stored under key, computing it with compute() on a miss.
+        """
+        if key in self._values:
+            self.hits += 1
+            self._values.move_to_end(key)
+            return self._values[key]
+
+        self.misses += 1
+        value = compute()
+        self._freeze(value)
+        if value.nbytes <= self.max_bytes and self.max_entries > 0:
+            self._values[key] = value
+            self.nbytes += value.nbytes
+            self._evict()
+        return value
+
+    def set_limits(self, max_bytes=None, max_entries=None):
+        """
+        Change the memory and entry limits, evicting values if needed.
+        """
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        if max_entries is not None:
+            self.max_entries = max_entries
+        self._evict()
+
+    def clear(self):
+        """
+        Remove all the values and reset the counters.
+        """
+        self._values.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def info(self):
+        """
+        Dict with the counters, the number of values and their total size.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._values),
+            'nbytes': self.nbytes,
+        }
+
+    def _freeze(self, value):
+        pass
+
+    def _evict(self):
+        while self._values and (self.nbytes > self.max_bytes or len(self._values) > self.max_entries):
+            _, value = self._values.popitem(last=False)
+            self.nbytes -= value.nbytes
+            self.evictions += 1
+
+def write_atomically(filename, write):
+    """
+    Call write(path) with a temporary path next to filename, then move the
+    written file to filename, so that an interrupted write never leaves a
+    partial file under filename.
+    """
+    temporary = filename + '.tmp'
+    try:
+        write(temporary)
+        os.replace(temporary, filename)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
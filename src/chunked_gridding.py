@@ -0,0 +1,150 @@
+import os
+import time
+
+import fastparquet
+import numpy as np
+from src.aggregation_1d import create_bins, create_random_origin_bins
+from src.binning import get_bin_index
+from src.aggregation_2d import create_random_origin_bins_2d
+from src.aggregation_nd import COMPACT_COUNT_DTYPES, get_compact_count_dtype
+
+# Default number of points read from the source and binned at once
+DEFAULT_CHUNK_POINTS = 2**20
+
+def iter_point_chunks(source, chunk_size=DEFAULT_CHUNK_POINTS, columns=None):
+    """
+    Yield the points of source in chunks of at most chunk_size points.
+
+    Parameters:
+    - source: One of
+      - the path of a .npy file, which is memory-mapped so that only the
+        current chunk is read from disk
+      - the path of a Parquet file or dataset directory, read one row group at a
+        time with fastparquet. Row groups are read whole, so their size bounds
+        the memory as well as chunk_size.
+      - an array of points, e.g. a np.memmap
+      - an iterable of arrays of points, e.g. another generator of chunks
+    - chunk_size: Maximum number of points per chunk
+    - columns: Columns of the Parquet file holding the coordinates, or the
+      number of leading columns holding them. Only these columns are read; all
+      of them by default.
+
+    Yields:
+    - Arrays of shape (n,) for 1D points, or (n, d)
+    """
+    if isinstance(source, (str, os.PathLike)):
+        if os.fspath(source).endswith('.npy'):
+            yield from _split(np.load(source, mmap_mode='r'), chunk_size)
+            return
+        parquet = fastparquet.ParquetFile(os.fspath(source))
+        if isinstance(columns, int):
+            columns = parquet.columns[:columns]
+        for row_group in parquet.iter_row_groups(columns=columns):
+            points = row_group.to_numpy(dtype=float)
+            yield from _split(points[:, 0] if points.shape[1] == 1 else points, chunk_size)
+        return
+    if isinstance(source, np.ndarray):
+        yield from _split(source, chunk_size)
+        return
+    for points in source:
+        yield from _split(np.asarray(points), chunk_size)
+
+def _split(points, chunk_size):
+    """
+    Consecutive slices of at most chunk_size points, read into memory one at a time.
+    """
+    for first in range(0, len(points), chunk_size):
+        yield np.asarray(points[first:first + chunk_size], dtype=float)
+
+def histogram_chunks(chunks, edges, compact=False, stats=None):
+    """
+    Histogram of the points of all the chunks, the same as
+    aggregation_nd.histogram_nd of their concatenation.
+
+    Only one chunk is held at a time. The cells of each chunk are counted with
+    np.bincount when the grid has fewer cells than the chunk has points, and
+    with np.unique otherwise, so that a fine grid is not scanned once per chunk.
+
+    Parameters:
+    - chunks: Iterable of arrays of points, (n,) for one axis or (n, d), e.g. from
+      iter_point_chunks. Columns beyond the d axes of the edges are ignored.
+    - edges: Sequence of the d arrays of bin edges
+    - compact: Store the counts with the smallest integer type that can hold them
+      (see aggregation_nd.count_cells). The type is widened as the counts grow.
+    - stats: If a dict is given, it is filled with the number of 'points' and
+      'chunks' read, the wall time in 'seconds' and the throughput in 'points_per_second'
+
+    Returns:
+    - Counts with one axis per dimension
+    """
+    edges = [np.asarray(axis_edges, dtype=float) for axis_edges in edges]
+    shape = tuple(len(axis_edges) - 1 for axis_edges in edges)
+    n_cells = int(np.prod(shape))
+    count = np.zeros(n_cells, dtype=COMPACT_COUNT_DTYPES[0] if compact else np.int64)
+    # Upper bound on the largest count, which decides the type of compact counts
+    max_count = 0
+    n_points = 0
+    n_chunks = 0
+    start = time.perf_counter()
+    for chunk in chunks:
+        chunk = np.asarray(chunk, dtype=float)
+        if chunk.ndim == 1:
+            chunk = chunk[:, None]
+        index = [get_bin_index(chunk[:, axis], axis_edges) for axis, axis_edges in enumerate(edges)]
+        valid = np.logical_and.reduce([axis_index >= 0 for axis_index in index])
+        flat_index = np.ravel_multi_index([axis_index[valid] for axis_index in index], shape)
+        if n_cells <= len(flat_index):
+            cells = slice(None)
+            cell_count = np.bincount(flat_index, minlength=n_cells)
+        else:
+            cells, cell_count = np.unique(flat_index, return_counts=True)
+        max_count += cell_count.max(initial=0)
+        if compact and max_count > np.iinfo(count.dtype).max:
+            count = count.astype(get_compact_count_dtype(max_count))
+        # The bound on the counts makes the cast of the chunk counts safe
+        count[cells] += cell_count.astype(count.dtype)
+        n_points += len(chunk)
+        n_chunks += 1
+    if stats is not None:
+        seconds = time.perf_counter() - start
+        stats.update(points=n_points, chunks=n_chunks, seconds=seconds, points_per_second=n_points / seconds if seconds > 0 else float('inf'))
+    return count.reshape(shape)
+
+def create_gridded_data_chunked(source, grid_size, start=0, end=1, chunk_size=DEFAULT_CHUNK_POINTS, column=None, compact=False, stats=None):
+    """
+    Same as aggregation_1d.create_gridded_data, with the points streamed from
+    source in chunks (see iter_point_chunks and histogram_chunks).
+
+    - column: Column of the points in a Parquet source, the first one by default
+    """
+    bins = create_bins(grid_size, start, end)
+    chunks = iter_point_chunks(source, chunk_size, 1 if column is None else [column])
+    return histogram_chunks(chunks, [bins], compact, stats), bins
+
+def create_gridded_data_random_origin_chunked(source, grid_size, start=0, end=1, range_of_variation=0, chunk_size=DEFAULT_CHUNK_POINTS, column=None, compact=False, stats=None):
+    """
+    Same as aggregation_1d.create_gridded_data_random_origin, with the points
+    streamed from source in chunks (see iter_point_chunks and histogram_chunks).
+    The random origin is drawn as in create_gridded_data_random_origin.
+
+    - column: Column of the points in a Parquet source, the first one by default
+    """
+    bins = create_random_origin_bins(grid_size, start, end, range_of_variation)
+    chunks = iter_point_chunks(source, chunk_size, 1 if column is None else [column])
+    return histogram_chunks(chunks, [bins], compact, stats), bins
+
+def create_gridded_data_2d_chunked(source, grid_size, x_range=(0,1), y_range=(0,1), range_of_variation=0, chunk_size=DEFAULT_CHUNK_POINTS, columns=None, compact=False, stats=None):
+    """
+    Same as aggregation_2d.create_gridded_data_2d, including float counts unless
+    compact, with the (n, 2) points streamed from source in chunks (see
+    iter_point_chunks and histogram_chunks). The random origin is drawn as in
+    create_gridded_data_2d.
+
+    - columns: x and y columns of the points in a Parquet source, the first two by default
+    """
+    binx = create_random_origin_bins_2d(x_range[0], x_range[1], grid_size, range_of_variation)
+    biny = create_random_origin_bins_2d(y_range[0], y_range[1], grid_size, range_of_variation)
+    hist = histogram_chunks(iter_point_chunks(source, chunk_size, 2 if columns is None else columns), [binx, biny], compact, stats)
+    if compact:
+        return hist, binx, biny
+    return hist.astype(float), binx, biny
@@ -0,0 +1,21 @@
+from src.caching import LRUCache
+
+class FactorCache(LRUCache):
+    """
+    Bounded LRU cache of covariance factors.
+
+    A sweep draws many Gaussian fields with the same kernel parameters and
+    discretization, so the factor of their covariance is computed once and
+    reused. Factors are kept until the total size exceeds max_bytes or the
+    number of factors exceeds max_entries, then the least recently used ones
+    are evicted. hits, misses and evictions count the cache activity.
+    """
+    def __init__(self, max_bytes=256 * 2**20, max_entries=64):
+        super().__init__(max_bytes, max_entries)
+
+    def _freeze(self, factor):
+        # Cached factors are shared between callers, so they must not be modified
+        factor.setflags(write=False)
+
+# Cache shared by the Gaussian field samplers of point_processes_1d and point_processes_2d
+covariance_cache = FactorCache()
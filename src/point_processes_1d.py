@@ -1,6 +1,6 @@
 import numpy as np
-from scipy.spatial.distance import cdist
 from scipy.interpolate import CubicSpline
+from src.covariance_cache import covariance_cache
 
 # Homogeneous Poisson Process
 def get_poisson_process_samples(rate,start=0,end=1):
@@ -12,6 +12,17 @@ def get_poisson_process_samples(rate,start=0,end=1):
     s = np.random.poisson(rate*delta)
     return np.random.rand(s) * (end - start) + start
 
+def get_poisson_process_samples_batch(n, rate, start=0, end=1):
+    """
+    Generate n realizations of get_poisson_process_samples at once.
+
+    Returns the concatenated points of the realizations and the realization
+    each point belongs to, like aggregation_1d.stack_trials.
+    """
+    delta = end - start
+    s = np.random.poisson(rate*delta, n)
+    return np.random.uniform(start, end, s.sum()), np.repeat(np.arange(n), s)
+
 # Inhomogeneous Poisson Processes (next two functions)
 def get_neyman_scott_process(lambda_p, lambda_c, sigma, start=0, end=1):
     """
@@ -30,30 +41,21 @@ def get_neyman_scott_process(lambda_p, lambda_c, sigma, start=0, end=1):
     num_parents = max(np.random.poisson(lambda_p * delta),1)  # Ensure at least one parent
     parent_points = np.random.uniform(start, end, num_parents)
 
-    offspring_points = []
-    
-    # 2. For each parent, generate offspring
-    for parent in parent_points:
-        num_offspring = np.random.poisson(lambda_c)
-        displacements = np.random.normal(0, sigma, num_offspring)
-        offspring = parent + displacements
-        offspring_points.append(offspring)
+    # 2. Generate the offspring of all the parents at once
+    num_offspring = np.random.poisson(lambda_c, num_parents)
+    displacements = np.random.normal(0, sigma, num_offspring.sum())
+    offspring_points = np.repeat(parent_points, num_offspring) + displacements
     
     # Combine all points into a single array
-    return np.concatenate((np.concatenate(offspring_points), parent_points))
+    return np.concatenate((offspring_points, parent_points))
 
 def get_log_gaussian_cox_process(dx, mean_log_intensity, variance, length_scale, start=0, end=1):
     # Discretize space
     x = np.arange(start, end, dx)
     n = len(x)
     
-    # Compute covariance matrix (Squared Exponential Kernel)
-    dists = cdist(x[:, None], x[:, None], metric='euclidean')
-    K = variance * np.exp(-0.5 * (dists / length_scale)**2)
-    
-    # Sample from multivariate normal (Gaussian Process)
-    mean_vector = mean_log_intensity * np.ones(n)
-    G = np.random.multivariate_normal(mean_vector, K)
+    # Sample the Gaussian Process (Squared Exponential Kernel)
+    G = mean_log_intensity + sample_gaussian_field(n, dx, variance, length_scale)
     
     # Exponentiate to get positive intensities
     Lambda = np.exp(G)
@@ -77,22 +79,78 @@ def get_log_gaussian_cox_process_direct_sampling(dx, mean_log_intensity, varianc
     x = np.arange(start, end, dx)
     n = len(x)
     
-    # Compute covariance matrix (Squared Exponential Kernel)
-    dists = cdist(x[:, None], x[:, None], metric='euclidean')
-    K = variance * np.exp(-0.5 * (dists / length_scale)**2)
-    
-    # Sample from multivariate normal (Gaussian Process)
-    mean_vector = mean_log_intensity * np.ones(n)
-    G = np.random.multivariate_normal(mean_vector, K)
+    # Sample the Gaussian Process (Squared Exponential Kernel)
+    G = mean_log_intensity + sample_gaussian_field(n, dx, variance, length_scale)
     
     # Exponentiate to get positive intensities
     Lambda = np.exp(G)
     
-    # Now simulate Poisson points
-    points = []
-    for xi, lam in zip(x, Lambda):
-        expected_points = lam * dx
-        num_points = np.random.poisson(expected_points)
-        points.extend(xi + dx * np.random.rand(num_points))
-    
-    return np.array(points)
\ No newline at end of file
+    # Now simulate Poisson points, uniformly within each cell
+    num_points = np.random.poisson(Lambda * dx)
+    return np.repeat(x, num_points) + dx * np.random.rand(np.sum(num_points))
+
+# Stationary Gaussian fields by circulant embedding
+def get_circulant_embedding_eigenvalues(n, dx, variance, length_scale, max_size=2**24):
+    """
+    Eigenvalues of the circulant embedding of the squared exponential covariance
+    of n regularly spaced points.
+
+    The embedding is grown (in powers of two) until it is non-negative definite,
+    up to max_size. Remaining round-off negatives are clipped to zero.
+    """
+    m = 2 ** int(np.ceil(np.log2(max(2 * (n - 1), 1))))
+    while True:
+        lags = np.minimum(np.arange(m), m - np.arange(m)) * dx
+        first_row = variance * np.exp(-0.5 * (lags / length_scale)**2)
+        eigenvalues = np.fft.fft(first_row).real
+        if eigenvalues.min() >= -1e-8 * eigenvalues.max() or m >= max_size:
+            break
+        m *= 2
+    return np.clip(eigenvalues, 0, None)
+
+def get_circulant_embedding_factor(n, dx, variance, length_scale):
+    """
+    Square root of the scaled circulant embedding eigenvalues, the spectral
+    factor of the covariance. Cached in covariance_cache, so the embedding is
+    only computed once per set of kernel parameters and discretization.
+    """
+    key = ('squared_exponential_1d', n, dx, variance, length_scale)
+    def compute():
+        eigenvalues = get_circulant_embedding_eigenvalues(n, dx, variance, length_scale)
+        return np.sqrt(eigenvalues / len(eigenvalues))
+    return covariance_cache.get(key, compute)
+
+def sample_gaussian_field(n, dx, variance, length_scale, size=None):
+    """
+    Sample a zero-mean Gaussian field with a squared exponential covariance at
+    n points spaced by dx, in O(n log n) time and O(n) memory.
+
+    Uses circulant embedding: the covariance is embedded in a circulant matrix,
+    which the FFT diagonalizes. The real and imaginary parts of one complex draw
+    are two independent fields. The factor of the covariance is cached, so each
+    further draw only costs an FFT.
+
+    Parameters:
+    - n: Number of points
+    - dx: Spacing of the points
+    - variance: Variance of the field
+    - length_scale: Length scale of the covariance
+    - size: Number of independent fields to draw, or None for a single field
+
+    Returns:
+    - Array of shape (n,), or (size, n) if size is given
+    """
+    scale = get_circulant_embedding_factor(n, dx, variance, length_scale)
+    m = len(scale)
+    n_draws = 1 if size is None else (size + 1) // 2
+    z = np.random.standard_normal((n_draws, m)) + 1j * np.random.standard_normal((n_draws, m))
+    fields = np.fft.fft(scale * z, axis=-1)[:, :n]
+    if size is None:
+        return fields[0].real
+    return np.concatenate((fields.real, fields.imag))[:size]
+
+# Samplers drawing many realizations of a point process at once, used by the
+# batched simulations in place of one call of the point process per trial
+BATCH_SAMPLERS = {
+    get_poisson_process_samples: get_poisson_process_samples_batch,
+}
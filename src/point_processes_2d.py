@@ -1,5 +1,5 @@
 import numpy as np
-from scipy.spatial.distance import cdist
+from src.covariance_cache import covariance_cache
 
 # Homogeneous Poisson Process
 def get_poisson_process_samples_2d(rate, x_min, x_max, y_min, y_max):
@@ -9,6 +9,26 @@ def get_poisson_process_samples_2d(rate, x_min, x_max, y_min, y_max):
     y_coords = np.random.uniform(y_min, y_max, n_points)
     return np.column_stack((x_coords, y_coords))
 
+def poisson_process_2d(rate, x_range, y_range):
+    """
+    get_poisson_process_samples_2d with the (rate, x_range, y_range) arguments
+    the simulation2d runners pass to their point_process.
+    """
+    return get_poisson_process_samples_2d(rate, x_range[0], x_range[1], y_range[0], y_range[1])
+
+def poisson_process_2d_batch(n, rate, x_range, y_range):
+    """
+    Generate n realizations of poisson_process_2d at once.
+
+    Returns the concatenated points of the realizations and the realization
+    each point belongs to, like aggregation_1d.stack_trials.
+    """
+    area = (x_range[1] - x_range[0]) * (y_range[1] - y_range[0])
+    n_points = np.random.poisson(rate * area, n)
+    x_coords = np.random.uniform(x_range[0], x_range[1], n_points.sum())
+    y_coords = np.random.uniform(y_range[0], y_range[1], n_points.sum())
+    return np.column_stack((x_coords, y_coords)), np.repeat(np.arange(n), n_points)
+
 def get_neyman_scott_process_2d(lambda_p, lambda_c, sigma, x_min, x_max, y_min, y_max):
     """
     Simulate a Neyman-Scott process in 2D.
@@ -27,67 +47,110 @@ def get_neyman_scott_process_2d(lambda_p, lambda_c, sigma, x_min, x_max, y_min,
     parent_x = np.random.uniform(x_min, x_max, num_parents)
     parent_y = np.random.uniform(y_min, y_max, num_parents)
 
-    offspring_x = []
-    offspring_y = []
-    
-    # 2. For each parent, generate offspring
-    for px, py in zip(parent_x, parent_y):
-        num_offspring = np.random.poisson(lambda_c)
-        displacements_x = np.random.normal(0, sigma, num_offspring)
-        displacements_y = np.random.normal(0, sigma, num_offspring)
-        offspring_x.append(px + displacements_x)
-        offspring_y.append(py + displacements_y)
+    # 2. Generate the offspring of all the parents at once
+    num_offspring = np.random.poisson(lambda_c, num_parents)
+    parents = np.repeat(np.column_stack((parent_x, parent_y)), num_offspring, axis=0)
+    displacements = np.random.normal(0, sigma, (num_offspring.sum(), 2))
     
     # Combine all points into a single array
-    return np.column_stack((np.concatenate(offspring_x), np.concatenate(offspring_y)))
+    return parents + displacements
 
+def get_lgcp_2d(rate, x_min, x_max, y_min, y_max, grid_size=50, variance=0.5, length_scale=0.1):
+    """
+    Simulate a log-Gaussian Cox process in 2D.
 
-def get_lgcp_2d(rate, x_min, x_max, y_min, y_max):
+    Parameters:
+    - rate: Mean intensity, exp of the mean of the log-intensity field
+    - grid_size: Number of cells of the intensity field along the longest side
+    - variance: Variance of the Gaussian field
+    - length_scale: Correlation length scale of the Gaussian field
+
+    Returns:
+    - Array of (x, y) points within [x_min, x_max] x [y_min, y_max]
+    """
     domain_size = max(x_max - x_min, y_max - y_min)
-    # domain_size = 1          # Size of square domain
-    grid_size = 50            # Discretization resolution
-    # mean_log_intensity = 1.0  # Mean of log-intensity field
-    variance = 0.5            # Variance of Gaussian field
-    length_scale = 0.1         # Correlation length scale
     mean_log_intensity = np.log(rate)
     
-    # Create grid
-    x = np.linspace(0, domain_size, grid_size)
-    y = np.linspace(0, domain_size, grid_size)
-    xx, yy = np.meshgrid(x, y)
-    coords = np.column_stack([xx.ravel(), yy.ravel()])
-    
-    # Compute covariance matrix (Squared Exponential Kernel)
-    dists = cdist(coords, coords, metric='euclidean')
-    K = variance * np.exp(-0.5 * (dists / length_scale)**2)
-    
-    # Sample from multivariate normal (Gaussian process)
-    mean_vector = mean_log_intensity * np.ones(len(coords))
-    G = np.random.multivariate_normal(mean_vector, K)
-    
-    # Exponentiate to get intensity
-    Lambda = np.exp(G).reshape(grid_size, grid_size)
-    
-    # Simulate points
+    # Create grid of cells covering the domain
     dx = domain_size / grid_size
-    points = []
-    for i in range(grid_size):
-        for j in range(grid_size):
-            lam = Lambda[i, j]
-            expected_points = lam * dx * dx
-            num_points = np.random.poisson(expected_points)
-            # Uniformly distribute points within the cell
-            for _ in range(num_points):
-                px = x[j] + dx * np.random.rand()
-                py = y[i] + dx * np.random.rand()
-                points.append((px, py))
-
-    # Filter points that are within the specified bounds
-    points = np.array(points)
-    # filtered_points = points[(points[:, 0] >= x_min) & (points[:, 0] <= x_max) &
-    #                 (points[:, 1] >= y_min) & (points[:, 1] <= y_max)]
-    
-    return points
+    nx = max(int(np.ceil((x_max - x_min) / dx - 1e-9)), 1)
+    ny = max(int(np.ceil((y_max - y_min) / dx - 1e-9)), 1)
+    x = x_min + dx * np.arange(nx)
+    y = y_min + dx * np.arange(ny)
+    
+    # Sample the Gaussian field (Squared Exponential Kernel) and exponentiate to get intensity
+    G = mean_log_intensity + sample_gaussian_field_2d((nx, ny), dx, variance, length_scale)
+    Lambda = np.exp(G)
+    
+    # Simulate points: Poisson counts per cell, uniformly distributed within the cell
+    num_points = np.random.poisson(Lambda * dx * dx).ravel()
+    total = np.sum(num_points)
+    px = np.repeat(np.repeat(x, ny), num_points) + dx * np.random.rand(total)
+    py = np.repeat(np.tile(y, nx), num_points) + dx * np.random.rand(total)
+    points = np.column_stack((px, py))
+
+    # Cells on the upper edges can overhang a non-square domain
+    return points[(points[:, 0] <= x_max) & (points[:, 1] <= y_max)]
+
+# Stationary Gaussian fields by circulant embedding
+def get_circulant_embedding_eigenvalues_2d(shape, dx, variance, length_scale, max_size=2**26):
+    """
+    Eigenvalues of the circulant embedding of the squared exponential covariance
+    of a regular grid of the given shape and spacing dx.
+
+    The embedding is grown (in powers of two) until it is non-negative definite,
+    or it reaches max_size cells. Remaining round-off negatives are clipped to zero.
+    """
+    m = [2 ** int(np.ceil(np.log2(max(2 * (n - 1), 1)))) for n in shape]
+    while True:
+        lags_x = np.minimum(np.arange(m[0]), m[0] - np.arange(m[0])) * dx
+        lags_y = np.minimum(np.arange(m[1]), m[1] - np.arange(m[1])) * dx
+        # The kernel is separable, so the first row is an outer product
+        first_row = variance * np.outer(np.exp(-0.5 * (lags_x / length_scale)**2), np.exp(-0.5 * (lags_y / length_scale)**2))
+        eigenvalues = np.fft.fft2(first_row).real
+        if eigenvalues.min() >= -1e-8 * eigenvalues.max() or m[0] * m[1] >= max_size:
+            break
+        m = [2 * size for size in m]
+    return np.clip(eigenvalues, 0, None)
+
+def get_circulant_embedding_factor_2d(shape, dx, variance, length_scale):
+    """
+    Square root of the scaled circulant embedding eigenvalues, the spectral
+    factor of the covariance. Cached in covariance_cache, so the embedding is
+    only computed once per set of kernel parameters and discretization.
+    """
+    key = ('squared_exponential_2d', tuple(shape), dx, variance, length_scale)
+    def compute():
+        eigenvalues = get_circulant_embedding_eigenvalues_2d(shape, dx, variance, length_scale)
+        return np.sqrt(eigenvalues / eigenvalues.size)
+    return covariance_cache.get(key, compute)
+
+def sample_gaussian_field_2d(shape, dx, variance, length_scale, size=None):
+    """
+    Sample a zero-mean Gaussian field with a squared exponential covariance on
+    a regular grid, in O(n log n) time and O(n) memory for n grid cells.
+
+    Parameters:
+    - shape: (nx, ny) shape of the grid
+    - dx: Spacing of the grid
+    - variance: Variance of the field
+    - length_scale: Length scale of the covariance
+    - size: Number of independent fields to draw, or None for a single field
+
+    Returns:
+    - Array of the given shape, or (size, nx, ny) if size is given
+    """
+    scale = get_circulant_embedding_factor_2d(shape, dx, variance, length_scale)
+    fields = []
+    n_fields = 1 if size is None else size
+    while len(fields) < n_fields:
+        # The real and imaginary parts of one draw are two independent fields
+        z = np.random.standard_normal(scale.shape) + 1j * np.random.standard_normal(scale.shape)
+        field = np.fft.fft2(scale * z)[:shape[0], :shape[1]]
+        fields.extend([field.real, field.imag])
+    if size is None:
+        return fields[0]
+    return np.stack(fields[:size])
 
 # def simulate_2d_lgcp(grid_size, mean_log_intensity, variance, length_scale, x_min, x_max, y_min, y_max):
 #     # Create grid
@@ -138,4 +201,10 @@ def get_lgcp_2d(rate, x_min, x_max, y_min, y_max):
 #                 py = y[i] + dx * np.random.rand()
 #                 points.append((px, py))
     
-#     return np.array(points)
\ No newline at end of file
+#     return np.array(points)
+
+# Samplers drawing many realizations of a point process at once, used by the
+# batched simulations in place of one call of the point process per trial
+BATCH_SAMPLERS = {
+    poisson_process_2d: poisson_process_2d_batch,
+}
@@ -0,0 +1,124 @@
+import functools
+import hashlib
+import json
+import os
+import fastparquet
+import numpy as np
+import pandas as pd
+from src.caching import write_atomically
+from src.simulation_engine import RESULT_KEYS, ErrorAccumulator, RunningMoments
+
+# RunningMoments of an ErrorAccumulator saved for each sweep point
+MOMENTS = ('errors_centroid', 'errors_proportional', 'mape_centroid', 'mape_proportional')
+
+class ResultStore:
+    """
+    Parquet dataset of sweep point results, used to resume interrupted sweeps.
+
+    Every sweep point is written to its own file in the directory as soon as it
+    is done, keyed by a hash of everything that determines its result (see
+    make_key). Besides the summary statistics, the file holds the state of the
+    point's ErrorAccumulator, so the stored results can be merged with new ones.
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def make_key(**fields):
+        """
+        Hash of the fields identifying a sweep point.
+        """
+        text = json.dumps(fields, sort_keys=True, default=_to_json)
+        return hashlib.sha256(text.encode()).hexdigest()[:32]
+
+    def get(self, key):
+        """
+        ErrorAccumulator stored under key, or None.
+        """
+        filename = self._filename(key)
+        if not os.path.exists(filename):
+            return None
+        row = fastparquet.ParquetFile(filename).to_pandas().iloc[0]
+        accumulator = ErrorAccumulator()
+        for name in MOMENTS:
+            moments = RunningMoments()
+            moments.count = int(row[f'{name}_count'])
+            moments._mean = float(row[f'{name}_mean'])
+            moments.m2 = float(row[f'{name}_m2'])
+            setattr(accumulator, name, moments)
+        return accumulator
+
+    def put(self, key, accumulator, **fields):
+        """
+        Write the ErrorAccumulator of a sweep point with its identifying fields.
+        """
+        row = {'key': key}
+        for name, value in fields.items():
+            row[name] = value if isinstance(value, (int, float, str)) else json.dumps(value, sort_keys=True, default=_to_json)
+        row.update(accumulator.summary())
+        for name in MOMENTS:
+            moments = getattr(accumulator, name)
+            row[f'{name}_count'] = moments.count
+            row[f'{name}_mean'] = moments._mean
+            row[f'{name}_m2'] = moments.m2
+
+        write_atomically(self._filename(key), lambda path: fastparquet.write(path, pd.DataFrame([row])))
+
+    def load(self):
+        """
+        DataFrame with one row per stored sweep point.
+        """
+        filenames = sorted(name for name in os.listdir(self.path) if name.endswith('.parquet'))
+        if not filenames:
+            return pd.DataFrame(columns=['key', *RESULT_KEYS])
+        return pd.concat(
+            [fastparquet.ParquetFile(os.path.join(self.path, name)).to_pandas() for name in filenames],
+            ignore_index=True,
+        )
+
+    def __contains__(self, key):
+        return os.path.exists(self._filename(key))
+
+    def _filename(self, key):
+        return os.path.join(self.path, f'{key}.parquet')
+
+def open_store(store):
+    """
+    ResultStore for a directory, or store itself if it is already one.
+    """
+    if store is None or isinstance(store, ResultStore):
+        return store
+    return ResultStore(store)
+
+def describe_generator(point_process, generator_key=None):
+    """
+    Name and parameters of a point process, as used in the store keys.
+
+    The arguments bound with functools.partial are part of the parameters. Other
+    parameters of the generator, such as the defaults of a lambda, are not seen.
+    The name is generator_key if given, and the qualified name of the generator
+    otherwise. A lambda, a closure or a function defined inside another
+    function cannot be told apart from others by its qualified name, so it
+    raises a ValueError without a generator_key, rather than sharing the
+    stored results of another generator.
+    """
+    parameters = {}
+    while isinstance(point_process, functools.partial):
+        parameters = {'args': list(point_process.args), **point_process.keywords, **parameters}
+        point_process = point_process.func
+    if generator_key is not None:
+        return generator_key, parameters
+    name = getattr(point_process, '__qualname__', repr(point_process))
+    if '<lambda>' in name or '<locals>' in name or getattr(point_process, '__closure__', None):
+        raise ValueError(f"The point process {name} cannot be identified in the store keys by its name, pass a generator_key")
+    return name, parameters
+
+def _to_json(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.random.SeedSequence):
+        return {'entropy': value.entropy, 'spawn_key': list(value.spawn_key)}
+    return repr(value)
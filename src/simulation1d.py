@@ -1,14 +1,83 @@
-from tqdm import tqdm
+"""
+Sweeps comparing the centroid and proportional allocation estimates of 1D
+point processes, one function per scenario.
+
+Keyword arguments shared by the run_simulation_* functions:
+- batch_size: If given, run the trials in vectorized blocks of up to this many trials
+  instead of one at a time. The polygons, the grid origins and, for the point
+  processes of point_processes_1d.BATCH_SAMPLERS, the realizations of a block
+  are drawn at once, so the trials differ from those of the loop for the same
+  seed but have the same distribution.
+- n_jobs: Number of worker processes, -1 for one per CPU. point_process must
+  then be picklable (a module-level function or functools.partial, not a lambda).
+- seed: Seed for np.random.SeedSequence. Every block of trials gets its own
+  spawned stream, so results for a given seed do not depend on n_jobs.
+- grid_free: Compute the estimates directly from the points (see aggregation_1d.grid_free_estimates)
+  instead of creating the histogram, so that time and memory do not grow with
+  the number of cells. Simulates the same trials as the default for a given seed.
+- common_random_numbers: Draw every realization and polygon placement once and
+  evaluate it at all the (grid width, polygon width) points of the sweep, rather
+  than drawing new ones for each point. Divides the cost of the point process by
+  the number of points and correlates the errors of the points, which reduces
+  the variance of the comparisons between them. batch_size then only sets the
+  size of the blocks of trials.
+- store: Directory of a Parquet result store, or a result_store.ResultStore.
+  Sweep points already in the store (same generator, parameters, scenario,
+  grid width, polygon width, trials, batch size and seed) are read from it
+  instead of being simulated, and the other points are written to it as soon
+  as they are done, so an interrupted sweep resumes where it stopped.
+- generator_key: Name identifying point_process in the store keys, in place of
+  its qualified name. Required with a store when point_process is a lambda, a
+  closure or a function defined inside another function, whose qualified name
+  does not tell it apart from others (see result_store.describe_generator).
+- target_relative_width: If given, run the trials of each point in blocks of
+  batch_size (100 by default) and stop once the confidence intervals on the mean
+  errors and MAPEs are narrower than this fraction of the root mean squared error
+  and of the MAPE respectively (see simulation_engine.has_converged), or once
+  trials trials have been run.
+- confidence: Confidence level of the intervals used by target_relative_width
+- profile: Record the wall time and peak memory (traced with tracemalloc, which
+  slows down allocations) of the generation, gridding, ground truth and
+  estimation stages of every point, returned under 'profile' (see
+  simulation_engine.run_sweep). Costs next to nothing when off.
+- polygons_per_realization: Number of random polygons evaluated against each
+  realization and its grid, all in one vectorized pass. Every polygon counts
+  as one of the trials, so the point process and the gridding run about
+  trials / polygons_per_realization times. The polygons of a realization
+  share its points, so their errors are correlated, which the intervals of
+  target_relative_width do not account for. Not taken by run_simulation_fixed_edge.
+- compact: Store the counts with the smallest integer type that can hold them
+  (see aggregation_nd.count_cells), which usually takes 2 bytes per cell rather
+  than 8 on fine grids. The estimates are accumulated in float64 and do not change.
+"""
+from functools import partial
 import numpy as np
 from src.aggregation_1d import (
+    create_bins,
+    create_random_origin_bins,
     create_gridded_data, 
     create_gridded_data_random_origin,
     get_actual_value, 
     centroid_allocation_estimate, 
-    proportional_allocation_estimate
+    proportional_allocation_estimate,
+    grid_free_estimates,
+    GridIndex1D,
+    PointIndex1D,
+    stack_trials,
+    create_random_origin_bins_batch,
+    create_gridded_data_batch,
+    get_actual_value_batch,
+    centroid_allocation_estimate_batch,
+    proportional_allocation_estimate_batch,
 )
+from src.point_processes_1d import BATCH_SAMPLERS
+from src.result_store import describe_generator, open_store
+from src.simulation_engine import get_block_sizes, point_profile, point_random_state, run_sweep, stage
+
+# Upper bound on the number of histogram cells held in memory by one batch
+MAX_BATCH_CELLS = 2**24
 
-def run_simulation_fixed_edge(rate, start, end, trials, dg, dp, point_process):
+def run_simulation_fixed_edge(rate, start, end, trials, dg, dp, point_process, batch_size=None, n_jobs=1, seed=None, grid_free=False, common_random_numbers=False, store=None, target_relative_width=None, confidence=0.95, profile=False, compact=False, generator_key=None):
     """
     Run a simulation to compare the performance of centroid and proportional allocation estimates.
     
@@ -19,53 +88,21 @@ def run_simulation_fixed_edge(rate, start, end, trials, dg, dp, point_process):
     - trials: Number of trials to run
     - dg: List of grid cell widths
     - dp: Polygon width
+    - point_process: Function (rate, start, end) returning the points of one realization
+
+    The keyword arguments are shared by the run_simulation_* functions and
+    documented in the module docstring.
 
     Returns:
-    - Lists containing mean and variance of estimates for both methods
-    """
-    # Run many iterations to get a distribution of the estimates
-    mean_estimate_centroid = []
-    var_estimate_centroid = []
-    mean_estimate_proportional = []
-    var_estimate_proportional = []
-    mean_mape_proportional = []
-    mean_mape_centroid = []
-    for grid_width, polygon_width in tqdm(zip(dg, dp),  total=len(dg)):
-        errors_centroid = []
-        errors_proportional = []
-        mape_centroid = []
-        mape_proportional = []
-        
-        for _ in range(trials):
-            data = point_process(rate, start, end)
-            count, edges = create_gridded_data(data, grid_width, 0, 1)
-            actual_value = get_actual_value(data, 0, polygon_width)
-            estimate_centroid = centroid_allocation_estimate(count, edges, 0, polygon_width)
-            estimate_proportional = proportional_allocation_estimate(count, edges, 0, polygon_width)
-            errors_centroid.append(estimate_centroid - actual_value)
-            errors_proportional.append(estimate_proportional - actual_value)
-            if actual_value != 0:
-                mape_centroid.append(np.abs(estimate_centroid - actual_value) / actual_value * 100)
-                mape_proportional.append(np.abs(estimate_proportional - actual_value) / actual_value * 100)
-
-        # Calculate mean and variance of the estimates
-        mean_estimate_centroid.append(np.mean(errors_centroid))
-        var_estimate_centroid.append(np.var(errors_centroid))
-        mean_estimate_proportional.append(np.mean(errors_proportional))
-        var_estimate_proportional.append(np.var(errors_proportional))
-        mean_mape_centroid.append(np.mean(mape_centroid))
-        mean_mape_proportional.append(np.mean(mape_proportional))
-        
-    return {
-        'mean_estimate_centroid': mean_estimate_centroid,
-        'mean_estimate_proportional': mean_estimate_proportional,
-        'var_estimate_centroid': var_estimate_centroid,
-        'var_estimate_proportional': var_estimate_proportional,
-        'mean_mape_centroid': mean_mape_centroid,
-        'mean_mape_proportional': mean_mape_proportional
-    }
-
-def run_simulation_random_polygon_placement(rate, start, end, trials, dg, dp, point_process):
+    - Lists containing mean and variance of estimates for both methods, and the
+      number of trials run for each point under 'trials'
+    """
+    return _run_simulation(
+        rate, start, end, trials, dg, dp, point_process, batch_size, n_jobs, seed, grid_free, common_random_numbers, store, target_relative_width, confidence, profile, 1, compact, generator_key,
+        scenario='fixed_edge', grid_range=(0, 1), random_polygon=False, random_origin=False,
+    )
+
+def run_simulation_random_polygon_placement(rate, start, end, trials, dg, dp, point_process, batch_size=None, n_jobs=1, seed=None, grid_free=False, common_random_numbers=False, store=None, target_relative_width=None, confidence=0.95, profile=False, polygons_per_realization=1, compact=False, generator_key=None):
     """
     Run a simulation to compare the performance of centroid and proportional allocation estimates.
     
@@ -76,58 +113,21 @@ def run_simulation_random_polygon_placement(rate, start, end, trials, dg, dp, po
     - trials: Number of trials to run
     - dg: List of grid cell widths
     - dp: Polygon width
+    - point_process: Function (rate, start, end) returning the points of one realization
+
+    The keyword arguments are shared by the run_simulation_* functions and
+    documented in the module docstring.
 
     Returns:
-    - Lists containing mean and variance of estimates for both methods
-    """
-    # Run many iterations to get a distribution of the estimates
-    mean_estimate_centroid = []
-    var_estimate_centroid = []
-    mean_estimate_proportional = []
-    var_estimate_proportional = []
-    mean_mape_proportional = []
-    mean_mape_centroid = []
-    for grid_width, polygon_width in tqdm(zip(dg, dp),  total=len(dg)):
-        errors_centroid = []
-        errors_proportional = []
-        mape_centroid = []
-        mape_proportional = []
-        
-        for _ in range(trials):
-            # Generate polygon
-            polygon_start = np.random.uniform(low=-1, high=2)
-            polygon_end = polygon_start + polygon_width
-            
-            data = point_process(rate, start, end)
-            count, edges = create_gridded_data(data, grid_width, start, end)
-            actual_value = get_actual_value(data, polygon_start, polygon_end)
-
-            estimate_centroid = centroid_allocation_estimate(count, edges, polygon_start, polygon_end)
-            estimate_proportional = proportional_allocation_estimate(count, edges, polygon_start, polygon_end)
-            errors_centroid.append(estimate_centroid - actual_value)
-            errors_proportional.append(estimate_proportional - actual_value)
-            if actual_value != 0:
-                mape_centroid.append(np.abs(estimate_centroid - actual_value) / actual_value * 100)
-                mape_proportional.append(np.abs(estimate_proportional - actual_value) / actual_value * 100)
-
-        # Calculate mean and variance of the estimates
-        mean_estimate_centroid.append(np.mean(errors_centroid))
-        var_estimate_centroid.append(np.var(errors_centroid))
-        mean_estimate_proportional.append(np.mean(errors_proportional))
-        var_estimate_proportional.append(np.var(errors_proportional))
-        mean_mape_centroid.append(np.mean(mape_centroid))
-        mean_mape_proportional.append(np.mean(mape_proportional))
-        
-    return {
-        'mean_estimate_centroid': mean_estimate_centroid,
-        'mean_estimate_proportional': mean_estimate_proportional,
-        'var_estimate_centroid': var_estimate_centroid,
-        'var_estimate_proportional': var_estimate_proportional,
-        'mean_mape_centroid': mean_mape_centroid,
-        'mean_mape_proportional': mean_mape_proportional
-    }
-    
-def run_simulation_random_polygon_placement_and_grid_origin(rate, start, end, trials, dg, dp, point_process):
+    - Lists containing mean and variance of estimates for both methods, and the
+      number of trials run for each point under 'trials'
+    """
+    return _run_simulation(
+        rate, start, end, trials, dg, dp, point_process, batch_size, n_jobs, seed, grid_free, common_random_numbers, store, target_relative_width, confidence, profile, polygons_per_realization, compact, generator_key,
+        scenario='random_polygon_placement', grid_range=(start, end), random_polygon=True, random_origin=False,
+    )
+
+def run_simulation_random_polygon_placement_and_grid_origin(rate, start, end, trials, dg, dp, point_process, batch_size=None, n_jobs=1, seed=None, grid_free=False, common_random_numbers=False, store=None, target_relative_width=None, confidence=0.95, profile=False, polygons_per_realization=1, compact=False, generator_key=None):
     """
     Run a simulation to compare the performance of centroid and proportional allocation estimates.
     
@@ -138,53 +138,233 @@ def run_simulation_random_polygon_placement_and_grid_origin(rate, start, end, tr
     - trials: Number of trials to run
     - dg: List of grid cell widths
     - dp: Polygon width
+    - point_process: Function (rate, start, end) returning the points of one realization
+
+    The keyword arguments are shared by the run_simulation_* functions and
+    documented in the module docstring.
 
     Returns:
-    - Lists containing mean and variance of estimates for both methods
-    """
-    # Run many iterations to get a distribution of the estimates
-    mean_estimate_centroid = []
-    var_estimate_centroid = []
-    mean_estimate_proportional = []
-    var_estimate_proportional = []
-    mean_mape_proportional = []
-    mean_mape_centroid = []
-    for grid_width, polygon_width in tqdm(zip(dg, dp),  total=len(dg)):
-        errors_centroid = []
-        errors_proportional = []
-        mape_centroid = []
-        mape_proportional = []
-        
-        for _ in range(trials):
+    - Lists containing mean and variance of estimates for both methods, and the
+      number of trials run for each point under 'trials'
+    """
+    return _run_simulation(
+        rate, start, end, trials, dg, dp, point_process, batch_size, n_jobs, seed, grid_free, common_random_numbers, store, target_relative_width, confidence, profile, polygons_per_realization, compact, generator_key,
+        scenario='random_polygon_placement_and_grid_origin', grid_range=(start, end), random_polygon=True, random_origin=True,
+    )
+
+def _run_simulation(rate, start, end, trials, dg, dp, point_process, batch_size, n_jobs, seed, grid_free, common_random_numbers, store, target_relative_width, confidence, profile, polygons_per_realization, compact, generator_key, scenario, grid_range, random_polygon, random_origin):
+    """
+    Run a sweep of one of the simulation scenarios.
+
+    - grid_range: (start, end) passed to the gridding functions
+    - random_polygon: Place the polygon uniformly at random instead of at 0
+    - random_origin: Draw a random grid origin in [0, polygon_width) for every trial
+    - grid_free: Use the grid-free estimators, batch_size then only sets the size
+      of the blocks of trials
+    - common_random_numbers: Evaluate every realization at all the points of the sweep
+    - store: Result store directory or ResultStore
+    - generator_key: Name of point_process in the store keys, see result_store.describe_generator
+    - target_relative_width, confidence: Stopping rule of the adaptive mode
+    - profile: Record the stages of every point
+    - polygons_per_realization: Number of polygons evaluated against each realization,
+      batch_size then only sets the size of the blocks of trials
+    - compact: Store the counts with the smallest integer type that can hold them
+    - scenario: Name of the scenario in the store keys
+    """
+    parameters = dict(
+        rate=rate, start=start, end=end, point_process=point_process,
+        grid_range=grid_range, random_polygon=random_polygon, random_origin=random_origin,
+    )
+    if common_random_numbers:
+        simulate_trials = partial(_simulate_trials_common, grid_free=grid_free, polygons_per_realization=polygons_per_realization, compact=compact, **parameters)
+    elif polygons_per_realization > 1:
+        simulate_trials = partial(_simulate_realizations, grid_free=grid_free, polygons_per_realization=polygons_per_realization, compact=compact, **parameters)
+    elif grid_free or batch_size is None:
+        simulate_trials = partial(_simulate_trials, grid_free=grid_free, compact=compact, **parameters)
+    else:
+        simulate_trials = partial(_simulate_trial_block, compact=compact, **parameters)
+    store = open_store(store)
+    store_fields = None
+    if store is not None:
+        generator, generator_parameters = describe_generator(point_process, generator_key)
+        store_fields = dict(
+            parameters, point_process=generator, generator_parameters=generator_parameters,
+            scenario=scenario, grid_free=grid_free, common_random_numbers=common_random_numbers,
+        )
+        if polygons_per_realization > 1:
+            store_fields['polygons_per_realization'] = polygons_per_realization
+    return run_sweep(
+        simulate_trials, dg, dp, trials, batch_size, n_jobs, seed, common_random_numbers, store, store_fields,
+        target_relative_width, confidence, profile,
+    )
+
+def _simulate_trials(grid_width, polygon_width, n, rate, start, end, point_process, grid_range, random_polygon, random_origin, grid_free=False, compact=False):
+    """
+    Run n trials one at a time with the scalar (or grid-free) estimators.
+
+    Returns the actual value, centroid estimate and proportional estimate of each trial.
+    """
+    actual_value = np.empty(n)
+    estimate_centroid = np.empty(n)
+    estimate_proportional = np.empty(n)
+    for i in range(n):
+        with stage('generation'):
             # Generate polygon
-            polygon_start = np.random.uniform(low=-1, high=2)
-            polygon_end = polygon_start + polygon_width
-            
+            polygon_start = np.random.uniform(low=-1, high=2) if random_polygon else 0
+
+            data = point_process(rate, start, end)
+        actual_value[i], estimate_centroid[i], estimate_proportional[i] = _estimate(
+            data, grid_width, polygon_start, polygon_width, grid_range, random_origin, grid_free, compact)
+    return actual_value, estimate_centroid, estimate_proportional
+
+def _simulate_realizations(grid_width, polygon_width, n, rate, start, end, point_process, grid_range, random_polygon, random_origin, polygons_per_realization, grid_free=False, compact=False):
+    """
+    Run n trials as polygons_per_realization polygons on each realization.
+
+    The last realization has fewer polygons when n is not a multiple of
+    polygons_per_realization.
+    """
+    values = np.empty((3, n))
+    for first in range(0, n, polygons_per_realization):
+        n_polygons = min(polygons_per_realization, n - first)
+        with stage('generation'):
+            polygon_start = np.random.uniform(low=-1, high=2, size=n_polygons) if random_polygon else np.zeros(n_polygons)
+
             data = point_process(rate, start, end)
-            count, edges = create_gridded_data_random_origin(data, grid_width, start, end, range_of_variation=polygon_width)
-            actual_value = get_actual_value(data, polygon_start, polygon_end)
-
-            estimate_centroid = centroid_allocation_estimate(count, edges, polygon_start, polygon_end)
-            estimate_proportional = proportional_allocation_estimate(count, edges, polygon_start, polygon_end)
-            errors_centroid.append(estimate_centroid - actual_value)
-            errors_proportional.append(estimate_proportional - actual_value)
-            if actual_value != 0:
-                mape_centroid.append(np.abs(estimate_centroid - actual_value) / actual_value * 100)
-                mape_proportional.append(np.abs(estimate_proportional - actual_value) / actual_value * 100)
-
-        # Calculate mean and variance of the estimates
-        mean_estimate_centroid.append(np.mean(errors_centroid))
-        var_estimate_centroid.append(np.var(errors_centroid))
-        mean_estimate_proportional.append(np.mean(errors_proportional))
-        var_estimate_proportional.append(np.var(errors_proportional))
-        mean_mape_centroid.append(np.mean(mape_centroid))
-        mean_mape_proportional.append(np.mean(mape_proportional))
-        
-    return {
-        'mean_estimate_centroid': mean_estimate_centroid,
-        'mean_estimate_proportional': mean_estimate_proportional,
-        'var_estimate_centroid': var_estimate_centroid,
-        'var_estimate_proportional': var_estimate_proportional,
-        'mean_mape_centroid': mean_mape_centroid,
-        'mean_mape_proportional': mean_mape_proportional
-    }
\ No newline at end of file
+        values[:, first:first + n_polygons] = _estimate_polygons(
+            data, grid_width, polygon_start, polygon_width, grid_range, random_origin, grid_free, compact=compact)
+    return tuple(values)
+
+def _simulate_trials_common(dg, dp, n, random_states, rate, start, end, point_process, grid_range, random_polygon, random_origin, grid_free=False, polygons_per_realization=1, compact=False):
+    """
+    Run n trials, each one evaluated at every (grid width, polygon width) point.
+
+    Returns one tuple (actual_value, estimate_centroid, estimate_proportional)
+    per point. The realizations and polygons are drawn from the global state,
+    and the grid of each point from its entry of random_states (see
+    simulation_engine.run_common_shard). Without random states, and with a
+    single point, the random numbers are drawn in the same order as in
+    _simulate_trials (or _simulate_realizations).
+    """
+    values = np.empty((len(dg), 3, n))
+    for first in range(0, n, polygons_per_realization):
+        n_polygons = min(polygons_per_realization, n - first)
+        with stage('generation'):
+            polygon_start = np.random.uniform(low=-1, high=2, size=n_polygons) if random_polygon else np.zeros(n_polygons)
+
+            data = point_process(rate, start, end)
+        point_index = None
+        if not grid_free:
+            # The points are indexed once for all the points of the sweep
+            with stage('ground_truth'):
+                point_index = PointIndex1D(data)
+        for point, (grid_width, polygon_width) in enumerate(zip(dg, dp)):
+            with point_profile(point), point_random_state(random_states[point]):
+                values[point, :, first:first + n_polygons] = _estimate_polygons(
+                    data, grid_width, polygon_start, polygon_width, grid_range, random_origin, grid_free, point_index, compact)
+    return [tuple(point_values) for point_values in values]
+
+def _estimate(data, grid_width, polygon_start, polygon_width, grid_range, random_origin, grid_free, compact=False):
+    """
+    Actual value, centroid estimate and proportional estimate of one realization.
+
+    With grid_free the ground truth is computed with the estimates, in the
+    estimation stage.
+    """
+    polygon_end = polygon_start + polygon_width
+    if grid_free:
+        with stage('gridding'):
+            if random_origin:
+                edges = create_random_origin_bins(grid_width, grid_range[0], grid_range[1], range_of_variation=polygon_width)
+            else:
+                edges = create_bins(grid_width, grid_range[0], grid_range[1])
+        with stage('estimation'):
+            return grid_free_estimates(data, edges, polygon_start, polygon_end)
+
+    with stage('gridding'):
+        if random_origin:
+            count, edges = create_gridded_data_random_origin(data, grid_width, grid_range[0], grid_range[1], range_of_variation=polygon_width, compact=compact)
+        else:
+            count, edges = create_gridded_data(data, grid_width, grid_range[0], grid_range[1], compact=compact)
+    with stage('ground_truth'):
+        actual_value = get_actual_value(data, polygon_start, polygon_end)
+    with stage('estimation'):
+        estimate_centroid = centroid_allocation_estimate(count, edges, polygon_start, polygon_end)
+        estimate_proportional = proportional_allocation_estimate(count, edges, polygon_start, polygon_end)
+    return actual_value, estimate_centroid, estimate_proportional
+
+def _estimate_polygons(data, grid_width, polygon_start, polygon_width, grid_range, random_origin, grid_free, point_index=None, compact=False):
+    """
+    Actual values, centroid estimates and proportional estimates of an array of
+    polygons on one realization, which is gridded once.
+
+    The estimates of all the polygons come from one GridIndex1D, and the actual
+    values from point_index, a PointIndex1D of the data built here if not given.
+    The grid-free estimators are evaluated one polygon at a time.
+    """
+    polygon_end = polygon_start + polygon_width
+    if grid_free:
+        with stage('gridding'):
+            if random_origin:
+                edges = create_random_origin_bins(grid_width, grid_range[0], grid_range[1], range_of_variation=polygon_width)
+            else:
+                edges = create_bins(grid_width, grid_range[0], grid_range[1])
+        with stage('estimation'):
+            return np.array([grid_free_estimates(data, edges, begin, end) for begin, end in zip(polygon_start, polygon_end)]).reshape(-1, 3).T
+
+    with stage('gridding'):
+        if random_origin:
+            count, edges = create_gridded_data_random_origin(data, grid_width, grid_range[0], grid_range[1], range_of_variation=polygon_width, compact=compact)
+        else:
+            count, edges = create_gridded_data(data, grid_width, grid_range[0], grid_range[1], compact=compact)
+    with stage('ground_truth'):
+        if point_index is None:
+            point_index = PointIndex1D(data)
+        actual_value = point_index.get_actual_value(polygon_start, polygon_end)
+    with stage('estimation'):
+        index = GridIndex1D(count, edges)
+        estimate_centroid = index.centroid_allocation(polygon_start, polygon_end)
+        estimate_proportional = index.proportional_allocation(polygon_start, polygon_end)
+    return actual_value, estimate_centroid, estimate_proportional
+
+def _simulate_trial_block(grid_width, polygon_width, n, rate, start, end, point_process, grid_range, random_polygon, random_origin, compact=False):
+    """
+    Run n trials as a batch with the batched estimators.
+
+    The polygons and the grid origins of the batch are each drawn at once, and
+    so are the realizations when point_process has a batch sampler (see
+    point_processes_1d.BATCH_SAMPLERS). The trials therefore differ from those
+    of _simulate_trials for the same seed, but have the same distribution.
+    """
+    # Keep the histograms of one batch within MAX_BATCH_CELLS. Only the window
+    # of cells holding the polygon of each trial is counted.
+    n_cells = polygon_width / grid_width + 2
+    max_trials = max(1, int(MAX_BATCH_CELLS // n_cells))
+    if n > max_trials:
+        blocks = [_simulate_trial_block(grid_width, polygon_width, size, rate, start, end, point_process, grid_range, random_polygon, random_origin, compact)
+                  for size in get_block_sizes(n, max_trials)]
+        return tuple(np.concatenate(values) for values in zip(*blocks))
+
+    # The random grid origins are drawn with the realizations, in the generation stage
+    with stage('generation'):
+        polygon_start = np.random.uniform(low=-1, high=2, size=n) if random_polygon else np.zeros(n)
+        sample_batch = BATCH_SAMPLERS.get(point_process)
+        if sample_batch is None:
+            data, trial_index = stack_trials([point_process(rate, start, end) for _ in range(n)])
+        else:
+            data, trial_index = sample_batch(n, rate, start, end)
+        if random_origin:
+            bins = create_random_origin_bins_batch(n, grid_width, grid_range[0], grid_range[1], range_of_variation=polygon_width)
+    polygon_end = polygon_start + polygon_width
+
+    with stage('gridding'):
+        if not random_origin:
+            bins = create_bins(grid_width, grid_range[0], grid_range[1])
+        count, edges = create_gridded_data_batch(data, trial_index, n, bins, compact, window=(polygon_start, polygon_end))
+    with stage('ground_truth'):
+        actual_value = get_actual_value_batch(data, trial_index, n, polygon_start, polygon_end)
+
+    with stage('estimation'):
+        estimate_centroid = centroid_allocation_estimate_batch(count, edges, polygon_start, polygon_end)
+        estimate_proportional = proportional_allocation_estimate_batch(count, edges, polygon_start, polygon_end)
+    return actual_value, estimate_centroid, estimate_proportional
@@ -1,14 +1,87 @@
-from tqdm import tqdm
+"""
+Sweeps comparing the centroid and proportional allocation estimates of 2D
+point processes, one function per scenario.
+
+Keyword arguments shared by the run_simulation_* functions:
+- batch_size: If given, run the trials in vectorized blocks of up to this many trials
+  instead of one at a time. The polygons, the grid origins and, for the point
+  processes of point_processes_2d.BATCH_SAMPLERS, the realizations of a block
+  are drawn at once, so the trials differ from those of the loop for the same
+  seed but have the same distribution.
+- n_jobs: Number of worker processes, -1 for one per CPU. point_process must
+  then be picklable (a module-level function or functools.partial, not a lambda).
+- seed: Seed for np.random.SeedSequence. Every block of trials gets its own
+  spawned stream, so results for a given seed do not depend on n_jobs.
+- grid_free: Compute the estimates directly from the points (see aggregation_2d.grid_free_estimates_2d)
+  instead of creating the histogram, so that time and memory do not grow with
+  the number of cells. Simulates the same trials as the default for a given seed.
+- common_random_numbers: Draw every realization and polygon placement once and
+  evaluate it at all the (grid width, polygon width) points of the sweep, rather
+  than drawing new ones for each point. Divides the cost of the point process by
+  the number of points and correlates the errors of the points, which reduces
+  the variance of the comparisons between them. batch_size then only sets the
+  size of the blocks of trials.
+- store: Directory of a Parquet result store, or a result_store.ResultStore.
+  Sweep points already in the store (same generator, parameters, scenario,
+  grid width, polygon width, trials, batch size and seed) are read from it
+  instead of being simulated, and the other points are written to it as soon
+  as they are done, so an interrupted sweep resumes where it stopped.
+- generator_key: Name identifying point_process in the store keys, in place of
+  its qualified name. Required with a store when point_process is a lambda, a
+  closure or a function defined inside another function, whose qualified name
+  does not tell it apart from others (see result_store.describe_generator).
+- target_relative_width: If given, run the trials of each point in blocks of
+  batch_size (100 by default) and stop once the confidence intervals on the mean
+  errors and MAPEs are narrower than this fraction of the root mean squared error
+  and of the MAPE respectively (see simulation_engine.has_converged), or once
+  trials trials have been run.
+- confidence: Confidence level of the intervals used by target_relative_width
+- profile: Record the wall time and peak memory (traced with tracemalloc, which
+  slows down allocations) of the generation, gridding, ground truth and
+  estimation stages of every point, returned under 'profile' (see
+  simulation_engine.run_sweep). Costs next to nothing when off.
+- polygons_per_realization: Number of random polygons evaluated against each
+  realization and its grid, all in one vectorized pass. Every polygon counts
+  as one of the trials, so the point process and the gridding run about
+  trials / polygons_per_realization times. The polygons of a realization
+  share its points, so their errors are correlated, which the intervals of
+  target_relative_width do not account for. Not taken by run_simulation_fixed_edge_2d.
+- compact: Store the counts with the smallest integer type that can hold them
+  (see aggregation_nd.count_cells), which usually takes 2 bytes per cell rather
+  than 8 on fine grids. The estimates are accumulated in float64 and do not change.
+- sparse: Grid each realization into an aggregation_nd.SparseCount of its
+  occupied cells, so that the cost of the gridding and of the estimates
+  depends on the number of points rather than on the number of cells. The
+  realizations are then evaluated one at a time, as with grid_free, and the
+  estimates do not change.
+"""
+from functools import partial
 import numpy as np
+from src.aggregation_1d import stack_trials
 from src.aggregation_2d import (
     create_gridded_data_origin_0_2d, 
+    create_random_origin_bins_2d,
+    create_random_origin_bins_2d_batch,
     create_gridded_data_2d,
     get_actual_value_2d, 
     centroid_allocation_estimate_2d, 
     proportional_allocation_estimate_2d,
+    grid_free_estimates_2d,
+    GridIndex2D,
+    PointIndex2D,
+    create_gridded_data_2d_batch,
+    get_actual_value_2d_batch,
+    centroid_allocation_estimate_2d_batch,
+    proportional_allocation_estimate_2d_batch,
 )
+from src.point_processes_2d import BATCH_SAMPLERS
+from src.result_store import describe_generator, open_store
+from src.simulation_engine import get_block_sizes, point_profile, point_random_state, run_sweep, stage
+
+# Upper bound on the number of histogram cells held in memory by one batch
+MAX_BATCH_CELLS = 2**24
 
-def run_simulation_fixed_edge_2d(rate, x_range, y_range, trials, dg, dp, point_process):
+def run_simulation_fixed_edge_2d(rate, x_range, y_range, trials, dg, dp, point_process, batch_size=None, n_jobs=1, seed=None, grid_free=False, common_random_numbers=False, store=None, target_relative_width=None, confidence=0.95, profile=False, compact=False, sparse=False, generator_key=None):
     """
     Run a simulation to compare the performance of centroid and proportional allocation estimates.
     
@@ -19,56 +92,21 @@ def run_simulation_fixed_edge_2d(rate, x_range, y_range, trials, dg, dp, point_p
     - trials: Number of trials to run
     - dg: List of grid cell widths
     - dp: Polygon width
+    - point_process: Function (rate, x_range, y_range) returning the (n, 2) points of one realization
+
+    The keyword arguments are shared by the run_simulation_* functions and
+    documented in the module docstring.
 
     Returns:
-    - Lists containing mean and variance of estimates for both methods
-    """
-    # Run many iterations to get a distribution of the estimates
-    mean_estimate_centroid = []
-    var_estimate_centroid = []
-    mean_estimate_proportional = []
-    var_estimate_proportional = []
-    mean_mape_proportional = []
-    mean_mape_centroid = []
-    for grid_width, polygon_width in tqdm(zip(dg, dp),  total=len(dg)):
-        errors_centroid = []
-        errors_proportional = []
-        mape_centroid = []
-        mape_proportional = []
-        
-        polygon_x_range = (0, polygon_width)
-        polygon_y_range = (0, polygon_width)
-        
-        for _ in range(trials):
-            data = point_process(rate, x_range, y_range)
-            count, edgesx, edgesy = create_gridded_data_2d(data, grid_width, x_range=x_range, y_range=y_range)
-            actual_value = get_actual_value_2d(data, polygon_x_range, polygon_y_range)
-            estimate_centroid = centroid_allocation_estimate_2d(count, edgesx, edgesy, polygon_x_range, polygon_y_range)
-            estimate_proportional = proportional_allocation_estimate_2d(count, edgesx, edgesy, polygon_x_range, polygon_y_range)
-            errors_centroid.append(estimate_centroid - actual_value)
-            errors_proportional.append(estimate_proportional - actual_value)
-            if actual_value != 0:
-                mape_centroid.append(np.abs(estimate_centroid - actual_value) / actual_value * 100)
-                mape_proportional.append(np.abs(estimate_proportional - actual_value) / actual_value * 100)
-
-        # Calculate mean and variance of the estimates
-        mean_estimate_centroid.append(np.mean(errors_centroid))
-        var_estimate_centroid.append(np.var(errors_centroid))
-        mean_estimate_proportional.append(np.mean(errors_proportional))
-        var_estimate_proportional.append(np.var(errors_proportional))
-        mean_mape_centroid.append(np.mean(mape_centroid))
-        mean_mape_proportional.append(np.mean(mape_proportional))
-        
-    return {
-        'mean_estimate_centroid': mean_estimate_centroid,
-        'mean_estimate_proportional': mean_estimate_proportional,
-        'var_estimate_centroid': var_estimate_centroid,
-        'var_estimate_proportional': var_estimate_proportional,
-        'mean_mape_centroid': mean_mape_centroid,
-        'mean_mape_proportional': mean_mape_proportional
-    }
-
-def run_simulation_random_polygon_placement_2d(rate, x_range, y_range, trials, dg, dp, point_process):
+    - Lists containing mean and variance of estimates for both methods, and the
+      number of trials run for each point under 'trials'
+    """
+    return _run_simulation(
+        rate, x_range, y_range, trials, dg, dp, point_process, batch_size, n_jobs, seed, grid_free, common_random_numbers, store, target_relative_width, confidence, profile, 1, compact, sparse, generator_key,
+        scenario='fixed_edge', random_polygon=False, random_origin=False,
+    )
+
+def run_simulation_random_polygon_placement_2d(rate, x_range, y_range, trials, dg, dp, point_process, batch_size=None, n_jobs=1, seed=None, grid_free=False, common_random_numbers=False, store=None, target_relative_width=None, confidence=0.95, profile=False, polygons_per_realization=1, compact=False, sparse=False, generator_key=None):
     """
     Run a simulation to compare the performance of centroid and proportional allocation estimates.
     
@@ -79,62 +117,21 @@ def run_simulation_random_polygon_placement_2d(rate, x_range, y_range, trials, d
     - trials: Number of trials to run
     - dg: List of grid cell widths
     - dp: Polygon width
+    - point_process: Function (rate, x_range, y_range) returning the (n, 2) points of one realization
+
+    The keyword arguments are shared by the run_simulation_* functions and
+    documented in the module docstring.
 
     Returns:
-    - Lists containing mean and variance of estimates for both methods
-    """
-    # Run many iterations to get a distribution of the estimates
-    mean_estimate_centroid = []
-    var_estimate_centroid = []
-    mean_estimate_proportional = []
-    var_estimate_proportional = []
-    mean_mape_proportional = []
-    mean_mape_centroid = []
-    for grid_width, polygon_width in tqdm(zip(dg, dp),  total=len(dg)):
-        errors_centroid = []
-        errors_proportional = []
-        mape_centroid = []
-        mape_proportional = []
-        
-        for _ in range(trials):
-            # Generate polygon
-            
-            polygon_start_x_offset = np.random.uniform(low=-1, high=0)
-            polygon_start_y_offset = np.random.uniform(low=-1, high=0)
-            
-            polygon_x_range = (polygon_start_x_offset, polygon_width + polygon_start_x_offset)
-            polygon_y_range = (polygon_start_y_offset, polygon_width + polygon_start_y_offset)
-            
-            data = point_process(rate, x_range, y_range)
-            count, xedges, yedges = create_gridded_data_2d(data, grid_width, x_range, y_range)
-            actual_value = get_actual_value_2d(data, polygon_x_range, polygon_y_range)
-
-            estimate_centroid = centroid_allocation_estimate_2d(count, xedges, yedges, polygon_x_range, polygon_y_range)
-            estimate_proportional = proportional_allocation_estimate_2d(count, xedges, yedges, polygon_x_range, polygon_y_range)
-            errors_centroid.append(estimate_centroid - actual_value)
-            errors_proportional.append(estimate_proportional - actual_value)
-            if actual_value != 0:
-                mape_centroid.append(np.abs(estimate_centroid - actual_value) / actual_value * 100)
-                mape_proportional.append(np.abs(estimate_proportional - actual_value) / actual_value * 100)
-
-        # Calculate mean and variance of the estimates
-        mean_estimate_centroid.append(np.mean(errors_centroid))
-        var_estimate_centroid.append(np.var(errors_centroid))
-        mean_estimate_proportional.append(np.mean(errors_proportional))
-        var_estimate_proportional.append(np.var(errors_proportional))
-        mean_mape_centroid.append(np.mean(mape_centroid))
-        mean_mape_proportional.append(np.mean(mape_proportional))
-        
-    return {
-        'mean_estimate_centroid': mean_estimate_centroid,
-        'mean_estimate_proportional': mean_estimate_proportional,
-        'var_estimate_centroid': var_estimate_centroid,
-        'var_estimate_proportional': var_estimate_proportional,
-        'mean_mape_centroid': mean_mape_centroid,
-        'mean_mape_proportional': mean_mape_proportional
-    }
-
-def run_simulation_random_polygon_placement_and_grid_origin_2d(rate, x_range, y_range, trials, dg, dp, point_process):
+    - Lists containing mean and variance of estimates for both methods, and the
+      number of trials run for each point under 'trials'
+    """
+    return _run_simulation(
+        rate, x_range, y_range, trials, dg, dp, point_process, batch_size, n_jobs, seed, grid_free, common_random_numbers, store, target_relative_width, confidence, profile, polygons_per_realization, compact, sparse, generator_key,
+        scenario='random_polygon_placement', random_polygon=True, random_origin=False,
+    )
+
+def run_simulation_random_polygon_placement_and_grid_origin_2d(rate, x_range, y_range, trials, dg, dp, point_process, batch_size=None, n_jobs=1, seed=None, grid_free=False, common_random_numbers=False, store=None, target_relative_width=None, confidence=0.95, profile=False, polygons_per_realization=1, compact=False, sparse=False, generator_key=None):
     """
     Run a simulation to compare the performance of centroid and proportional allocation estimates.
     
@@ -145,56 +142,259 @@ def run_simulation_random_polygon_placement_and_grid_origin_2d(rate, x_range, y_
     - trials: Number of trials to run
     - dg: List of grid cell widths
     - dp: Polygon width
+    - point_process: Function (rate, x_range, y_range) returning the (n, 2) points of one realization
+
+    The keyword arguments are shared by the run_simulation_* functions and
+    documented in the module docstring.
 
     Returns:
-    - Lists containing mean and variance of estimates for both methods
-    """
-    # Run many iterations to get a distribution of the estimates
-    mean_estimate_centroid = []
-    var_estimate_centroid = []
-    mean_estimate_proportional = []
-    var_estimate_proportional = []
-    mean_mape_proportional = []
-    mean_mape_centroid = []
-    for grid_width, polygon_width in tqdm(zip(dg, dp),  total=len(dg)):
-        errors_centroid = []
-        errors_proportional = []
-        mape_centroid = []
-        mape_proportional = []
-        
-        for _ in range(trials):
+    - Lists containing mean and variance of estimates for both methods, and the
+      number of trials run for each point under 'trials'
+    """
+    return _run_simulation(
+        rate, x_range, y_range, trials, dg, dp, point_process, batch_size, n_jobs, seed, grid_free, common_random_numbers, store, target_relative_width, confidence, profile, polygons_per_realization, compact, sparse, generator_key,
+        scenario='random_polygon_placement_and_grid_origin', random_polygon=True, random_origin=True,
+    )
+
+def _run_simulation(rate, x_range, y_range, trials, dg, dp, point_process, batch_size, n_jobs, seed, grid_free, common_random_numbers, store, target_relative_width, confidence, profile, polygons_per_realization, compact, sparse, generator_key, scenario, random_polygon, random_origin):
+    """
+    Run a sweep of one of the simulation scenarios.
+
+    - random_polygon: Place the polygon uniformly at random instead of at the origin
+    - random_origin: Draw a random grid origin in [0, polygon_width) for every trial
+    - grid_free: Use the grid-free estimators, batch_size then only sets the size
+      of the blocks of trials
+    - common_random_numbers: Evaluate every realization at all the points of the sweep
+    - store: Result store directory or ResultStore
+    - generator_key: Name of point_process in the store keys, see result_store.describe_generator
+    - target_relative_width, confidence: Stopping rule of the adaptive mode
+    - profile: Record the stages of every point
+    - polygons_per_realization: Number of polygons evaluated against each realization,
+      batch_size then only sets the size of the blocks of trials
+    - compact: Store the counts with the smallest integer type that can hold them
+    - sparse: Grid into SparseCount, with the realizations evaluated one at a time
+    - scenario: Name of the scenario in the store keys
+    """
+    parameters = dict(
+        rate=rate, x_range=x_range, y_range=y_range, point_process=point_process,
+        random_polygon=random_polygon, random_origin=random_origin,
+    )
+    if common_random_numbers:
+        simulate_trials = partial(_simulate_trials_common, grid_free=grid_free, polygons_per_realization=polygons_per_realization, compact=compact, sparse=sparse, **parameters)
+    elif polygons_per_realization > 1:
+        simulate_trials = partial(_simulate_realizations, grid_free=grid_free, polygons_per_realization=polygons_per_realization, compact=compact, sparse=sparse, **parameters)
+    elif grid_free or sparse or batch_size is None:
+        simulate_trials = partial(_simulate_trials, grid_free=grid_free, compact=compact, sparse=sparse, **parameters)
+    else:
+        simulate_trials = partial(_simulate_trial_block, compact=compact, **parameters)
+    store = open_store(store)
+    store_fields = None
+    if store is not None:
+        generator, generator_parameters = describe_generator(point_process, generator_key)
+        store_fields = dict(
+            parameters, point_process=generator, generator_parameters=generator_parameters,
+            scenario=scenario, grid_free=grid_free, common_random_numbers=common_random_numbers,
+        )
+        if polygons_per_realization > 1:
+            store_fields['polygons_per_realization'] = polygons_per_realization
+    return run_sweep(
+        simulate_trials, dg, dp, trials, batch_size, n_jobs, seed, common_random_numbers, store, store_fields,
+        target_relative_width, confidence, profile,
+    )
+
+def _simulate_trials(grid_width, polygon_width, n, rate, x_range, y_range, point_process, random_polygon, random_origin, grid_free=False, compact=False, sparse=False):
+    """
+    Run n trials one at a time with the scalar (or grid-free) estimators.
+
+    Returns the actual value, centroid estimate and proportional estimate of each trial.
+    """
+    actual_value = np.empty(n)
+    estimate_centroid = np.empty(n)
+    estimate_proportional = np.empty(n)
+    for i in range(n):
+        with stage('generation'):
             # Generate polygon
-            polygon_start_x_offset = np.random.uniform(low=-1, high=0)
-            polygon_start_y_offset = np.random.uniform(low=-1, high=0)
-            
-            polygon_x_range = (polygon_start_x_offset, polygon_width + polygon_start_x_offset)
-            polygon_y_range = (polygon_start_y_offset, polygon_width + polygon_start_y_offset)
-            
+            polygon_start_x_offset = np.random.uniform(low=-1, high=0) if random_polygon else 0
+            polygon_start_y_offset = np.random.uniform(low=-1, high=0) if random_polygon else 0
+
+            data = point_process(rate, x_range, y_range)
+        actual_value[i], estimate_centroid[i], estimate_proportional[i] = _estimate(
+            data, grid_width, (polygon_start_x_offset, polygon_start_y_offset), polygon_width,
+            x_range, y_range, random_origin, grid_free, compact, sparse)
+    return actual_value, estimate_centroid, estimate_proportional
+
+def _simulate_realizations(grid_width, polygon_width, n, rate, x_range, y_range, point_process, random_polygon, random_origin, polygons_per_realization, grid_free=False, compact=False, sparse=False):
+    """
+    Run n trials as polygons_per_realization polygons on each realization.
+
+    The last realization has fewer polygons when n is not a multiple of
+    polygons_per_realization.
+    """
+    values = np.empty((3, n))
+    for first in range(0, n, polygons_per_realization):
+        n_polygons = min(polygons_per_realization, n - first)
+        with stage('generation'):
+            polygon_start = _draw_polygon_starts(n_polygons, random_polygon)
+
+            data = point_process(rate, x_range, y_range)
+        values[:, first:first + n_polygons] = _estimate_polygons(
+            data, grid_width, polygon_start, polygon_width, x_range, y_range, random_origin, grid_free, compact=compact, sparse=sparse)
+    return tuple(values)
+
+def _simulate_trials_common(dg, dp, n, random_states, rate, x_range, y_range, point_process, random_polygon, random_origin, grid_free=False, polygons_per_realization=1, compact=False, sparse=False):
+    """
+    Run n trials, each one evaluated at every (grid width, polygon width) point.
+
+    Returns one tuple (actual_value, estimate_centroid, estimate_proportional)
+    per point. The realizations and polygons are drawn from the global state,
+    and the grid of each point from its entry of random_states (see
+    simulation_engine.run_common_shard). Without random states, and with a
+    single point, the random numbers are drawn in the same order as in
+    _simulate_trials (or _simulate_realizations).
+    """
+    values = np.empty((len(dg), 3, n))
+    for first in range(0, n, polygons_per_realization):
+        n_polygons = min(polygons_per_realization, n - first)
+        with stage('generation'):
+            polygon_start = _draw_polygon_starts(n_polygons, random_polygon)
+
             data = point_process(rate, x_range, y_range)
-            count, xedges, yedges = create_gridded_data_2d(data, grid_width, x_range, y_range, range_of_variation=polygon_width)
-            actual_value = get_actual_value_2d(data, polygon_x_range, polygon_y_range)
-
-            estimate_centroid = centroid_allocation_estimate_2d(count, xedges, yedges, polygon_x_range, polygon_y_range)
-            estimate_proportional = proportional_allocation_estimate_2d(count, xedges, yedges, polygon_x_range, polygon_y_range)
-            errors_centroid.append(estimate_centroid - actual_value)
-            errors_proportional.append(estimate_proportional - actual_value)
-            if actual_value != 0:
-                mape_centroid.append(np.abs(estimate_centroid - actual_value) / actual_value * 100)
-                mape_proportional.append(np.abs(estimate_proportional - actual_value) / actual_value * 100)
-
-        # Calculate mean and variance of the estimates
-        mean_estimate_centroid.append(np.mean(errors_centroid))
-        var_estimate_centroid.append(np.var(errors_centroid))
-        mean_estimate_proportional.append(np.mean(errors_proportional))
-        var_estimate_proportional.append(np.var(errors_proportional))
-        mean_mape_centroid.append(np.mean(mape_centroid))
-        mean_mape_proportional.append(np.mean(mape_proportional))
-        
-    return {
-        'mean_estimate_centroid': mean_estimate_centroid,
-        'mean_estimate_proportional': mean_estimate_proportional,
-        'var_estimate_centroid': var_estimate_centroid,
-        'var_estimate_proportional': var_estimate_proportional,
-        'mean_mape_centroid': mean_mape_centroid,
-        'mean_mape_proportional': mean_mape_proportional
-    }
\ No newline at end of file
+        point_index = None
+        if not grid_free:
+            # The points are indexed once for all the points of the sweep
+            with stage('ground_truth'):
+                point_index = PointIndex2D(data)
+        for point, (grid_width, polygon_width) in enumerate(zip(dg, dp)):
+            with point_profile(point), point_random_state(random_states[point]):
+                values[point, :, first:first + n_polygons] = _estimate_polygons(
+                    data, grid_width, polygon_start, polygon_width, x_range, y_range, random_origin, grid_free, point_index, compact, sparse)
+    return [tuple(point_values) for point_values in values]
+
+def _draw_polygon_starts(n, random_polygon):
+    """
+    Lower left corners of n polygons, with shape (2, n). The x and y offsets of
+    each polygon are drawn one after the other, as in _simulate_trials.
+    """
+    if not random_polygon:
+        return np.zeros((2, n))
+    return np.random.uniform(low=-1, high=0, size=(n, 2)).T
+
+def _estimate(data, grid_width, polygon_start, polygon_width, x_range, y_range, random_origin, grid_free, compact=False, sparse=False):
+    """
+    Actual value, centroid estimate and proportional estimate of one realization.
+
+    With grid_free the ground truth is computed with the estimates, in the
+    estimation stage.
+    """
+    range_of_variation = polygon_width if random_origin else 0
+    polygon_x_range = (polygon_start[0], polygon_width + polygon_start[0])
+    polygon_y_range = (polygon_start[1], polygon_width + polygon_start[1])
+    if grid_free:
+        with stage('gridding'):
+            xedges = create_random_origin_bins_2d(x_range[0], x_range[1], grid_width, range_of_variation)
+            yedges = create_random_origin_bins_2d(y_range[0], y_range[1], grid_width, range_of_variation)
+        with stage('estimation'):
+            return grid_free_estimates_2d(data, xedges, yedges, polygon_x_range, polygon_y_range)
+
+    with stage('gridding'):
+        count, xedges, yedges = create_gridded_data_2d(data, grid_width, x_range, y_range, range_of_variation=range_of_variation, compact=compact, sparse=sparse)
+    with stage('ground_truth'):
+        actual_value = get_actual_value_2d(data, polygon_x_range, polygon_y_range)
+    with stage('estimation'):
+        estimate_centroid = centroid_allocation_estimate_2d(count, xedges, yedges, polygon_x_range, polygon_y_range)
+        estimate_proportional = proportional_allocation_estimate_2d(count, xedges, yedges, polygon_x_range, polygon_y_range)
+    return actual_value, estimate_centroid, estimate_proportional
+
+def _estimate_polygons(data, grid_width, polygon_start, polygon_width, x_range, y_range, random_origin, grid_free, point_index=None, compact=False, sparse=False):
+    """
+    Actual values, centroid estimates and proportional estimates of an array of
+    squares with lower left corners polygon_start (shape (2, n)) on one
+    realization, which is gridded once.
+
+    The estimates of all the squares come from one GridIndex2D, and the actual
+    values from point_index, a PointIndex2D of the data built here if not given.
+    The grid-free estimators, and the estimators of a sparse grid, are
+    evaluated one square at a time.
+    """
+    range_of_variation = polygon_width if random_origin else 0
+    polygon_x_range = (polygon_start[0], polygon_start[0] + polygon_width)
+    polygon_y_range = (polygon_start[1], polygon_start[1] + polygon_width)
+    if grid_free:
+        with stage('gridding'):
+            xedges = create_random_origin_bins_2d(x_range[0], x_range[1], grid_width, range_of_variation)
+            yedges = create_random_origin_bins_2d(y_range[0], y_range[1], grid_width, range_of_variation)
+        with stage('estimation'):
+            return np.array([
+                grid_free_estimates_2d(data, xedges, yedges, (x_start, x_end), (y_start, y_end))
+                for x_start, x_end, y_start, y_end in zip(*polygon_x_range, *polygon_y_range)
+            ]).reshape(-1, 3).T
+
+    with stage('gridding'):
+        count, xedges, yedges = create_gridded_data_2d(data, grid_width, x_range, y_range, range_of_variation=range_of_variation, compact=compact, sparse=sparse)
+    with stage('ground_truth'):
+        if point_index is None:
+            point_index = PointIndex2D(data)
+        actual_value = point_index.get_actual_value(polygon_x_range, polygon_y_range)
+    with stage('estimation'):
+        if sparse:
+            estimate_centroid = np.array([
+                centroid_allocation_estimate_2d(count, xedges, yedges, (x_start, x_end), (y_start, y_end))
+                for x_start, x_end, y_start, y_end in zip(*polygon_x_range, *polygon_y_range)
+            ])
+            estimate_proportional = np.array([
+                proportional_allocation_estimate_2d(count, xedges, yedges, (x_start, x_end), (y_start, y_end))
+                for x_start, x_end, y_start, y_end in zip(*polygon_x_range, *polygon_y_range)
+            ])
+            return actual_value, estimate_centroid, estimate_proportional
+        index = GridIndex2D(count, xedges, yedges)
+        estimate_centroid = index.centroid_allocation(polygon_x_range, polygon_y_range)
+        estimate_proportional = index.proportional_allocation(polygon_x_range, polygon_y_range)
+    return actual_value, estimate_centroid, estimate_proportional
+
+def _simulate_trial_block(grid_width, polygon_width, n, rate, x_range, y_range, point_process, random_polygon, random_origin, compact=False):
+    """
+    Run n trials as a batch with the batched estimators.
+
+    The polygons and the grid origins of the batch are each drawn at once, and
+    so are the realizations when point_process has a batch sampler (see
+    point_processes_2d.BATCH_SAMPLERS). The trials therefore differ from those
+    of _simulate_trials for the same seed, but have the same distribution.
+    """
+    # Keep the histograms of one batch within MAX_BATCH_CELLS. Only the window
+    # of cells holding the polygon of each trial is counted.
+    n_cells = (polygon_width / grid_width + 2) ** 2
+    max_trials = max(1, int(MAX_BATCH_CELLS // n_cells))
+    if n > max_trials:
+        blocks = [_simulate_trial_block(grid_width, polygon_width, size, rate, x_range, y_range, point_process, random_polygon, random_origin, compact)
+                  for size in get_block_sizes(n, max_trials)]
+        return tuple(np.concatenate(values) for values in zip(*blocks))
+
+    range_of_variation = polygon_width if random_origin else 0
+    # The grid origins are drawn with the realizations, in the generation stage
+    with stage('generation'):
+        if random_polygon:
+            polygon_start_x = np.random.uniform(low=-1, high=0, size=n)
+            polygon_start_y = np.random.uniform(low=-1, high=0, size=n)
+        else:
+            polygon_start_x = polygon_start_y = np.zeros(n)
+        sample_batch = BATCH_SAMPLERS.get(point_process)
+        if sample_batch is None:
+            data, trial_index = stack_trials([point_process(rate, x_range, y_range) for _ in range(n)])
+        else:
+            data, trial_index = sample_batch(n, rate, x_range, y_range)
+        binx = create_random_origin_bins_2d_batch(n, x_range[0], x_range[1], grid_width, range_of_variation)
+        biny = create_random_origin_bins_2d_batch(n, y_range[0], y_range[1], grid_width, range_of_variation)
+    polygon_x_range = (polygon_start_x, polygon_start_x + polygon_width)
+    polygon_y_range = (polygon_start_y, polygon_start_y + polygon_width)
+
+    with stage('gridding'):
+        data = data.reshape(-1, 2)
+        window = (polygon_x_range, polygon_y_range)
+        count, xedges, yedges = create_gridded_data_2d_batch(data, trial_index, n, binx, biny, compact, window=window)
+    with stage('ground_truth'):
+        actual_value = get_actual_value_2d_batch(data, trial_index, n, polygon_x_range, polygon_y_range)
+
+    with stage('estimation'):
+        estimate_centroid = centroid_allocation_estimate_2d_batch(count, xedges, yedges, polygon_x_range, polygon_y_range)
+        estimate_proportional = proportional_allocation_estimate_2d_batch(count, xedges, yedges, polygon_x_range, polygon_y_range)
+    return actual_value, estimate_centroid, estimate_proportional
@@ -0,0 +1,535 @@
+from concurrent.futures import ProcessPoolExecutor
+import collections
+import contextlib
+import functools
+import os
+from statistics import NormalDist
+import time
+import tracemalloc
+from tqdm import tqdm
+import numpy as np
+
+# Keys of the results dict returned by every run_simulation_* function
+RESULT_KEYS = (
+    'mean_estimate_centroid',
+    'mean_estimate_proportional',
+    'var_estimate_centroid',
+    'var_estimate_proportional',
+    'mean_mape_centroid',
+    'mean_mape_proportional',
+)
+
+# Block size of the adaptive mode of run_sweep when no batch_size is given
+ADAPTIVE_BATCH_SIZE = 100
+
+def get_block_sizes(trials, batch_size=None):
+    """
+    Split a number of trials into blocks of at most batch_size trials.
+
+    With batch_size=None all the trials form a single block.
+    """
+    if batch_size is None or batch_size >= trials:
+        return [trials]
+    sizes = [batch_size] * (trials // batch_size)
+    if trials % batch_size:
+        sizes.append(trials % batch_size)
+    return sizes
+
+class RunningMoments:
+    """
+    Count, mean and sum of squared deviations of a stream of values.
+
+    Blocks of values are folded in with update and accumulators of different
+    blocks or shards are combined with merge (Chan et al.'s pairwise update),
+    so the memory used does not grow with the number of values.
+    """
+    def __init__(self):
+        self.count = 0
+        self._mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, values):
+        """
+        Add an array of values.
+        """
+        values = np.asarray(values, dtype=float)
+        if len(values) == 0:
+            return self
+        block = RunningMoments()
+        block.count = len(values)
+        block._mean = np.mean(values)
+        block.m2 = np.sum((values - block._mean)**2)
+        return self.merge(block)
+
+    def merge(self, other):
+        """
+        Add the values summarized by another RunningMoments.
+        """
+        if other.count == 0:
+            return self
+        count = self.count + other.count
+        delta = other._mean - self._mean
+        self._mean = self._mean + delta * other.count / count
+        self.m2 = self.m2 + other.m2 + delta**2 * self.count * other.count / count
+        self.count = count
+        return self
+
+    @property
+    def mean(self):
+        return self._mean if self.count else np.nan
+
+    @property
+    def variance(self):
+        """
+        Population variance, as np.var.
+        """
+        return self.m2 / self.count if self.count else np.nan
+
+class ErrorAccumulator:
+    """
+    Running error statistics of the centroid and proportional estimates.
+
+    Keeps the moments of the errors and of the absolute percentage errors of
+    both methods. The MAPE only counts the trials with a non-zero actual value.
+    """
+    def __init__(self):
+        self.errors_centroid = RunningMoments()
+        self.errors_proportional = RunningMoments()
+        self.mape_centroid = RunningMoments()
+        self.mape_proportional = RunningMoments()
+
+    def update(self, actual_value, estimate_centroid, estimate_proportional):
+        """
+        Add the results of a block of trials.
+        """
+        actual_value = np.asarray(actual_value)
+        errors_centroid = np.asarray(estimate_centroid) - actual_value
+        errors_proportional = np.asarray(estimate_proportional) - actual_value
+        self.errors_centroid.update(errors_centroid)
+        self.errors_proportional.update(errors_proportional)
+
+        nonzero = actual_value != 0
+        self.mape_centroid.update(np.abs(errors_centroid[nonzero]) / actual_value[nonzero] * 100)
+        self.mape_proportional.update(np.abs(errors_proportional[nonzero]) / actual_value[nonzero] * 100)
+        return self
+
+    def merge(self, other):
+        """
+        Add the statistics of another ErrorAccumulator.
+        """
+        self.errors_centroid.merge(other.errors_centroid)
+        self.errors_proportional.merge(other.errors_proportional)
+        self.mape_centroid.merge(other.mape_centroid)
+        self.mape_proportional.merge(other.mape_proportional)
+        return self
+
+    @property
+    def trials(self):
+        return self.errors_centroid.count
+
+    def summary(self):
+        """
+        Dict with one value for each of RESULT_KEYS.
+        """
+        return {
+            'mean_estimate_centroid': self.errors_centroid.mean,
+            'mean_estimate_proportional': self.errors_proportional.mean,
+            'var_estimate_centroid': self.errors_centroid.variance,
+            'var_estimate_proportional': self.errors_proportional.variance,
+            'mean_mape_centroid': self.mape_centroid.mean,
+            'mean_mape_proportional': self.mape_proportional.mean,
+        }
+
+def run_sweep(simulate_trials, dg, dp, trials, batch_size=None, n_jobs=1, seed=None, common_random_numbers=False,
+              store=None, store_fields=None, target_relative_width=None, confidence=0.95, profile=False):
+    """
+    Run the trials of every (grid width, polygon width) point of a sweep.
+
+    The sweep is split into shards of one sweep point and one block of trials.
+    With a seed, every shard draws from its own stream spawned from
+    np.random.SeedSequence(seed), so the results for a given seed do not depend
+    on n_jobs. Without a seed and with n_jobs=1 the global np.random state is used.
+
+    Parameters:
+    - simulate_trials: Function (grid_width, polygon_width, n) returning the arrays
+      (actual_value, estimate_centroid, estimate_proportional) of n trials
+    - dg: List of grid cell widths
+    - dp: List of polygon widths
+    - trials: Number of trials to run for each point of the sweep, or the maximum
+      number of trials with target_relative_width
+    - batch_size: Maximum number of trials passed to simulate_trials at once
+    - n_jobs: Number of worker processes, -1 for one per CPU. With more than one
+      process simulate_trials (and the point process) must be picklable, i.e.
+      module-level functions or functools.partial objects rather than lambdas.
+    - seed: Seed of the SeedSequence the shard streams are spawned from
+    - common_random_numbers: Shard the sweep by block of trials only. simulate_trials
+      is then called as (dg, dp, n, random_states) and returns one tuple of arrays
+      per sweep point, so that the same realizations can be evaluated at every
+      point. The numbers drawn for a single point, such as its random grid
+      origins, should be drawn with point_random_state from its entry of
+      random_states (see run_common_shard), so that they do not depend on the
+      other points of the shard.
+    - store: ResultStore (see result_store) the points are read from and written to.
+      Points found in the store are not simulated again, and every other point is
+      written as soon as all its trials are done.
+    - store_fields: Dict of the fields, besides the grid width, polygon width,
+      trials, batch size, seed and stopping rule, that identify the sweep in the store
+    - target_relative_width: If given, the trials of every point are run one block
+      of batch_size (ADAPTIVE_BATCH_SIZE by default) at a time, until the point
+      has_converged or has run all its trials.
+    - confidence: Confidence level of the intervals of has_converged
+    - profile: Record the stages of the simulation (see stage and profiling)
+
+    Returns:
+    - Dict of lists with the statistics of each point of the sweep, and the
+      number of trials run for each point under 'trials'. With profile, 'profile'
+      holds a dict with the StageProfile.as_dict of every point under 'points',
+      that of the stages shared by all points (generation, with common random
+      numbers) under 'shared' and their sum under 'total'.
+    """
+    adaptive = target_relative_width is not None
+    if adaptive and batch_size is None:
+        batch_size = min(trials, ADAPTIVE_BATCH_SIZE)
+
+    accumulators = [ErrorAccumulator() for _ in dg]
+    keys = [None] * len(dg)
+    fields = [None] * len(dg)
+    todo = list(range(len(dg)))
+    if store is not None:
+        todo = []
+        for point, (grid_width, polygon_width) in enumerate(zip(dg, dp)):
+            fields[point] = dict(
+                store_fields or {}, grid_width=grid_width, polygon_width=polygon_width,
+                trials=trials, batch_size=batch_size, seed=seed,
+            )
+            if adaptive:
+                fields[point].update(target_relative_width=target_relative_width, confidence=confidence)
+            keys[point] = store.make_key(**fields[point])
+            stored = store.get(keys[point])
+            if stored is None:
+                todo.append(point)
+            else:
+                accumulators[point] = stored
+
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    if seed is None and n_jobs > 1:
+        # Forked workers would otherwise share the same global random state
+        seed = np.random.SeedSequence()
+
+    # The streams of all the blocks are spawned up front, so they do not depend
+    # on how the blocks are scheduled. Points are seeded by their grid and polygon
+    # widths (see get_point_seed), also within the shards of common random
+    # numbers, so a point gets the same results, and the same store key, whatever
+    # other points the sweep has and in whichever order.
+    block_sizes = get_block_sizes(trials, batch_size)
+    if seed is not None and not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    if common_random_numbers:
+        common_seeds = spawn_seeds(seed, len(block_sizes))
+        run = functools.partial(run_common_shard, simulate_trials, profile=profile)
+    else:
+        block_seeds = {
+            point: get_point_seed(seed, dg[point], dp[point]).spawn(len(block_sizes)) if seed is not None else [None] * len(block_sizes)
+            for point in todo
+        }
+        run = functools.partial(run_shard, simulate_trials, profile=profile)
+
+    # Every round runs all the blocks of the remaining points, or only their next
+    # block in adaptive mode
+    blocks_done = {point: 0 for point in todo}
+    point_profiles = [StageProfile() for _ in dg]
+    shared_profile = StageProfile()
+    active = todo
+    while active:
+        shards = []
+        shard_points = []
+        if common_random_numbers:
+            first = blocks_done[active[0]]
+            for block in ([first] if adaptive else range(len(block_sizes))):
+                shard_points.append(active)
+                shards.append(([dg[point] for point in active], [dp[point] for point in active], block_sizes[block], common_seeds[block]))
+        else:
+            for point in active:
+                first = blocks_done[point]
+                for block in ([first] if adaptive else range(len(block_sizes))):
+                    shard_points.append([point])
+                    shards.append((dg[point], dp[point], block_sizes[block], block_seeds[point][block]))
+
+        # Merge the accumulators of every sweep point, in shard order
+        remaining = collections.Counter(point for points in shard_points for point in points)
+        finished = []
+        for points, output in zip(shard_points, _run_shards(run, shards, n_jobs)):
+            if profile:
+                output, shard_profile = output
+                if common_random_numbers:
+                    shared_profile.merge(shard_profile, include_points=False)
+                    for i, point in enumerate(points):
+                        point_profiles[point].merge(shard_profile.point(i))
+                else:
+                    point_profiles[points[0]].merge(shard_profile)
+            for point, accumulator in zip(points, output if common_random_numbers else [output]):
+                accumulators[point].merge(accumulator)
+                blocks_done[point] += 1
+                remaining[point] -= 1
+                if remaining[point] > 0:
+                    continue
+                done = blocks_done[point] == len(block_sizes)
+                if done or (adaptive and has_converged(accumulators[point], target_relative_width, confidence)):
+                    finished.append(point)
+                    if store is not None:
+                        store.put(keys[point], accumulators[point], **fields[point])
+        active = [point for point in active if point not in finished]
+
+    results = {key: [] for key in RESULT_KEYS}
+    for accumulator in accumulators:
+        summary = accumulator.summary()
+        for key in RESULT_KEYS:
+            results[key].append(summary[key])
+    results['trials'] = [accumulator.trials for accumulator in accumulators]
+    if profile:
+        total = StageProfile().merge(shared_profile)
+        for stages in point_profiles:
+            total.merge(stages)
+        results['profile'] = {
+            'points': [stages.as_dict() for stages in point_profiles],
+            'shared': shared_profile.as_dict(),
+            'total': total.as_dict(),
+        }
+    return results
+
+def has_converged(accumulator, target_relative_width, confidence=0.95):
+    """
+    Whether the confidence intervals on the mean errors and mean MAPEs of both
+    methods are narrower than target_relative_width.
+
+    The width of the interval on a mean MAPE is relative to the MAPE. The mean
+    errors are often close to zero, so the width of their interval is relative
+    to the root mean squared error instead.
+    """
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    for moments in [accumulator.errors_centroid, accumulator.errors_proportional]:
+        if moments.count < 2:
+            return False
+        scale = np.sqrt(moments.mean**2 + moments.variance)
+        if 2 * z * np.sqrt(moments.m2 / (moments.count - 1) / moments.count) > target_relative_width * scale:
+            return False
+    for moments in [accumulator.mape_centroid, accumulator.mape_proportional]:
+        if moments.count < 2:
+            return False
+        if 2 * z * np.sqrt(moments.m2 / (moments.count - 1) / moments.count) > target_relative_width * abs(moments.mean):
+            return False
+    return True
+
+def _run_shards(run, shards, n_jobs):
+    """
+    Yield the outputs of run for every shard, in order.
+    """
+    if not shards:
+        return
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            yield from tqdm(executor.map(run, *zip(*shards)), total=len(shards))
+    else:
+        for shard in tqdm(shards):
+            yield run(*shard)
+
+def spawn_seeds(seed, n):
+    """
+    Spawn n independent SeedSequences from seed, or n times None without a seed.
+    """
+    if seed is None:
+        return [None] * n
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    return seed.spawn(n)
+
+def run_shard(simulate_trials, grid_width, polygon_width, n, seed=None, profile=False):
+    """
+    Run one block of trials and return its ErrorAccumulator, and its
+    StageProfile if profile is set.
+    """
+    with seeded_random_state(seed), profiling(profile) as shard_profile:
+        accumulator = ErrorAccumulator().update(*simulate_trials(grid_width, polygon_width, n))
+    return (accumulator, shard_profile) if profile else accumulator
+
+def run_common_shard(simulate_trials, dg, dp, n, seed=None, profile=False):
+    """
+    Run one block of trials at the (grid width, polygon width) points of the
+    sweep and return one ErrorAccumulator per point, and the StageProfile if
+    profile is set.
+
+    The realizations are drawn from the stream of the block. With a seed, every
+    point also gets a np.random.RandomState of its own, seeded from the seed of
+    the block and the widths of the point (see get_point_seed), for the numbers
+    drawn for that point alone. These do not depend on which other points are
+    in the shard, e.g. when the others were read from a store.
+    Without a seed the random states are None.
+    """
+    random_states = [None if seed is None else np.random.RandomState(get_point_seed(seed, grid_width, polygon_width).generate_state(4)) for grid_width, polygon_width in zip(dg, dp)]
+    with seeded_random_state(seed), profiling(profile) as shard_profile:
+        accumulators = [ErrorAccumulator().update(*values) for values in simulate_trials(dg, dp, n, random_states)]
+    return (accumulators, shard_profile) if profile else accumulators
+
+def get_point_seed(seed, grid_width, polygon_width):
+    """
+    SeedSequence of the sweep point (grid_width, polygon_width) within the
+    stream of seed. Its spawn key extends that of seed with the bits of the two
+    widths as float64, so it depends on the values identifying the point in a
+    store rather than on its position in the sweep, and is the same whatever
+    else is drawn from seed.
+    """
+    widths = np.array([grid_width, polygon_width], dtype=np.float64)
+    return np.random.SeedSequence(seed.entropy, spawn_key=seed.spawn_key + tuple(int(bits) for bits in widths.view(np.uint64)), pool_size=seed.pool_size)
+
+@contextlib.contextmanager
+def point_random_state(random_state=None):
+    """
+    Draw from random_state, a np.random.RandomState, instead of the global
+    np.random state inside the context, and leave random_state advanced by the
+    numbers drawn. Does nothing without a random_state.
+    """
+    if random_state is None:
+        yield
+        return
+    state = np.random.get_state()
+    np.random.set_state(random_state.get_state())
+    try:
+        yield
+    finally:
+        random_state.set_state(np.random.get_state())
+        np.random.set_state(state)
+
+@contextlib.contextmanager
+def seeded_random_state(seed=None):
+    """
+    Seed the global np.random state from a SeedSequence, restoring it on exit.
+
+    The generators and gridding functions draw from the global state, so it is
+    seeded for the duration of a shard. Does nothing without a seed.
+    """
+    if seed is None:
+        yield
+        return
+    state = np.random.get_state()
+    np.random.seed(seed.generate_state(4))
+    try:
+        yield
+    finally:
+        np.random.set_state(state)
+
+class StageProfile:
+    """
+    Wall time, peak traced memory and number of calls of each stage of a simulation.
+
+    Stages recorded for one point of a sweep evaluated with common random numbers
+    go to the child profile points[i] of its position i in the shard.
+    """
+    def __init__(self):
+        self.stages = {}
+        self.points = {}
+
+    def record(self, name, seconds, peak_memory):
+        """
+        Add one call of a stage.
+        """
+        time, peak, calls = self.stages.get(name, (0.0, 0, 0))
+        self.stages[name] = (time + seconds, max(peak, peak_memory), calls + 1)
+
+    def point(self, i):
+        """
+        Child profile of the point at position i.
+        """
+        return self.points.setdefault(i, StageProfile())
+
+    def merge(self, other, include_points=True):
+        """
+        Add the stages of another StageProfile, and of its children if include_points.
+        """
+        for name, (time, peak, calls) in other.stages.items():
+            total_time, total_peak, total_calls = self.stages.get(name, (0.0, 0, 0))
+            self.stages[name] = (total_time + time, max(total_peak, peak), total_calls + calls)
+        if include_points:
+            for child in other.points.values():
+                self.merge(child)
+        return self
+
+    def as_dict(self):
+        """
+        Dict of stage name to a dict with the total 'time' in seconds, the
+        'peak_memory' in bytes and the number of 'calls'.
+        """
+        return {
+            name: {'time': time, 'peak_memory': peak, 'calls': calls}
+            for name, (time, peak, calls) in self.stages.items()
+        }
+
+# StageProfile recording the stages, None when profiling is off
+_active_profile = None
+_no_stage = contextlib.nullcontext()
+
+def stage(name):
+    """
+    Context manager recording the wall time and peak memory of a stage in the
+    active profile. When profiling is off it is a shared no-op context, so the
+    stages can stay in the simulation code at negligible cost.
+    """
+    if _active_profile is None:
+        return _no_stage
+    return _record_stage(_active_profile, name)
+
+@contextlib.contextmanager
+def _record_stage(profile, name):
+    tracemalloc.reset_peak()
+    start_memory = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        profile.record(name, seconds, tracemalloc.get_traced_memory()[1] - start_memory)
+
+@contextlib.contextmanager
+def point_profile(i):
+    """
+    Record the stages inside the context for the point at position i of a shard.
+    """
+    global _active_profile
+    if _active_profile is None:
+        yield
+        return
+    parent = _active_profile
+    _active_profile = parent.point(i)
+    try:
+        yield
+    finally:
+        _active_profile = parent
+
+@contextlib.contextmanager
+def profiling(enabled=True):
+    """
+    Record the stages run inside the context in a new StageProfile, whose 'shard'
+    stage is the whole context. Memory is traced with tracemalloc, which slows
+    down allocations. Yields None when not enabled.
+    """
+    global _active_profile
+    if not enabled:
+        yield None
+        return
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    parent = _active_profile
+    profile = StageProfile()
+    _active_profile = profile
+    start = time.perf_counter()
+    try:
+        yield profile
+    finally:
+        # The stages reset the traced peak, so the peak of the shard is that of its stages
+        seconds = time.perf_counter() - start
+        peak_memory = max([peak for _, peak, _ in StageProfile().merge(profile).stages.values()], default=0)
+        profile.record('shard', seconds, peak_memory)
+        _active_profile = parent
+        if started:
+            tracemalloc.stop()
@@ -0,0 +1,16 @@
+import importlib
+import sys
+import os
+
+# The modules in src import each other as src.<module>, so the repository root
+# has to be importable as well as src itself
+root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, root)
+
+# The tests import the modules by their plain names (with src on sys.path).
+# Register the src.<module> ones under those names as well, so that a process
+# holds a single copy of every module, and with it of every class and cache.
+for filename in sorted(os.listdir(os.path.join(root, 'src'))):
+    name, extension = os.path.splitext(filename)
+    if extension == '.py' and name != '__init__':
+        sys.modules.setdefault(name, importlib.import_module(f'src.{name}'))
@@ -5,8 +5,22 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../s
 from aggregation_1d import (
     get_actual_value,
     proportional_allocation_estimate,
-    centroid_allocation_estimate
+    centroid_allocation_estimate,
+    GridIndex1D,
+    PointIndex1D,
+    create_bins,
+    create_random_origin_bins,
+    stack_trials,
+    pad_edges,
+    histogram,
+    create_random_origin_bins_batch,
+    create_gridded_data_batch,
+    get_actual_value_batch,
+    centroid_allocation_estimate_batch,
+    proportional_allocation_estimate_batch,
 )
+from binning import get_arithmetic_bin_index, get_bin_index, is_regular_edges
+from aggregation_nd import centroid_allocation_estimate_nd, proportional_allocation_estimate_nd
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -71,4 +85,210 @@ def test_centroid_allocation_estimate():
     edges3 = np.array([0.0, 0.2, 0.4, 0.6])
     polygon3 = [0.15, 0.45]
     result3 = centroid_allocation_estimate(count3, edges3, polygon3[0], polygon3[1])
-    assert np.isclose(result3, 3), f"Expected 3, but got {result3}"
\ No newline at end of file
+    assert np.isclose(result3, 3), f"Expected 3, but got {result3}"
+
+def test_proportional_allocation_estimate_non_uniform_edges():
+    """
+    Test proportional allocation with cells of different widths and with a
+    polygon that lies within a single cell.
+    """
+    count = np.array([2, 3, 5])
+    edges = np.array([0.0, 0.1, 0.4, 0.6])
+
+    result1 = proportional_allocation_estimate(count, edges, 0.05, 0.25)
+    truth1 = 2 * 0.5 + 3 * 0.5
+    assert np.isclose(result1, truth1), f"Expected {truth1}, but got {result1}"
+
+    result2 = proportional_allocation_estimate(count, edges, 0.15, 0.2)
+    truth2 = 3 * 0.05 / 0.3
+    assert np.isclose(result2, truth2), f"Expected {truth2}, but got {result2}"
+
+    result3 = proportional_allocation_estimate(count, edges, -1, 2)
+    assert np.isclose(result3, 10), f"Expected 10, but got {result3}"
+
+def test_estimates_match_nd_estimates():
+    """
+    Test the 1D estimators against the n-dimensional ones, for intervals inside,
+    across and outside of a grid with a cell without width.
+    """
+    np.random.seed(30)
+    edges = create_random_origin_bins(0.1, 0, 1, 0.5)
+    edges = np.concatenate((edges, [edges[-1], edges[-1] + 0.2]))
+    count = np.random.poisson(4, len(edges) - 1)
+    count[np.diff(edges) == 0] = 0
+    bounds = np.random.uniform(-0.5, 1.5, (200, 2))
+    bounds = np.concatenate((bounds, [[0.3, 0.3], [0.7, 0.2], [-1, -0.5], [2, 3], [edges[3], edges[5]]]))
+    for start, end in bounds:
+        expected = centroid_allocation_estimate_nd(count, [edges], [(start, end)])
+        assert centroid_allocation_estimate(count, edges, start, end) == expected
+        expected = proportional_allocation_estimate_nd(count, [edges], [(start, end)])
+        assert np.isclose(proportional_allocation_estimate(count, edges, start, end), expected)
+
+def test_grid_index_1d_batched_queries():
+    """
+    Test that GridIndex1D answers arrays of intervals like the scalar functions.
+    """
+    np.random.seed(3)
+    count, edges = np.histogram(np.random.uniform(-3, 4, 500), bins=create_random_origin_bins(0.07, -3, 4, 0.5))
+    index = GridIndex1D(count, edges)
+    polygon_start = np.random.uniform(-4, 4, 200)
+    polygon_end = polygon_start + np.random.uniform(0, 1, 200)
+
+    centroid = index.centroid_allocation(polygon_start, polygon_end)
+    proportional = index.proportional_allocation(polygon_start, polygon_end)
+
+    # Brute force overlap of every cell with every polygon
+    overlap = np.clip(np.minimum(edges[1:], polygon_end[:, None]) - np.maximum(edges[:-1], polygon_start[:, None]), 0, None)
+    expected_proportional = overlap / np.diff(edges) @ count
+    for i in range(len(polygon_start)):
+        expected = centroid_allocation_estimate(count, edges, polygon_start[i], polygon_end[i])
+        assert centroid[i] == expected, f"Interval {i}. Expected {expected}, but got {centroid[i]}"
+    assert np.allclose(proportional, expected_proportional)
+
+def test_get_bin_index():
+    """
+    Test that get_bin_index matches np.histogram, including points on the edges.
+    """
+    np.random.seed(0)
+    for bins in [create_bins(0.01, -3, 4), create_bins(0.3, 0, 1), create_random_origin_bins(0.01, -3, 4, 0.5)]:
+        data = np.concatenate((np.random.uniform(-4, 5, 1000), bins))
+        index = get_bin_index(data, bins)
+        count = np.bincount(index[index >= 0], minlength=len(bins) - 1)
+        expected, _ = np.histogram(data, bins=bins)
+        assert np.array_equal(count, expected), f"Histogram mismatch for {len(bins) - 1} bins"
+
+def test_get_bin_index_per_trial_edges():
+    """
+    Test get_bin_index with padded per-trial edges against np.searchsorted,
+    for random origin grids and for irregular grids, which need the binary
+    search fallback, including points on the edges and outside them.
+    """
+    np.random.seed(3)
+    bins = [create_random_origin_bins(0.01, -1, 2, 0.5), create_random_origin_bins(0.3, -1, 2, 0.5),
+            np.cumsum(np.random.uniform(0.01, 1, 40)) - 3, np.array([0, 0.1, 0.15, 0.4, 0.5, 1])]
+    samples = []
+    for edges in bins:
+        on_edges = np.random.choice(edges, 50)
+        samples.append(np.concatenate((np.random.uniform(edges[0] - 1, edges[-1] + 1, 500), on_edges, np.nextafter(on_edges, -np.inf), [np.nan, np.inf])))
+    data, trial_index = stack_trials(samples)
+    index = get_bin_index(data, pad_edges(bins), trial_index, chunk_size=333)
+    for i, edges in enumerate(bins):
+        points = samples[i]
+        expected = np.minimum(np.searchsorted(edges, points, side='right') - 1, len(edges) - 2)
+        expected[~((points >= edges[0]) & (points <= edges[-1]))] = -1
+        assert np.array_equal(index[trial_index == i], expected), f"Trial {i}. Bin index mismatch"
+
+def test_histogram_matches_numpy():
+    """
+    Test that histogram matches np.histogram for regular and irregular edges,
+    coarse and fine enough to be binned arithmetically, including points on
+    and next to the edges.
+    """
+    np.random.seed(2)
+    irregular = np.array([0, 0.1, 0.15, 0.4, 0.5, 1])
+    fine_irregular = np.cumsum(np.random.uniform(0.5, 1.5, 3000)) / 1000
+    all_bins = [create_bins(0.01, -1, 2), create_bins(2, 0, 1), create_random_origin_bins(0.013, -1, 2, 0.5), irregular,
+                create_bins(0.001, -1, 2), create_random_origin_bins(0.0013, -1, 2, 0.5), fine_irregular]
+    for bins in all_bins:
+        on_edges = np.random.choice(bins, min(len(bins), 1000), replace=False)
+        data = np.concatenate((np.random.uniform(-2, 3, 1000), on_edges, np.nextafter(on_edges, -np.inf), np.nextafter(on_edges, np.inf)))
+        hist, edges = histogram(data, bins)
+        expected, expected_edges = np.histogram(data, bins=bins)
+        assert np.array_equal(hist, expected) and hist.dtype == expected.dtype
+        assert np.array_equal(edges, expected_edges)
+    assert is_regular_edges(all_bins[2])
+    assert not is_regular_edges(irregular)
+    assert np.array_equal(get_arithmetic_bin_index(data, all_bins[5]), get_bin_index(data, all_bins[5]))
+    assert get_arithmetic_bin_index(data, fine_irregular) is None
+
+def test_batch_estimates_match_scalar_estimates():
+    """
+    Test the batched functions against the scalar ones on random trials, with
+    lists of per-trial edges and with RandomOriginEdges.
+    """
+    np.random.seed(1)
+    n_trials = 50
+    samples = [np.random.uniform(-3, 4, np.random.poisson(100)) for _ in range(n_trials)]
+    # Points outside of the edges
+    samples[3] = np.append(samples[3], [-3.5, 4.2])
+    polygon_start = np.random.uniform(-1, 2, n_trials)
+    polygon_end = polygon_start + np.random.uniform(0.01, 0.5, n_trials)
+    # Polygon past the end of the grid
+    polygon_start[5], polygon_end[5] = 3.8, 4.5
+    # Both draw the same origins
+    state = np.random.get_state()
+    bins = [create_random_origin_bins(0.07, -3, 4, 0.5) for _ in range(n_trials)]
+    np.random.set_state(state)
+    random_origin_edges = create_random_origin_bins_batch(n_trials, 0.07, -3, 4, 0.5)
+    rows = np.arange(n_trials)[:, None]
+    assert np.allclose(random_origin_edges[rows, np.arange(random_origin_edges.shape[1])], pad_edges(bins))
+
+    data, trial_index = stack_trials(samples)
+    for trial_bins in [bins, random_origin_edges]:
+        count, edges = create_gridded_data_batch(data, trial_index, n_trials, trial_bins)
+        actual = get_actual_value_batch(data, trial_index, n_trials, polygon_start, polygon_end)
+        centroid = centroid_allocation_estimate_batch(count, edges, polygon_start, polygon_end)
+        proportional = proportional_allocation_estimate_batch(count, edges, polygon_start, polygon_end)
+
+        for i in range(n_trials):
+            count_i, edges_i = np.histogram(samples[i], bins=bins[i])
+            assert np.array_equal(count[i, :len(count_i)], count_i), f"Trial {i}. Histogram mismatch"
+            assert actual[i] == get_actual_value(samples[i], polygon_start[i], polygon_end[i]), f"Trial {i}. Actual value mismatch"
+            expected = centroid_allocation_estimate(count_i, edges_i, polygon_start[i], polygon_end[i])
+            assert np.isclose(centroid[i], expected), f"Trial {i}. Expected {expected}, but got {centroid[i]}"
+            expected = proportional_allocation_estimate(count_i, edges_i, polygon_start[i], polygon_end[i])
+            assert np.isclose(proportional[i], expected), f"Trial {i}. Expected {expected}, but got {proportional[i]}"
+
+        # Counting only the windows of cells holding the polygons gives the same estimates
+        count, edges = create_gridded_data_batch(data, trial_index, n_trials, trial_bins, window=(polygon_start, polygon_end))
+        assert count.shape[1] <= 0.5 / 0.07 + 2
+        assert np.allclose(centroid_allocation_estimate_batch(count, edges, polygon_start, polygon_end), centroid)
+        assert np.allclose(proportional_allocation_estimate_batch(count, edges, polygon_start, polygon_end), proportional)
+
+def test_point_index_1d_matches_get_actual_value():
+    """
+    Test PointIndex1D against get_actual_value, with points on the bounds and
+    repeated points.
+    """
+    np.random.seed(15)
+    data = np.round(np.random.uniform(0, 1, 300), 2)
+    index = PointIndex1D(data)
+    start = np.round(np.random.uniform(-0.2, 1.2, 200), 2)
+    end = np.round(np.random.uniform(-0.2, 1.2, 200), 2)
+    result = index.get_actual_value(start, end)
+    for i in range(200):
+        expected = get_actual_value(data, start[i], end[i])
+        assert result[i] == expected, f"Interval {i}. Expected {expected}, but got {result[i]}"
+    assert index.get_actual_value(data[0], data[0]) == get_actual_value(data, data[0], data[0])
+    assert PointIndex1D(np.array([])).get_actual_value(0, 1) == 0
+
+
+def test_compact_counts_1d():
+    """
+    Test that compact counts give the same histograms and estimates, including
+    cumulative counts beyond the range of their type.
+    """
+    np.random.seed(16)
+    data = np.random.uniform(0, 1, 5000)
+    bins = create_random_origin_bins(0.01, 0, 1, 0.3)
+    expected, _ = histogram(data, bins)
+    count, _ = histogram(data, bins, compact=True)
+    assert count.dtype == np.uint16
+    assert np.array_equal(count, expected)
+
+    # Cells holding the maximum of uint16 overflow a cumulative count in that type
+    count = np.full(4, 2**16 - 1, dtype=np.uint16)
+    edges = np.linspace(0, 1, 5)
+    expected = 4 * (2**16 - 1)
+    assert GridIndex1D(count, edges).centroid_allocation(0, 1) == expected
+    assert np.isclose(GridIndex1D(count, edges).proportional_allocation(0, 1), expected)
+    assert centroid_allocation_estimate_batch(count[None], edges, 0, 1)[0] == expected
+    assert np.isclose(proportional_allocation_estimate_batch(count[None], edges, 0, 1)[0], expected)
+
+    samples = [np.random.uniform(-0.5, 1.5, 1000) for _ in range(5)]
+    data, trial_index = stack_trials(samples)
+    bins = [create_random_origin_bins(0.05, 0, 1, 0.3) for _ in range(5)]
+    expected, _ = create_gridded_data_batch(data, trial_index, 5, bins)
+    count, _ = create_gridded_data_batch(data, trial_index, 5, bins, compact=True)
+    assert count.dtype == np.uint16
+    assert np.array_equal(count, expected)
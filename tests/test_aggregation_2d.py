@@ -6,8 +6,20 @@ from aggregation_2d import (
     get_actual_value_2d,
     proportional_allocation_estimate_2d,
     centroid_allocation_estimate_2d,
-    create_gridded_data_2d
+    create_gridded_data_2d,
+    histogram_2d,
+    GridIndex2D,
+    PointIndex2D,
+    create_random_origin_bins_2d,
+    create_random_origin_bins_2d_batch,
+    create_gridded_data_2d_batch,
+    get_actual_value_2d_batch,
+    centroid_allocation_estimate_2d_batch,
+    proportional_allocation_estimate_2d_batch,
+    proportional_allocation_estimate_polygon_2d,
 )
+from aggregation_1d import stack_trials
+from aggregation_nd import SparseCount, histogram_nd
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -189,4 +201,304 @@ def test_proportional_allocation_estimate():
         assert np.isclose(result, expected), f"Case {case}. Expected {expected}, but got {result}"
 
 
-test_proportional_allocation_estimate()
\ No newline at end of file
+def test_batch_estimates_match_scalar_estimates_2d():
+    """
+    Test the batched functions against the scalar ones on random trials, with
+    lists of per-trial edges and with the edges of create_random_origin_bins_2d_batch.
+    """
+    np.random.seed(2)
+    n_trials = 20
+    samples = [np.random.uniform(-1, 2, (np.random.poisson(200), 2)) for _ in range(n_trials)]
+    polygon_x = np.random.uniform(-1, 0, n_trials)
+    polygon_y = np.random.uniform(-1, 0, n_trials)
+    polygon_x_range = (polygon_x, polygon_x + 0.5)
+    polygon_y_range = (polygon_y, polygon_y + 0.5)
+    # Both draw the same origins, the x ones then the y ones
+    state = np.random.get_state()
+    binx = [create_random_origin_bins_2d(-1, 2, 0.07, 0.5) for _ in range(n_trials)]
+    biny = [create_random_origin_bins_2d(-1, 2, 0.07, 0.5) for _ in range(n_trials)]
+    np.random.set_state(state)
+    batch_bins = [create_random_origin_bins_2d_batch(n_trials, -1, 2, 0.07, 0.5) for _ in range(2)]
+
+    data, trial_index = stack_trials(samples)
+    for trial_binx, trial_biny in [(binx, biny), batch_bins]:
+        count, edges_x, edges_y = create_gridded_data_2d_batch(data, trial_index, n_trials, trial_binx, trial_biny)
+        actual = get_actual_value_2d_batch(data, trial_index, n_trials, polygon_x_range, polygon_y_range)
+        centroid = centroid_allocation_estimate_2d_batch(count, edges_x, edges_y, polygon_x_range, polygon_y_range)
+        proportional = proportional_allocation_estimate_2d_batch(count, edges_x, edges_y, polygon_x_range, polygon_y_range)
+        for i in range(n_trials):
+            polygon_x_i = (polygon_x_range[0][i], polygon_x_range[1][i])
+            polygon_y_i = (polygon_y_range[0][i], polygon_y_range[1][i])
+            count_i, edges_x_i, edges_y_i = np.histogram2d(samples[i][:,0], samples[i][:,1], bins=[binx[i], biny[i]])
+            assert np.array_equal(count[i, :count_i.shape[0], :count_i.shape[1]], count_i), f"Trial {i}. Histogram mismatch"
+            assert actual[i] == get_actual_value_2d(samples[i], polygon_x_i, polygon_y_i), f"Trial {i}. Actual value mismatch"
+            expected = centroid_allocation_estimate_2d(count_i, edges_x_i, edges_y_i, polygon_x_i, polygon_y_i)
+            assert np.isclose(centroid[i], expected), f"Trial {i}. Expected {expected}, but got {centroid[i]}"
+            expected = proportional_allocation_estimate_2d(count_i, edges_x_i, edges_y_i, polygon_x_i, polygon_y_i)
+            assert np.isclose(proportional[i], expected), f"Trial {i}. Expected {expected}, but got {proportional[i]}"
+
+        # Counting only the windows of cells holding the polygons gives the same estimates
+        window = (polygon_x_range, polygon_y_range)
+        count, edges_x, edges_y = create_gridded_data_2d_batch(data, trial_index, n_trials, trial_binx, trial_biny, window=window)
+        assert max(count.shape[1:]) <= 0.5 / 0.07 + 2
+        assert np.allclose(centroid_allocation_estimate_2d_batch(count, edges_x, edges_y, *window), centroid)
+        assert np.allclose(proportional_allocation_estimate_2d_batch(count, edges_x, edges_y, *window), proportional)
+
+
+def test_grid_index_2d_batched_queries():
+    """
+    Test that GridIndex2D answers arrays of rectangles like a brute force overlap.
+    """
+    np.random.seed(4)
+    data = np.random.uniform(-1, 2, (500, 2))
+    binx = create_random_origin_bins_2d(-1, 2, 0.07, 0.5)
+    biny = create_random_origin_bins_2d(-1, 2, 0.11, 0.5)
+    count, edges_x, edges_y = np.histogram2d(data[:,0], data[:,1], bins=[binx, biny])
+    index = GridIndex2D(count, edges_x, edges_y)
+
+    n = 100
+    x_start = np.random.uniform(-1.5, 2, n)
+    y_start = np.random.uniform(-1.5, 2, n)
+    polygon_x = (x_start, x_start + np.random.uniform(0, 0.6, n))
+    polygon_y = (y_start, y_start + np.random.uniform(0, 0.6, n))
+    centroid = index.centroid_allocation(polygon_x, polygon_y)
+    proportional = index.proportional_allocation(polygon_x, polygon_y)
+
+    for i in range(n):
+        polygon_x_i = (polygon_x[0][i], polygon_x[1][i])
+        polygon_y_i = (polygon_y[0][i], polygon_y[1][i])
+        expected = centroid_allocation_estimate_2d(count, edges_x, edges_y, polygon_x_i, polygon_y_i)
+        assert np.isclose(centroid[i], expected), f"Rectangle {i}. Expected {expected}, but got {centroid[i]}"
+
+        overlap_x = np.clip(np.minimum(edges_x[1:], polygon_x_i[1]) - np.maximum(edges_x[:-1], polygon_x_i[0]), 0, None) / np.diff(edges_x)
+        overlap_y = np.clip(np.minimum(edges_y[1:], polygon_y_i[1]) - np.maximum(edges_y[:-1], polygon_y_i[0]), 0, None) / np.diff(edges_y)
+        expected = overlap_x @ count @ overlap_y
+        assert np.isclose(proportional[i], expected), f"Rectangle {i}. Expected {expected}, but got {proportional[i]}"
+
+def test_proportional_allocation_estimate_within_one_cell():
+    """
+    Test proportional allocation for a polygon that lies inside a single cell.
+    """
+    data = create_test_data()
+    count, edges_x, edges_y = create_gridded_data_2d(data, 0.5, x_range=(0, 1), y_range=(0, 1))
+    result = proportional_allocation_estimate_2d(count, edges_x, edges_y, (0.1, 0.2), (0.1, 0.35))
+    expected = 2 * (0.1 / 0.5) * (0.25 / 0.5)
+    assert np.isclose(result, expected), f"Expected {expected}, but got {result}"
+
+def test_histogram_2d_matches_numpy():
+    """
+    Test that histogram_2d matches np.histogram2d, including points on the edges.
+    """
+    np.random.seed(12)
+    binx = create_random_origin_bins_2d(-1, 2, 0.03, 0.5)
+    biny = create_random_origin_bins_2d(0, 1, 0.1, 0)
+    x = np.concatenate((np.random.uniform(-2, 3, 2000), binx, binx[:len(biny)]))
+    y = np.concatenate((np.random.uniform(-0.5, 1.5, 2000), biny[np.arange(len(binx)) % len(biny)], biny))
+    hist, edges_x, edges_y = histogram_2d(x, y, binx, biny)
+    expected, expected_x, expected_y = np.histogram2d(x, y, bins=[binx, biny])
+    assert np.array_equal(hist, expected) and hist.dtype == expected.dtype
+    assert np.array_equal(edges_x, expected_x) and np.array_equal(edges_y, expected_y)
+
+def test_proportional_allocation_estimate_polygon_matches_rectangles():
+    """
+    Test that the polygon estimator gives the rectangle estimate for rectangles,
+    including rectangles partly outside the grid.
+    """
+    np.random.seed(13)
+    data = np.random.uniform(-1, 2, (500, 2))
+    count, edges_x, edges_y = create_gridded_data_2d(data, 0.07, (-1, 2), (-1, 2), 0.5)
+    for i in range(50):
+        x_start, y_start = np.random.uniform(-1.5, 2, 2)
+        polygon_x = (x_start, x_start + np.random.uniform(0, 0.6))
+        polygon_y = (y_start, y_start + np.random.uniform(0, 0.6))
+        vertices = np.array([
+            [polygon_x[0], polygon_y[0]],
+            [polygon_x[1], polygon_y[0]],
+            [polygon_x[1], polygon_y[1]],
+            [polygon_x[0], polygon_y[1]],
+        ])
+        expected = proportional_allocation_estimate_2d(count, edges_x, edges_y, polygon_x, polygon_y)
+        result = proportional_allocation_estimate_polygon_2d(count, edges_x, edges_y, vertices)
+        assert np.isclose(result, expected), f"Rectangle {i}. Expected {expected}, but got {result}"
+
+def _clipped_area(vertices, x_range, y_range):
+    """
+    Area of a polygon clipped to a rectangle with the Sutherland-Hodgman algorithm.
+    """
+    polygon = [tuple(vertex) for vertex in vertices]
+    for axis in (0, 1):
+        bounds = x_range if axis == 0 else y_range
+        for bound, side in ((bounds[0], 1), (bounds[1], -1)):
+            clipped = []
+            for a, b in zip(polygon[-1:] + polygon[:-1], polygon):
+                if (side * (a[axis] - bound) >= 0) != (side * (b[axis] - bound) >= 0):
+                    t = (bound - a[axis]) / (b[axis] - a[axis])
+                    clipped.append((a[0] + t * (b[0] - a[0]), a[1] + t * (b[1] - a[1])))
+                if side * (b[axis] - bound) >= 0:
+                    clipped.append(b)
+            polygon = clipped
+    if len(polygon) < 3:
+        return 0
+    x, y = np.array(polygon).T
+    return abs(np.sum(x * np.roll(y, -1) - np.roll(x, -1) * y)) / 2
+
+def test_proportional_allocation_estimate_polygon_matches_clipped_areas():
+    """
+    Test the polygon estimator and its batched GridIndex2D version against the
+    cell areas of non-convex polygons in both orientations on an irregular grid.
+    """
+    np.random.seed(14)
+    edges_x = create_random_origin_bins_2d(-1, 2, 0.13, 0.5)
+    edges_y = np.sort(np.concatenate(([-1, 2], np.random.uniform(-1, 2, 20))))
+    count = np.random.poisson(3, (len(edges_x) - 1, len(edges_y) - 1)).astype(float)
+    polygons = []
+    while len(polygons) < 10:
+        # Star-shaped around their center, so the polygons are simple
+        angles = np.sort(np.random.uniform(0, 2 * np.pi, np.random.randint(6, 12)))
+        if np.max(np.diff(np.concatenate((angles, [angles[0] + 2 * np.pi])))) >= np.pi:
+            continue
+        radius = np.random.uniform(0.2, 1.5, len(angles))
+        vertices = np.column_stack((0.5 + radius * np.cos(angles), 0.5 + radius * np.sin(angles)))
+        polygons.append(vertices if len(polygons) % 2 else vertices[::-1])
+
+    batch = GridIndex2D(count, edges_x, edges_y).proportional_allocation_polygon(polygons)
+    for i, vertices in enumerate(polygons):
+        expected = sum(
+            count[x, y] * _clipped_area(vertices, edges_x[x:x+2], edges_y[y:y+2]) / ((edges_x[x+1] - edges_x[x]) * (edges_y[y+1] - edges_y[y]))
+            for x in range(count.shape[0]) for y in range(count.shape[1])
+        )
+        result = proportional_allocation_estimate_polygon_2d(count, edges_x, edges_y, vertices)
+        assert np.isclose(result, expected), f"Polygon {i}. Expected {expected}, but got {result}"
+        assert np.isclose(batch[i], expected), f"Polygon {i}. Expected {expected}, but got {batch[i]}"
+
+def test_point_index_2d_matches_get_actual_value_2d():
+    """
+    Test PointIndex2D against get_actual_value_2d for any number of points, with
+    points on the bounds, repeated coordinates and empty rectangles.
+    """
+    np.random.seed(16)
+    for n in [0, 1, 2, 5, 64, 300]:
+        data = np.round(np.random.uniform(0, 1, (n, 2)), 2)
+        index = PointIndex2D(data)
+        x_range = np.round(np.random.uniform(-0.2, 1.2, (2, 200)), 2)
+        y_range = np.round(np.random.uniform(-0.2, 1.2, (2, 200)), 2)
+        result = index.get_actual_value(x_range, y_range)
+        for i in range(200):
+            expected = get_actual_value_2d(data, x_range[:, i], y_range[:, i])
+            assert result[i] == expected, f"{n} points, rectangle {i}. Expected {expected}, but got {result[i]}"
+        assert index.get_actual_value((0, 1), (0, 1)) == n
+
+
+def test_compact_counts_2d():
+    """
+    Test that the estimators give the same values for compact counts as for the
+    float counts of create_gridded_data_2d, batched or not.
+    """
+    np.random.seed(21)
+    data = np.random.uniform(-0.5, 1.5, (4000, 2))
+    expected, edges_x, edges_y = create_gridded_data_2d(data, 0.05, (0, 1), (0, 1), range_of_variation=0.2)
+    # The grid origin is random, so it is drawn again from the same seed
+    np.random.seed(21)
+    data = np.random.uniform(-0.5, 1.5, (4000, 2))
+    count, compact_x, compact_y = create_gridded_data_2d(data, 0.05, (0, 1), (0, 1), range_of_variation=0.2, compact=True)
+    assert count.dtype == np.uint16
+    assert np.array_equal(count, expected)
+    assert np.array_equal(compact_x, edges_x) and np.array_equal(compact_y, edges_y)
+
+    polygon_x, polygon_y = (0.13, 0.71), (0.2, 0.93)
+    index = GridIndex2D(count, edges_x, edges_y)
+    expected_index = GridIndex2D(expected, edges_x, edges_y)
+    assert index.centroid_allocation(polygon_x, polygon_y) == expected_index.centroid_allocation(polygon_x, polygon_y)
+    assert np.isclose(index.proportional_allocation(polygon_x, polygon_y), expected_index.proportional_allocation(polygon_x, polygon_y))
+    assert np.isclose(
+        proportional_allocation_estimate_2d(count, edges_x, edges_y, polygon_x, polygon_y),
+        proportional_allocation_estimate_2d(expected, edges_x, edges_y, polygon_x, polygon_y))
+    vertices = np.array([[0.1, 0.1], [0.9, 0.3], [0.5, 1.2]])
+    assert np.isclose(
+        proportional_allocation_estimate_polygon_2d(count, edges_x, edges_y, vertices),
+        proportional_allocation_estimate_polygon_2d(expected, edges_x, edges_y, vertices))
+    assert np.isclose(index.proportional_allocation_polygon(vertices), expected_index.proportional_allocation_polygon(vertices))
+
+    data, trial_index = stack_trials([np.random.uniform(-0.5, 1.5, (500, 2)) for _ in range(4)])
+    data = data.reshape(-1, 2)
+    expected, _, _ = create_gridded_data_2d_batch(data, trial_index, 4, edges_x, edges_y)
+    count, batch_x, batch_y = create_gridded_data_2d_batch(data, trial_index, 4, edges_x, edges_y, compact=True)
+    assert count.dtype == np.uint16
+    assert np.array_equal(count, expected)
+    assert np.allclose(
+        proportional_allocation_estimate_2d_batch(count, batch_x, batch_y, polygon_x, polygon_y),
+        proportional_allocation_estimate_2d_batch(expected, batch_x, batch_y, polygon_x, polygon_y))
+
+
+def test_memmap_tiled_estimates_2d(tmp_path):
+    """
+    Test that the estimators give the same values for a np.memmap count read
+    in small tiles as for the count in memory.
+    """
+    np.random.seed(22)
+    edges_x = create_random_origin_bins_2d(0, 1, 0.02, 0.3)
+    edges_y = np.sort(np.concatenate(([0, 1], np.random.uniform(0, 1, 40))))
+    expected = np.random.poisson(3, (len(edges_x) - 1, len(edges_y) - 1)).astype(np.uint16)
+    path = str(tmp_path / 'count.npy')
+    np.save(path, expected)
+    count = np.load(path, mmap_mode='r')
+    assert isinstance(count, np.memmap)
+
+    for tile_cells in [None, 1, 7, 200]:
+        for i in range(10):
+            polygon_x = np.sort(np.random.uniform(-0.2, 1.2, 2))
+            polygon_y = np.sort(np.random.uniform(-0.2, 1.2, 2))
+            result = centroid_allocation_estimate_2d(count, edges_x, edges_y, polygon_x, polygon_y, tile_cells)
+            assert result == centroid_allocation_estimate_2d(expected, edges_x, edges_y, polygon_x, polygon_y)
+            result = proportional_allocation_estimate_2d(count, edges_x, edges_y, polygon_x, polygon_y, tile_cells)
+            assert np.isclose(result, proportional_allocation_estimate_2d(expected, edges_x, edges_y, polygon_x, polygon_y))
+            vertices = np.random.uniform(-0.2, 1.2, (3, 2))
+            result = proportional_allocation_estimate_polygon_2d(count, edges_x, edges_y, vertices, tile_cells)
+            assert np.isclose(result, proportional_allocation_estimate_polygon_2d(expected, edges_x, edges_y, vertices))
+
+
+def test_sparse_gridded_data_2d():
+    """
+    Test that the 2D estimators give the same values for the sparse counts of
+    create_gridded_data_2d as for the dense ones.
+    """
+    np.random.seed(31)
+    data = np.random.uniform(-1, 2, (300, 2))
+    np.random.seed(32)
+    expected, edges_x, edges_y = create_gridded_data_2d(data, 0.001, (-1, 2), (-1, 2), range_of_variation=0.5)
+    np.random.seed(32)
+    count, sparse_x, sparse_y = create_gridded_data_2d(data, 0.001, (-1, 2), (-1, 2), range_of_variation=0.5, sparse=True)
+    assert len(count.cells) <= 300
+    assert np.array_equal(count.to_dense(), expected)
+    assert np.array_equal(sparse_x, edges_x) and np.array_equal(sparse_y, edges_y)
+    for i in range(20):
+        polygon_x = np.sort(np.random.uniform(-1.2, 2.2, 2))
+        polygon_y = np.sort(np.random.uniform(-1.2, 2.2, 2))
+        assert centroid_allocation_estimate_2d(count, edges_x, edges_y, polygon_x, polygon_y) == centroid_allocation_estimate_2d(expected, edges_x, edges_y, polygon_x, polygon_y)
+        assert np.isclose(
+            proportional_allocation_estimate_2d(count, edges_x, edges_y, polygon_x, polygon_y),
+            proportional_allocation_estimate_2d(expected, edges_x, edges_y, polygon_x, polygon_y))
+
+    # Polygons, including ones reaching past the top of the grid or covering it
+    polygons = [np.random.uniform(-1.2, 2.2, (3, 2)) for _ in range(20)]
+    polygons += [np.array([[0, 0], [1.5, 0.5], [0.5, 2.5]]), np.array([[-2, -2], [3, -2], [3, 3], [-2, 3]])]
+    for vertices in polygons:
+        assert np.isclose(
+            proportional_allocation_estimate_polygon_2d(count, edges_x, edges_y, vertices),
+            proportional_allocation_estimate_polygon_2d(expected, edges_x, edges_y, vertices))
+    assert np.isclose(proportional_allocation_estimate_polygon_2d(count, edges_x, edges_y, polygons[-1]), 300)
+
+    # GridIndex2D converts the sparse counts to dense ones. The counts are built
+    # through aggregation_nd as imported here, like any caller would.
+    expected, edges_x, edges_y = create_gridded_data_2d(data, 0.1, (-1, 2), (-1, 2), range_of_variation=0.5)
+    for count in [histogram_nd(data, [edges_x, edges_y], sparse=True)[0], SparseCount.from_dense(expected)]:
+        assert isinstance(count, SparseCount)
+        assert np.allclose(GridIndex2D(count, edges_x, edges_y).proportional_allocation_polygon(polygons),
+                           GridIndex2D(expected, edges_x, edges_y).proportional_allocation_polygon(polygons))
+        for vertices in polygons:
+            assert np.isclose(
+                proportional_allocation_estimate_polygon_2d(count, edges_x, edges_y, vertices),
+                proportional_allocation_estimate_polygon_2d(expected, edges_x, edges_y, vertices))
+
+
+test_proportional_allocation_estimate()
@@ -0,0 +1,136 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+import aggregation_nd
+from aggregation_nd import (
+    SparseCount,
+    count_cells,
+    get_compact_count_dtype,
+    get_tiles,
+    histogram_nd,
+    centroid_allocation_estimate_nd,
+    proportional_allocation_estimate_nd,
+)
+from aggregation_2d import create_random_origin_bins_2d
+import numpy as np
+
+def test_histogram_nd_matches_numpy():
+    """
+    Test that histogram_nd matches np.histogramdd for regular and irregular edges,
+    with enough points for the regular ones to be binned arithmetically.
+    """
+    np.random.seed(17)
+    data = np.random.uniform(-1.5, 2.5, (30000, 3))
+    assert not aggregation_nd.is_numpy_histogram_faster(len(data), [np.linspace(-1, 2, 31)])
+    regular = [create_random_origin_bins_2d(-1, 2, width, 0.5) for width in (0.1, 0.07, 0.3)]
+    irregular = [np.sort(np.concatenate(([-1, 2], np.random.uniform(-1, 2, 10)))) for _ in range(3)]
+    for edges in [regular, irregular]:
+        count, count_edges = histogram_nd(data, edges)
+        expected, expected_edges = np.histogramdd(data, bins=edges)
+        assert np.array_equal(count, expected)
+        assert all(np.array_equal(a, b) for a, b in zip(count_edges, expected_edges))
+        count, _ = histogram_nd(tuple(data.T), edges)
+        assert np.array_equal(count, expected)
+        # Without points every cell is empty, for arrays of shape (0, d) too
+        for empty in [np.empty((0, 3)), (np.empty(0),) * 3]:
+            count, _ = histogram_nd(empty, edges)
+            assert count.shape == expected.shape and not count.any()
+
+def test_estimates_nd_match_brute_force():
+    """
+    Test the 3D estimators against the full weight tensor, for boxes inside,
+    across and outside the grid, with the count read in several chunks.
+    """
+    np.random.seed(18)
+    edges = [
+        create_random_origin_bins_2d(-1, 2, 0.13, 0.5),
+        np.sort(np.concatenate(([-1, 2], np.random.uniform(-1, 2, 15)))),
+        np.linspace(0, 10, 21),
+    ]
+    count = np.random.poisson(2, tuple(len(axis_edges) - 1 for axis_edges in edges))
+    chunk_cells = aggregation_nd.ALLOCATION_CHUNK_CELLS
+    for chunk in [chunk_cells, 50]:
+        aggregation_nd.ALLOCATION_CHUNK_CELLS = chunk
+        try:
+            for i in range(30):
+                start = np.random.uniform([-1.5, -1.5, -2], [2, 2, 10])
+                polygon = list(zip(start, start + np.random.uniform(0, [1, 1, 6])))
+                centroid = 1
+                proportional = 1
+                for axis, (axis_edges, (polygon_start, polygon_end)) in enumerate(zip(edges, polygon)):
+                    shape = [1, 1, 1]
+                    shape[axis] = -1
+                    centers = (axis_edges[:-1] + axis_edges[1:]) / 2
+                    centroid = centroid * ((centers >= polygon_start) & (centers <= polygon_end)).reshape(shape)
+                    overlap = np.clip(np.minimum(axis_edges[1:], polygon_end) - np.maximum(axis_edges[:-1], polygon_start), 0, None)
+                    proportional = proportional * (overlap / np.diff(axis_edges)).reshape(shape)
+
+                expected = np.sum(count * centroid)
+                result = centroid_allocation_estimate_nd(count, edges, polygon)
+                assert np.isclose(result, expected), f"Box {i}. Expected {expected}, but got {result}"
+                expected = np.sum(count * proportional)
+                result = proportional_allocation_estimate_nd(count, edges, polygon)
+                assert np.isclose(result, expected), f"Box {i}. Expected {expected}, but got {result}"
+        finally:
+            aggregation_nd.ALLOCATION_CHUNK_CELLS = chunk_cells
+
+def test_compact_counts():
+    """
+    Test that compact counts match np.bincount with the smallest integer type,
+    and that the estimators give the same values for them.
+    """
+    np.random.seed(19)
+    flat_index = np.random.randint(0, 1000, 5000)
+    count = count_cells(flat_index, 1200, compact=True)
+    assert count.dtype == np.uint16
+    assert np.array_equal(count, np.bincount(flat_index, minlength=1200))
+    assert get_compact_count_dtype(2**16 - 1) == np.uint16
+    assert get_compact_count_dtype(2**16) == np.int32
+    assert get_compact_count_dtype(2**31) == np.int64
+    assert count_cells(np.array([], dtype=int), 3, compact=True).tolist() == [0, 0, 0]
+    count = count_cells(np.zeros(2**16, dtype=int), 3, compact=True)
+    assert count.dtype == np.int32 and count.tolist() == [2**16, 0, 0]
+
+    data = np.random.uniform(-1.5, 2.5, (3000, 3))
+    edges = [create_random_origin_bins_2d(-1, 2, width, 0.5) for width in (0.1, 0.07, 0.3)]
+    expected, _ = histogram_nd(data, edges)
+    count, _ = histogram_nd(data, edges, compact=True)
+    assert count.dtype == np.uint16
+    assert np.array_equal(count, expected)
+    polygon = [(-0.3, 1.2), (0.1, 0.75), (-2, 3)]
+    assert np.isclose(proportional_allocation_estimate_nd(count, edges, polygon), proportional_allocation_estimate_nd(expected, edges, polygon))
+    assert centroid_allocation_estimate_nd(count, edges, polygon) == centroid_allocation_estimate_nd(expected, edges, polygon)
+
+def test_get_tiles():
+    """
+    Test that the tiles cover the array once, within the number of cells.
+    """
+    for shape in [(5, 7, 3), (1, 100), (40,), (0, 4)]:
+        for tile_cells in [1, 4, 21, 50, 10**6]:
+            covered = np.zeros(shape, dtype=int)
+            for tile in get_tiles(shape, tile_cells):
+                assert covered[tile].size <= tile_cells
+                covered[tile] += 1
+            assert np.all(covered == 1), f"Shape {shape}, {tile_cells} cells"
+
+def test_sparse_count_matches_dense():
+    """
+    Test that sparse counts hold the dense histogram and give the same estimates.
+    """
+    np.random.seed(30)
+    data = np.random.uniform(-1.5, 2.5, (500, 3))
+    edges = [create_random_origin_bins_2d(-1, 2, width, 0.5) for width in (0.01, 0.02, 0.05)]
+    expected, _ = histogram_nd(data, edges)
+    count, _ = histogram_nd(data, edges, sparse=True)
+    assert isinstance(count, SparseCount)
+    assert len(count.cells) == np.count_nonzero(expected)
+    assert np.array_equal(count.to_dense(), expected)
+    assert np.array_equal(SparseCount.from_dense(expected).cells, count.cells)
+    irregular = [np.sort(np.concatenate(([-1, 2], np.random.uniform(-1, 2, 10)))) for _ in range(3)]
+    assert np.array_equal(histogram_nd(data, irregular, sparse=True)[0].to_dense(), histogram_nd(data, irregular)[0])
+    for i in range(20):
+        start = np.random.uniform(-1.5, 2, 3)
+        polygon = list(zip(start, start + np.random.uniform(0, 1.5, 3)))
+        assert centroid_allocation_estimate_nd(count, edges, polygon) == centroid_allocation_estimate_nd(expected, edges, polygon)
+        assert np.isclose(proportional_allocation_estimate_nd(count, edges, polygon), proportional_allocation_estimate_nd(expected, edges, polygon))
@@ -0,0 +1,104 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+import areal_reallocation
+from areal_reallocation import (
+    ArealReallocation,
+    get_overlap_weights,
+    get_grid_reallocation,
+    get_polygon_reallocation,
+)
+from aggregation_1d import GridIndex1D, create_random_origin_bins
+from aggregation_2d import GridIndex2D, create_random_origin_bins_2d, proportional_allocation_estimate_polygon_2d
+import numpy as np
+
+def test_overlap_weights_match_proportional_allocation():
+    """
+    Test that the 1D weights give the proportional allocation estimate of every
+    target cell, with irregular and misaligned grids.
+    """
+    np.random.seed(27)
+    source = create_random_origin_bins(0.1, -1, 2, 0.5)
+    target = np.sort(np.concatenate(([-1.3, 2.4], np.random.uniform(-1.3, 2.4, 20))))
+    count = np.random.poisson(4, len(source) - 1)
+    result = get_overlap_weights(source, target) @ count
+    expected = GridIndex1D(count, source).proportional_allocation(target[:-1], target[1:])
+    assert np.allclose(result, expected)
+    # The target covers the source, so the counts are conserved
+    assert np.isclose(result.sum(), count.sum())
+    assert get_overlap_weights(source, [5, 6]).nnz == 0
+
+def test_grid_reallocation_2d_matches_grid_index():
+    """
+    Test the separable 2D reallocation against GridIndex2D, for several layers.
+    """
+    np.random.seed(28)
+    source = [create_random_origin_bins_2d(0, 1, 0.03, 0.2), np.linspace(0, 1, 41)]
+    target = [np.sort(np.concatenate(([-0.1, 1.1], np.random.uniform(0, 1, 12)))), create_random_origin_bins_2d(-0.2, 1.2, 0.07, 0.3)]
+    count = np.random.poisson(3, (5, len(source[0]) - 1, len(source[1]) - 1))
+    reallocation = ArealReallocation.from_grids(source, target)
+    result = reallocation.apply(count)
+    assert result.shape == (5, len(target[0]) - 1, len(target[1]) - 1)
+    lower_x, lower_y = np.meshgrid(target[0][:-1], target[1][:-1], indexing='ij')
+    upper_x, upper_y = np.meshgrid(target[0][1:], target[1][1:], indexing='ij')
+    for layer in range(5):
+        expected = GridIndex2D(count[layer], *source).proportional_allocation((lower_x, upper_x), (lower_y, upper_y))
+        assert np.allclose(result[layer], expected)
+    assert np.allclose(reallocation.apply(count[0]), result[0])
+    assert np.allclose((reallocation.matrix @ count.reshape(5, -1).T).T, result.reshape(5, -1))
+
+def test_polygon_reallocation_matches_polygon_estimates():
+    """
+    Test the reallocation onto polygons against the polygon estimator,
+    including polygons partly outside the grid.
+    """
+    np.random.seed(29)
+    edges_x = create_random_origin_bins_2d(0, 1, 0.05, 0.2)
+    edges_y = np.sort(np.concatenate(([0, 1], np.random.uniform(0, 1, 15))))
+    count = np.random.poisson(3, (3, len(edges_x) - 1, len(edges_y) - 1))
+    polygons = [np.random.uniform(-0.2, 1.2, (3, 2)) for _ in range(10)]
+    polygons.append(np.array([[0.1, 0.1], [0.9, 0.1], [0.9, 0.9], [0.1, 0.9]]))
+    polygons.append(np.array([[-1, -1], [2, -1], [2, 2], [-1, 2]]))
+    reallocation = ArealReallocation.from_polygons(edges_x, edges_y, polygons)
+    result = reallocation.apply(count)
+    assert result.shape == (3, len(polygons))
+    for layer in range(3):
+        for i, vertices in enumerate(polygons):
+            expected = proportional_allocation_estimate_polygon_2d(count[layer], edges_x, edges_y, vertices)
+            assert np.isclose(result[layer, i], expected), f"Polygon {i}. Expected {expected}, but got {result[layer, i]}"
+    assert np.isclose(result[0, -1], count[0].sum())
+    assert np.all(reallocation.weights.data > 0) and np.all(reallocation.weights.data <= 1 + 1e-12)
+
+def test_reallocation_cache(tmp_path):
+    """
+    Test that the reallocations are cached in memory and on disk by geometry.
+    """
+    source = [np.linspace(0, 1, 11), np.linspace(0, 1, 21)]
+    target = [np.linspace(0, 1, 4), np.linspace(-0.5, 1.5, 7)]
+    polygons = [np.array([[0.1, 0.2], [0.8, 0.3], [0.4, 0.9]])]
+    cache_dir = str(tmp_path / 'weights')
+    count = np.arange(200).reshape(10, 20)
+    areal_reallocation.reallocation_cache.clear()
+    grids = get_grid_reallocation(source, target, cache_dir)
+    zones = get_polygon_reallocation(source[0], source[1], polygons, cache_dir)
+    assert get_grid_reallocation([edges.copy() for edges in source], target, cache_dir) is grids
+    assert get_grid_reallocation(source, [target[0], target[1] + 0.1], cache_dir) is not grids
+    assert len(os.listdir(cache_dir)) == 3
+    info = areal_reallocation.reallocation_cache.info()
+    assert info['hits'] == 1 and info['misses'] == 3
+    assert info['nbytes'] == grids.nbytes + zones.nbytes + get_grid_reallocation(source, [target[0], target[1] + 0.1]).nbytes
+
+    areal_reallocation.reallocation_cache.clear()
+    loaded = get_grid_reallocation(source, target, cache_dir)
+    assert loaded is not grids
+    assert np.allclose(loaded.apply(count), grids.apply(count))
+    loaded = get_polygon_reallocation(source[0], source[1], polygons, cache_dir)
+    assert np.allclose(loaded.apply(count), zones.apply(count))
+    assert len(os.listdir(cache_dir)) == 3
+
+    # save writes to the given path, without appending .npz
+    path = str(tmp_path / 'weights.bin')
+    zones.save(path)
+    assert os.path.exists(path)
+    assert np.allclose(ArealReallocation.load(path).apply(count), zones.apply(count))
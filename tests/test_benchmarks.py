@@ -0,0 +1,17 @@
+from benchmarks.run_benchmarks import compare, get_benchmarks
+
+def test_compare_flags_slowdowns_above_threshold():
+    """
+    Test that only the benchmarks slower than threshold times their baseline are reported.
+    """
+    baseline = {'a': 1.0, 'b': 1.0, 'c': 2.0}
+    results = {'a': 1.4, 'b': 1.6, 'c': 1.0, 'new': 5.0}
+    assert compare(results, baseline, 1.5) == [('b', 1.0, 1.6, 1.6)]
+
+def test_benchmarks_cover_every_runner():
+    """
+    Test that a reduced sweep is benchmarked for every run_simulation_* function.
+    """
+    names = get_benchmarks().keys()
+    for module in ['simulation1d', 'simulation2d']:
+        assert sum(name.startswith(f'{module}.run_simulation_') for name in names) == 3
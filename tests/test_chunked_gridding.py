@@ -0,0 +1,93 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from chunked_gridding import (
+    iter_point_chunks,
+    histogram_chunks,
+    create_gridded_data_chunked,
+    create_gridded_data_random_origin_chunked,
+    create_gridded_data_2d_chunked,
+)
+from aggregation_1d import create_gridded_data, create_gridded_data_random_origin
+from aggregation_2d import create_gridded_data_2d
+import fastparquet
+import numpy as np
+import pandas as pd
+
+def write_sources(tmp_path, data, columns):
+    """
+    Save data as a .npy file and as a Parquet file with several row groups.
+    """
+    npy = str(tmp_path / 'points.npy')
+    np.save(npy, data)
+    parquet = str(tmp_path / 'points.parquet')
+    frame = pd.DataFrame(data.reshape(len(data), -1), columns=columns)
+    frame['weight'] = 1.0
+    fastparquet.write(parquet, frame, row_group_offsets=[0, 1000, 2500, 2600])
+    return npy, parquet
+
+def test_chunked_gridding_1d_matches_in_memory(tmp_path):
+    """
+    Test that gridding the points of a .npy file, a Parquet file, an array and
+    a list of arrays in chunks gives the histograms of the in-memory functions.
+    """
+    np.random.seed(23)
+    data = np.random.uniform(-3, 4, 5000)
+    npy, parquet = write_sources(tmp_path, data, ['x'])
+    expected, expected_edges = create_gridded_data(data, 0.01, -3, 4)
+    for source in [npy, parquet, data, np.array_split(data, 7)]:
+        for chunk_size in [333, 10**6]:
+            stats = {}
+            count, edges = create_gridded_data_chunked(source, 0.01, -3, 4, chunk_size, column='x', stats=stats)
+            assert np.array_equal(count, expected) and count.dtype == expected.dtype
+            assert np.array_equal(edges, expected_edges)
+            assert stats['points'] == 5000 and stats['points_per_second'] > 0
+
+    np.random.seed(24)
+    expected, expected_edges = create_gridded_data_random_origin(data, 0.001, -3, 4, range_of_variation=0.5)
+    np.random.seed(24)
+    count, edges = create_gridded_data_random_origin_chunked(parquet, 0.001, -3, 4, range_of_variation=0.5, chunk_size=700, column='x')
+    assert np.array_equal(count, expected)
+    assert np.array_equal(edges, expected_edges)
+
+    # Without a column only the first one is read, not the weights after it
+    expected, _ = create_gridded_data(data, 0.01, -3, 4)
+    count, _ = create_gridded_data_chunked(parquet, 0.01, -3, 4, 333)
+    assert np.array_equal(count, expected)
+    assert all(chunk.ndim == 1 for chunk in iter_point_chunks(parquet, 1000, 1))
+
+def test_chunked_gridding_2d_matches_in_memory(tmp_path):
+    """
+    Test the 2D chunked gridding against create_gridded_data_2d, with float and
+    compact counts.
+    """
+    np.random.seed(25)
+    data = np.random.uniform(-0.5, 1.5, (3000, 2))
+    npy, parquet = write_sources(tmp_path, data, ['x', 'y'])
+    np.random.seed(26)
+    expected, expected_x, expected_y = create_gridded_data_2d(data, 0.05, (0, 1), (0, 1), range_of_variation=0.2)
+    for source in [npy, parquet]:
+        for compact in [False, True]:
+            np.random.seed(26)
+            stats = {}
+            count, edges_x, edges_y = create_gridded_data_2d_chunked(
+                source, 0.05, (0, 1), (0, 1), range_of_variation=0.2, chunk_size=400, columns=['x', 'y'], compact=compact, stats=stats)
+            assert np.array_equal(count, expected)
+            assert count.dtype == (np.uint16 if compact else expected.dtype)
+            assert np.array_equal(edges_x, expected_x) and np.array_equal(edges_y, expected_y)
+            assert stats['chunks'] == (8 if source == npy else 9)
+
+    count, _, _ = create_gridded_data_2d_chunked(parquet, 0.05, (0, 1), (0, 1), chunk_size=400)
+    assert np.array_equal(count, create_gridded_data_2d(data, 0.05, (0, 1), (0, 1))[0])
+
+def test_compact_chunked_counts_are_widened():
+    """
+    Test that compact counts are widened when they outgrow their type.
+    """
+    chunks = [np.full(30000, 0.5) for _ in range(3)]
+    count = histogram_chunks(chunks, [np.linspace(0, 1, 5)], compact=True)
+    assert count.dtype == np.int32
+    assert count.tolist() == [0, 0, 90000, 0]
+    assert histogram_chunks(iter([]), [np.linspace(0, 1, 5)]).tolist() == [0, 0, 0, 0]
+    assert [len(chunk) for chunk in iter_point_chunks(np.arange(10), 4)] == [4, 4, 2]
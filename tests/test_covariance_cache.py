@@ -0,0 +1,40 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from covariance_cache import FactorCache
+from point_processes_1d import sample_gaussian_field, covariance_cache
+import numpy as np
+
+def test_factor_cache_eviction():
+    """
+    Test the hit and miss counters and the least recently used eviction.
+    """
+    cache = FactorCache(max_bytes=3 * 80, max_entries=10)
+    calls = []
+    def compute(key):
+        calls.append(key)
+        return np.full(10, key, dtype=float)
+    for key in [0, 1, 2, 0, 3, 1]:
+        factor = cache.get(key, lambda: compute(key))
+        assert factor[0] == key
+    # 3 evicts 1, the least recently used, so 1 is computed again
+    assert calls == [0, 1, 2, 3, 1]
+    assert cache.info() == {'hits': 1, 'misses': 5, 'evictions': 2, 'entries': 3, 'nbytes': 240}
+
+    cache.set_limits(max_entries=1)
+    assert cache.info()['entries'] == 1
+    assert cache.get(1, lambda: compute(-1))[0] == 1
+
+def test_sample_gaussian_field_reuses_factor():
+    """
+    Test that repeated draws reuse the cached factor and give the same fields for a seed.
+    """
+    covariance_cache.clear()
+    np.random.seed(8)
+    first = sample_gaussian_field(50, 0.02, 1.0, 0.1, size=3)
+    np.random.seed(8)
+    second = sample_gaussian_field(50, 0.02, 1.0, 0.1, size=3)
+    assert np.array_equal(first, second)
+    assert covariance_cache.misses == 1
+    assert covariance_cache.hits == 1
@@ -0,0 +1,53 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from point_processes_1d import (
+    get_neyman_scott_process,
+    sample_gaussian_field,
+    get_log_gaussian_cox_process,
+    get_log_gaussian_cox_process_direct_sampling,
+)
+import numpy as np
+
+def test_sample_gaussian_field_covariance():
+    """
+    Test that circulant embedding reproduces the squared exponential covariance.
+    """
+    np.random.seed(6)
+    n, dx, variance, length_scale = 40, 0.05, 1.5, 0.1
+    fields = sample_gaussian_field(n, dx, variance, length_scale, size=20000)
+    assert fields.shape == (20000, n)
+
+    x = np.arange(n) * dx
+    expected = variance * np.exp(-0.5 * ((x[:, None] - x[None, :]) / length_scale)**2)
+    covariance = np.cov(fields, rowvar=False)
+    assert np.allclose(np.mean(fields, axis=0), 0, atol=0.05)
+    assert np.max(np.abs(covariance - expected)) < 0.1, f"Max covariance error {np.max(np.abs(covariance - expected))}"
+
+def test_log_gaussian_cox_process_within_domain():
+    """
+    Test that the log-Gaussian Cox processes return points within the domain.
+    """
+    np.random.seed(7)
+    for process in [get_log_gaussian_cox_process, get_log_gaussian_cox_process_direct_sampling]:
+        points = process(0.01, np.log(200), 1, 0.05, start=-3, end=4)
+        assert points.ndim == 1
+        assert len(points) > 0
+        assert np.all((points >= -3) & (points <= 4))
+
+def test_neyman_scott_process_counts():
+    """
+    Test that the Neyman-Scott process returns its parents after their offspring
+    and has the expected mean number of points.
+    """
+    np.random.seed(10)
+    lambda_p, lambda_c = 20, 5
+    counts = []
+    for _ in range(2000):
+        points = get_neyman_scott_process(lambda_p, lambda_c, 0.01)
+        counts.append(len(points))
+    assert np.isclose(np.mean(counts), lambda_p * (1 + lambda_c), rtol=0.03)
+
+    points = get_neyman_scott_process(lambda_p, 0, 0.01)
+    assert np.all((points >= 0) & (points <= 1))
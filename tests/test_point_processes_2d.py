@@ -0,0 +1,51 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from point_processes_2d import (
+    get_neyman_scott_process_2d,
+    sample_gaussian_field_2d,
+    get_lgcp_2d,
+)
+import numpy as np
+
+def test_sample_gaussian_field_2d_covariance():
+    """
+    Test that 2D circulant embedding reproduces the squared exponential covariance.
+    """
+    np.random.seed(8)
+    shape, dx, variance, length_scale = (12, 9), 0.05, 0.5, 0.1
+    fields = sample_gaussian_field_2d(shape, dx, variance, length_scale, size=10000)
+    assert fields.shape == (10000, 12, 9)
+
+    xx, yy = np.meshgrid(np.arange(shape[0]) * dx, np.arange(shape[1]) * dx, indexing='ij')
+    coords = np.column_stack((xx.ravel(), yy.ravel()))
+    squared_distance = np.sum((coords[:, None, :] - coords[None, :, :])**2, axis=-1)
+    expected = variance * np.exp(-0.5 * squared_distance / length_scale**2)
+    covariance = np.cov(fields.reshape(len(fields), -1), rowvar=False)
+    assert np.max(np.abs(covariance - expected)) < 0.05, f"Max covariance error {np.max(np.abs(covariance - expected))}"
+
+def test_lgcp_2d_within_domain():
+    """
+    Test that get_lgcp_2d returns points within the requested domain.
+    """
+    np.random.seed(9)
+    for x_range, y_range in [((0, 1), (0, 1)), ((-1, 2), (-1, 2)), ((0, 2), (0.5, 1))]:
+        points = get_lgcp_2d(200, x_range[0], x_range[1], y_range[0], y_range[1], grid_size=64, length_scale=0.05)
+        assert points.shape[1] == 2
+        assert np.all((points[:, 0] >= x_range[0]) & (points[:, 0] <= x_range[1]))
+        assert np.all((points[:, 1] >= y_range[0]) & (points[:, 1] <= y_range[1]))
+
+def test_neyman_scott_process_2d_offspring():
+    """
+    Test the shape and the mean number of offspring of the 2D Neyman-Scott process.
+    """
+    np.random.seed(11)
+    lambda_p, lambda_c = 20, 5
+    counts = []
+    for _ in range(2000):
+        points = get_neyman_scott_process_2d(lambda_p, lambda_c, 0.01, 0, 1, 0, 2)
+        assert points.shape == (len(points), 2)
+        counts.append(len(points))
+    assert np.isclose(np.mean(counts), lambda_p * 2 * lambda_c, rtol=0.03)
+    assert get_neyman_scott_process_2d(lambda_p, 0, 0.01, 0, 1, 0, 1).shape == (0, 2)
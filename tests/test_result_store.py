@@ -0,0 +1,94 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from simulation1d import run_simulation_random_polygon_placement_and_grid_origin
+from point_processes_1d import get_poisson_process_samples
+from result_store import ResultStore, describe_generator
+from functools import partial
+import pytest
+import numpy as np
+
+def test_store_resumes_and_extends_sweep(tmp_path):
+    """
+    Test that stored points are not simulated again, that extending dg only
+    simulates the new points, and that the results match an unstored sweep.
+    """
+    calls = []
+    def point_process(rate, start, end):
+        calls.append(rate)
+        return get_poisson_process_samples(rate, start, end)
+
+    dg = [0.01, 0.1, 0.3]
+    dp = [0.5, 0.5, 0.5]
+    expected = run_simulation_random_polygon_placement_and_grid_origin(100, -3, 4, 20, dg, dp, point_process, seed=7)
+    calls.clear()
+
+    store = str(tmp_path / 'results')
+    first = run_simulation_random_polygon_placement_and_grid_origin(100, -3, 4, 20, dg[:2], dp[:2], point_process, seed=7, store=store, generator_key='poisson')
+    assert len(calls) == 40
+    result = run_simulation_random_polygon_placement_and_grid_origin(100, -3, 4, 20, dg, dp, point_process, seed=7, store=store, generator_key='poisson')
+    assert len(calls) == 60
+    for key, values in expected.items():
+        assert np.allclose(result[key], values, equal_nan=True), f"Mismatch in {key}"
+        assert np.allclose(first[key], values[:2], equal_nan=True), f"Mismatch in {key}"
+
+    table = ResultStore(store).load()
+    assert len(table) == 3
+    assert sorted(table['grid_width']) == dg
+    assert set(table['scenario']) == {'random_polygon_placement_and_grid_origin'}
+
+    # The points are seeded by their widths, so a reordered sweep reads the
+    # stored points, and simulating it gives the same results
+    reordered = run_simulation_random_polygon_placement_and_grid_origin(100, -3, 4, 20, dg[::-1], dp[::-1], point_process, seed=7, store=store, generator_key='poisson')
+    assert len(calls) == 60
+    for key, values in expected.items():
+        assert np.array_equal(reordered[key], values[::-1], equal_nan=True), f"Mismatch in {key}"
+    reordered = run_simulation_random_polygon_placement_and_grid_origin(100, -3, 4, 20, dg[::-1], dp[::-1], point_process, seed=7)
+    for key, values in expected.items():
+        assert np.allclose(reordered[key], values[::-1], equal_nan=True), f"Mismatch in {key}"
+
+    # A different seed is a different sweep
+    run_simulation_random_polygon_placement_and_grid_origin(100, -3, 4, 20, dg[:1], dp[:1], point_process, seed=8, store=store, generator_key='poisson')
+    assert len(calls) == 140
+    assert len(ResultStore(store).load()) == 4
+
+def test_store_extends_common_random_numbers_sweep(tmp_path):
+    """
+    Test that with common random numbers, extending dg through the store leaves
+    the earlier points unchanged, although every point draws its own grid origins.
+    """
+    dg = [0.05, 0.1, 0.3]
+    dp = [0.5, 0.5, 0.5]
+    options = dict(seed=11, batch_size=10, common_random_numbers=True)
+    expected = run_simulation_random_polygon_placement_and_grid_origin(100, -3, 4, 30, dg, dp, get_poisson_process_samples, **options)
+    store = str(tmp_path / 'results')
+    first = run_simulation_random_polygon_placement_and_grid_origin(100, -3, 4, 30, dg[:2], dp[:2], get_poisson_process_samples, store=store, **options)
+    result = run_simulation_random_polygon_placement_and_grid_origin(100, -3, 4, 30, dg, dp, get_poisson_process_samples, store=store, **options)
+    for key, values in expected.items():
+        assert np.array_equal(first[key], values[:2], equal_nan=True), f"Mismatch in {key}"
+        assert np.array_equal(result[key], values, equal_nan=True), f"Mismatch in {key}"
+
+    # Reordering the points does not change their grid origins either
+    reordered = run_simulation_random_polygon_placement_and_grid_origin(100, -3, 4, 30, dg[::-1], dp[::-1], get_poisson_process_samples, **options)
+    for key, values in expected.items():
+        assert np.array_equal(reordered[key], values[::-1], equal_nan=True), f"Mismatch in {key}"
+
+def test_store_keys_tell_generators_apart(tmp_path):
+    """
+    Test that lambdas and local functions need a generator_key with a store, and
+    that the key and the arguments of a partial tell generators apart.
+    """
+    store = str(tmp_path / 'results')
+    sparse = lambda rate, start, end: get_poisson_process_samples(rate / 2, start, end)
+    with pytest.raises(ValueError):
+        run_simulation_random_polygon_placement_and_grid_origin(100, -3, 4, 5, [0.1], [0.5], sparse, seed=7, store=store)
+    dense = lambda rate, start, end: get_poisson_process_samples(rate * 2, start, end)
+    for point_process, generator_key in [(sparse, 'sparse'), (dense, 'dense')]:
+        run_simulation_random_polygon_placement_and_grid_origin(100, -3, 4, 5, [0.1], [0.5], point_process, seed=7, store=store, generator_key=generator_key)
+    assert sorted(ResultStore(store).load()['point_process']) == ['dense', 'sparse']
+    # Without a store the generator is not described
+    run_simulation_random_polygon_placement_and_grid_origin(100, -3, 4, 5, [0.1], [0.5], sparse, seed=7)
+
+    assert describe_generator(partial(get_poisson_process_samples, 100)) == ('get_poisson_process_samples', {'args': [100]})
+    assert describe_generator(partial(sparse, 100), 'sparse') == ('sparse', {'args': [100]})
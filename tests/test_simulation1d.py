@@ -0,0 +1,168 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from simulation1d import (
+    run_simulation_fixed_edge,
+    run_simulation_random_polygon_placement,
+    run_simulation_random_polygon_placement_and_grid_origin,
+)
+from point_processes_1d import get_poisson_process_samples
+import numpy as np
+
+def get_fixed_points(rate, start, end):
+    """
+    Same irregular points at every call, without drawing random numbers.
+    """
+    return start + (end - start) * (np.arange(rate) * 0.618034 % 1)
+
+def test_batched_simulation_matches_loop():
+    """
+    Test that the batched runners give the statistics of the trial-by-trial
+    loop: the same ones when nothing is drawn, and the same ones up to the
+    sampling error otherwise, since the batches draw their trials differently.
+    """
+    dg = np.array([0.01, 0.1, 0.3])
+    dp = 0.5 * np.ones(3)
+    expected = run_simulation_fixed_edge(100, -3, 4, 10, dg, dp, get_fixed_points)
+    result = run_simulation_fixed_edge(100, -3, 4, 10, dg, dp, get_fixed_points, batch_size=4)
+    for key, values in expected.items():
+        assert np.allclose(result[key], values, equal_nan=True), f"Mismatch in {key}"
+
+    trials = 1000
+    for run_simulation in [
+        run_simulation_fixed_edge,
+        run_simulation_random_polygon_placement,
+        run_simulation_random_polygon_placement_and_grid_origin,
+    ]:
+        expected = run_simulation(100, -3, 4, trials, dg, dp, get_poisson_process_samples, seed=0)
+        result = run_simulation(100, -3, 4, trials, dg, dp, get_poisson_process_samples, batch_size=300, seed=1)
+        for method in ['centroid', 'proportional']:
+            mean = np.array(result[f'mean_estimate_{method}'])
+            expected_mean = np.array(expected[f'mean_estimate_{method}'])
+            error = np.sqrt((np.array(result[f'var_estimate_{method}']) + np.array(expected[f'var_estimate_{method}'])) / trials)
+            assert np.all(np.abs(mean - expected_mean) <= 5 * error + 1e-9), f"{run_simulation.__name__}. Mismatch in the {method} estimates"
+
+def test_seeded_simulation_does_not_depend_on_n_jobs():
+    """
+    Test that a seeded sweep gives bit-identical results for any number of workers.
+    """
+    dg = np.array([0.01, 0.1, 0.3])
+    dp = 0.5 * np.ones(3)
+    expected = run_simulation_random_polygon_placement_and_grid_origin(
+        100, -3, 4, 30, dg, dp, get_poisson_process_samples, batch_size=10, seed=42)
+    result = run_simulation_random_polygon_placement_and_grid_origin(
+        100, -3, 4, 30, dg, dp, get_poisson_process_samples, batch_size=10, n_jobs=3, seed=42)
+    for key, values in expected.items():
+        assert np.array_equal(result[key], values, equal_nan=True), f"Mismatch in {key}"
+
+    other = run_simulation_random_polygon_placement_and_grid_origin(
+        100, -3, 4, 30, dg, dp, get_poisson_process_samples, batch_size=10, seed=43)
+    assert not np.array_equal(other['mean_estimate_centroid'], expected['mean_estimate_centroid'])
+
+def test_grid_free_simulation_matches_loop():
+    """
+    Test that the grid-free estimators give the same statistics as the histograms.
+    """
+    dg = np.array([0.001, 0.1, 0.3])
+    dp = np.array([0.5, 0.05, 2.0])
+    for run_simulation in [
+        run_simulation_fixed_edge,
+        run_simulation_random_polygon_placement,
+        run_simulation_random_polygon_placement_and_grid_origin,
+    ]:
+        expected = run_simulation(100, -3, 4, 40, dg, dp, get_poisson_process_samples, seed=3)
+        result = run_simulation(100, -3, 4, 40, dg, dp, get_poisson_process_samples, seed=3, grid_free=True)
+        for key, values in expected.items():
+            assert np.allclose(result[key], values, equal_nan=True), f"{run_simulation.__name__}. Mismatch in {key}"
+
+def test_common_random_numbers():
+    """
+    Test that common random numbers evaluate the same realizations at every point
+    and match the default for a single point.
+    """
+    np.random.seed(5)
+    expected = run_simulation_random_polygon_placement_and_grid_origin(100, -3, 4, 30, [0.1], [0.5], get_poisson_process_samples)
+    np.random.seed(5)
+    result = run_simulation_random_polygon_placement_and_grid_origin(100, -3, 4, 30, [0.1], [0.5], get_poisson_process_samples, common_random_numbers=True)
+    for key, values in expected.items():
+        assert np.allclose(result[key], values, equal_nan=True), f"Mismatch in {key}"
+
+    dg = [0.1, 0.3, 0.1]
+    dp = [0.5, 0.5, 0.5]
+    result = run_simulation_random_polygon_placement(
+        100, -3, 4, 30, dg, dp, get_poisson_process_samples, batch_size=7, n_jobs=2, seed=6, common_random_numbers=True)
+    for key, values in result.items():
+        assert values[0] == values[2], f"Mismatch in {key}"
+
+def test_adaptive_trials():
+    """
+    Test that the adaptive mode stops the points with precise statistics early
+    and reports the number of trials run for each point.
+    """
+    # On a very fine grid the rare non-zero errors keep the intervals wide
+    dg = [0.001, 0.5]
+    dp = [0.5, 0.5]
+    result = run_simulation_random_polygon_placement(
+        100, -3, 4, 2000, dg, dp, get_poisson_process_samples, batch_size=50, seed=9, target_relative_width=0.2)
+    assert result['trials'][1] < result['trials'][0] == 2000
+    assert all(trials % 50 == 0 for trials in result['trials'])
+
+    result = run_simulation_random_polygon_placement(
+        100, -3, 4, 60, dg, dp, get_poisson_process_samples, batch_size=50, seed=9, target_relative_width=1e-6)
+    assert result['trials'] == [60, 60]
+
+def test_profile():
+    """
+    Test that the profile records every stage of every point, with the shared
+    generation of common random numbers kept apart.
+    """
+    dg = [0.01, 0.1]
+    dp = [0.5, 0.5]
+    result = run_simulation_random_polygon_placement(100, -3, 4, 20, dg, dp, get_poisson_process_samples, seed=1, profile=True)
+    assert len(result['profile']['points']) == 2
+    for stages in result['profile']['points']:
+        assert set(stages) == {'generation', 'gridding', 'ground_truth', 'estimation', 'shard'}
+        assert stages['gridding']['calls'] == 20
+        assert stages['gridding']['peak_memory'] > 0
+    assert result['profile']['total']['estimation']['calls'] == 40
+
+    result = run_simulation_random_polygon_placement(
+        100, -3, 4, 20, dg, dp, get_poisson_process_samples, seed=1, profile=True, common_random_numbers=True)
+    assert result['profile']['shared']['generation']['calls'] == 20
+    assert 'generation' not in result['profile']['points'][0]
+    assert result['profile']['points'][1]['estimation']['calls'] == 20
+    assert 'profile' not in run_simulation_random_polygon_placement(100, -3, 4, 5, dg, dp, get_poisson_process_samples)
+
+def test_polygons_per_realization():
+    """
+    Test that evaluating several polygons per realization gives the statistics
+    of one polygon per realization when every realization is the same, and runs
+    the point process once per realization.
+    """
+    dg = [0.01, 0.1, 0.3]
+    dp = [0.5, 0.05, 2.0]
+    for options in [{}, {'grid_free': True}, {'common_random_numbers': True}, {'batch_size': 16}]:
+        expected = run_simulation_random_polygon_placement(100, -3, 4, 40, dg, dp, get_fixed_points, seed=7, **options)
+        result = run_simulation_random_polygon_placement(
+            100, -3, 4, 40, dg, dp, get_fixed_points, seed=7, polygons_per_realization=7, **options)
+        for key, values in expected.items():
+            assert np.allclose(result[key], values, equal_nan=True), f"{options}. Mismatch in {key}"
+
+    result = run_simulation_random_polygon_placement_and_grid_origin(
+        100, -3, 4, 40, dg, dp, get_poisson_process_samples, seed=7, profile=True, polygons_per_realization=7)
+    assert result['trials'] == [40, 40, 40]
+    assert result['profile']['points'][0]['generation']['calls'] == 6
+
+def test_compact_counts_simulation():
+    """
+    Test that compact counts give the same statistics in every mode of the runners.
+    """
+    dg = [0.01, 0.1]
+    dp = [0.5, 0.05]
+    for options in [{}, {'batch_size': 8}, {'common_random_numbers': True}, {'polygons_per_realization': 5}]:
+        expected = run_simulation_random_polygon_placement_and_grid_origin(100, -3, 4, 20, dg, dp, get_poisson_process_samples, seed=8, **options)
+        result = run_simulation_random_polygon_placement_and_grid_origin(
+            100, -3, 4, 20, dg, dp, get_poisson_process_samples, seed=8, compact=True, **options)
+        for key, values in expected.items():
+            assert np.allclose(result[key], values, equal_nan=True), f"{options}. Mismatch in {key}"
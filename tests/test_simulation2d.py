@@ -0,0 +1,120 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from simulation2d import (
+    run_simulation_fixed_edge_2d,
+    run_simulation_random_polygon_placement_2d,
+    run_simulation_random_polygon_placement_and_grid_origin_2d,
+    _estimate,
+    _estimate_polygons,
+)
+from point_processes_2d import get_poisson_process_samples_2d
+import numpy as np
+
+def poisson_process(rate, x_range, y_range):
+    return get_poisson_process_samples_2d(rate, x_range[0], x_range[1], y_range[0], y_range[1])
+
+def test_batched_simulation_matches_loop_2d():
+    """
+    Test that the batched runners give the statistics of the trial-by-trial
+    loop up to the sampling error, since the batches draw their trials differently.
+    """
+    dg = np.array([0.05, 0.1, 0.3])
+    dp = 0.5 * np.ones(3)
+    trials = 400
+    for run_simulation, x_range in [
+        (run_simulation_fixed_edge_2d, (0, 1)),
+        (run_simulation_random_polygon_placement_2d, (-1, 1)),
+        (run_simulation_random_polygon_placement_and_grid_origin_2d, (-1, 2)),
+    ]:
+        expected = run_simulation(100, x_range, x_range, trials, dg, dp, poisson_process, seed=0)
+        result = run_simulation(100, x_range, x_range, trials, dg, dp, poisson_process, batch_size=150, seed=1)
+        for method in ['centroid', 'proportional']:
+            mean = np.array(result[f'mean_estimate_{method}'])
+            expected_mean = np.array(expected[f'mean_estimate_{method}'])
+            error = np.sqrt((np.array(result[f'var_estimate_{method}']) + np.array(expected[f'var_estimate_{method}'])) / trials)
+            assert np.all(np.abs(mean - expected_mean) <= 5 * error + 1e-9), f"{run_simulation.__name__}. Mismatch in the {method} estimates"
+
+def test_seeded_simulation_does_not_depend_on_n_jobs_2d():
+    """
+    Test that a seeded sweep gives bit-identical results for any number of workers.
+    """
+    dg = np.array([0.05, 0.1, 0.3])
+    dp = 0.5 * np.ones(3)
+    expected = run_simulation_random_polygon_placement_2d(100, (-1, 1), (-1, 1), 12, dg, dp, poisson_process, seed=7)
+    result = run_simulation_random_polygon_placement_2d(100, (-1, 1), (-1, 1), 12, dg, dp, poisson_process, n_jobs=2, seed=7)
+    for key, values in expected.items():
+        assert np.array_equal(result[key], values, equal_nan=True), f"Mismatch in {key}"
+
+def test_grid_free_simulation_matches_loop_2d():
+    """
+    Test that the grid-free estimators give the same statistics as the histograms.
+    """
+    dg = np.array([0.01, 0.1, 0.3])
+    dp = np.array([0.5, 0.05, 0.8])
+    for run_simulation, x_range in [
+        (run_simulation_fixed_edge_2d, (0, 1)),
+        (run_simulation_random_polygon_placement_2d, (-1, 1)),
+        (run_simulation_random_polygon_placement_and_grid_origin_2d, (-1, 2)),
+    ]:
+        expected = run_simulation(100, x_range, x_range, 20, dg, dp, poisson_process, seed=4)
+        result = run_simulation(100, x_range, x_range, 20, dg, dp, poisson_process, seed=4, grid_free=True)
+        for key, values in expected.items():
+            assert np.allclose(result[key], values, equal_nan=True), f"{run_simulation.__name__}. Mismatch in {key}"
+
+def test_common_random_numbers_2d():
+    """
+    Test that common random numbers evaluate the same realizations at every point
+    and match the default for a single point.
+    """
+    np.random.seed(5)
+    expected = run_simulation_random_polygon_placement_and_grid_origin_2d(100, (-1, 2), (-1, 2), 20, [0.1], [0.5], poisson_process)
+    np.random.seed(5)
+    result = run_simulation_random_polygon_placement_and_grid_origin_2d(100, (-1, 2), (-1, 2), 20, [0.1], [0.5], poisson_process, common_random_numbers=True)
+    for key, values in expected.items():
+        assert np.allclose(result[key], values, equal_nan=True), f"Mismatch in {key}"
+
+    result = run_simulation_random_polygon_placement_2d(
+        100, (-1, 1), (-1, 1), 20, [0.1, 0.3, 0.1], [0.5, 0.5, 0.5], poisson_process, seed=6, grid_free=True, common_random_numbers=True)
+    for key, values in result.items():
+        assert values[0] == values[2], f"Mismatch in {key}"
+
+def test_polygons_per_realization_2d():
+    """
+    Test that the polygons of a realization are evaluated like one polygon at a
+    time, and that the point process runs once per realization.
+    """
+    np.random.seed(8)
+    data = poisson_process(300, (-1, 2), (-1, 2))
+    polygon_start = np.random.uniform(-1, 1, (2, 20))
+    for grid_free in [False, True]:
+        result = _estimate_polygons(data, 0.1, polygon_start, 0.5, (-1, 2), (-1, 2), False, grid_free)
+        for i in range(20):
+            expected = _estimate(data, 0.1, polygon_start[:, i], 0.5, (-1, 2), (-1, 2), False, grid_free)
+            assert np.allclose([values[i] for values in result], expected), f"Polygon {i}. Expected {expected}"
+
+    dg = [0.05, 0.1, 0.3]
+    dp = [0.5, 0.05, 1.0]
+    result = run_simulation_random_polygon_placement_and_grid_origin_2d(
+        100, (-1, 2), (-1, 2), 30, dg, dp, poisson_process, seed=7, profile=True, polygons_per_realization=7)
+    assert result['trials'] == [30, 30, 30]
+    assert result['profile']['points'][0]['generation']['calls'] == 5
+
+def test_sparse_simulation_2d():
+    """
+    Test that gridding into sparse counts gives the same statistics in every mode
+    of the runners.
+    """
+    dg = [0.01, 0.1]
+    dp = [0.5, 0.3]
+    for options in [{}, {'batch_size': 8}, {'common_random_numbers': True}, {'polygons_per_realization': 5}]:
+        # Sparse counts are gridded one realization at a time, so with batch_size
+        # they simulate the trials of the grid-free estimators rather than those
+        # of the batches
+        reference = dict(options, grid_free=True) if 'batch_size' in options else options
+        expected = run_simulation_random_polygon_placement_and_grid_origin_2d(100, (-1, 2), (-1, 2), 20, dg, dp, poisson_process, seed=9, **reference)
+        result = run_simulation_random_polygon_placement_and_grid_origin_2d(
+            100, (-1, 2), (-1, 2), 20, dg, dp, poisson_process, seed=9, sparse=True, **options)
+        for key, values in expected.items():
+            assert np.allclose(result[key], values, equal_nan=True), f"{options}. Mismatch in {key}"
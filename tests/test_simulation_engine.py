@@ -0,0 +1,69 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from simulation_engine import RunningMoments, ErrorAccumulator, has_converged, point_profile, profiling, stage
+import numpy as np
+
+def test_running_moments_merge():
+    """
+    Test that merging the moments of blocks matches np.mean and np.var of all values.
+    """
+    np.random.seed(5)
+    values = np.random.normal(3, 2, 1000)
+    moments = RunningMoments()
+    for block in np.array_split(values, 7):
+        moments.merge(RunningMoments().update(block))
+    assert moments.count == 1000
+    assert np.isclose(moments.mean, np.mean(values))
+    assert np.isclose(moments.variance, np.var(values))
+    assert np.isnan(RunningMoments().mean)
+
+def test_error_accumulator_summary():
+    """
+    Test the error statistics, including trials with an actual value of zero.
+    """
+    actual = np.array([0, 2, 4, 5])
+    centroid = np.array([1, 2, 2, 5])
+    proportional = np.array([0.5, 1.5, 4.5, 5.0])
+    accumulator = ErrorAccumulator().update(actual[:2], centroid[:2], proportional[:2])
+    accumulator.merge(ErrorAccumulator().update(actual[2:], centroid[2:], proportional[2:]))
+    summary = accumulator.summary()
+
+    assert accumulator.trials == 4
+    assert np.isclose(summary['mean_estimate_centroid'], np.mean(centroid - actual))
+    assert np.isclose(summary['var_estimate_proportional'], np.var(proportional - actual))
+    assert np.isclose(summary['mean_mape_centroid'], np.mean([0, 50, 0]))
+    assert np.isclose(summary['mean_mape_proportional'], np.mean([25, 12.5, 0]))
+
+def test_has_converged():
+    """
+    Test the stopping rule on the width of the confidence intervals.
+    """
+    np.random.seed(7)
+    actual = np.random.poisson(50, 400) + 1
+    accumulator = ErrorAccumulator().update(actual, actual + np.random.normal(0, 5, 400), actual + np.random.normal(0, 1, 400))
+    # 95% interval width on the mean error is about 4 / sqrt(400) = 0.2 of the RMS error
+    assert has_converged(accumulator, 0.25)
+    assert not has_converged(accumulator, 0.15)
+    assert not has_converged(ErrorAccumulator().update([1], [1], [1]), 0.5)
+
+def test_stage_is_a_no_op_without_profiling():
+    """
+    Test that stages are only recorded inside profiling.
+    """
+    with stage('generation'):
+        pass
+    with profiling() as profile:
+        with stage('generation'):
+            np.ones(1000)
+        with point_profile(1):
+            with stage('estimation'):
+                pass
+    with stage('generation'):
+        pass
+    assert profile.stages['generation'][2] == 1
+    assert profile.points[1].stages['estimation'][2] == 1
+    assert set(profile.as_dict()) == {'generation', 'shard'}
+    with profiling(False) as profile:
+        assert profile is None